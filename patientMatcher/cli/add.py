@@ -41,8 +41,14 @@ def add():
 @click.option(
     "-c", "--contact", type=click.STRING, nargs=1, required=False, help="An email address"
 )
+@click.option(
+    "--max_connections",
+    type=click.INT,
+    required=False,
+    help="Max number of open connections to the node (default 10)",
+)
 @with_appcontext
-def node(id, label, token, matching_url, accepted_content, contact=None):
+def node(id, label, token, matching_url, accepted_content, contact=None, max_connections=None):
     """Adds a new server to database"""
     click.echo("Adding a new MatchMaker node to database")
     node_obj = {
@@ -54,6 +60,8 @@ def node(id, label, token, matching_url, accepted_content, contact=None):
         "accepted_content": accepted_content,
         "contact": contact,
     }
+    if max_connections:
+        node_obj["max_connections"] = max_connections
     inserted_id, collection = add_node(mongo_db=current_app.db, obj=node_obj, is_client=False)
     if inserted_id:
         click.echo(
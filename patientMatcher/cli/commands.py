@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import json
 import sys
 
 import click
@@ -7,7 +8,11 @@ from flask import Flask, current_app
 from flask.cli import FlaskGroup, routes_command, run_command, with_appcontext
 from flask_mail import Message
 from patientMatcher import __version__
-from patientMatcher.server import create_app
+from patientMatcher.parse.patient import features_to_hpo
+from patientMatcher.resources import path_to_benchmark_patients
+from patientMatcher.server import create_app, extensions
+from patientMatcher.utils.node_health import nodes_health, reset_node
+from patientMatcher.utils.similarity import ENGINES, PhenotypeSimilarity, benchmark
 
 from .add import add
 from .remove import remove
@@ -125,9 +130,69 @@ def email(recipient):
         click.echo('An error occurred while sending test email: "{}"'.format(err))
 
 
+@test.command()
+@with_appcontext
+@click.option(
+    "-r",
+    "--repeats",
+    type=click.INT,
+    default=3,
+    show_default=True,
+    help="Number of times the demo patients are compared",
+)
+def similarity(repeats):
+    """Benchmarks the phenotype similarity engines comparing the demo patients with each other"""
+    with open(path_to_benchmark_patients) as json_data:
+        patients_terms = [
+            features_to_hpo(patient.get("features")) for patient in json.load(json_data)
+        ]
+
+    click.echo(f"Engine selected in config: {extensions.similarity.engine.name}")
+    for engine_name in ENGINES:
+        engine_selector = PhenotypeSimilarity()
+        engine_selector.init_app(engine_name, extensions.simgic, extensions.hpoic)
+        throughput = benchmark(engine_selector.engine, patients_terms, repeats)
+        click.echo(f"{engine_name}: {throughput:.0f} comparisons/second")
+
+
+@click.command()
+@with_appcontext
+@click.option(
+    "-r",
+    "--reset",
+    type=click.STRING,
+    nargs=1,
+    required=False,
+    help="ID of a node whose failed requests should be forgotten, to send requests to it again",
+)
+def nodes(reset):
+    """Shows the health of the connected nodes, computed from the recent match requests"""
+    if reset:
+        if reset_node(current_app.db, reset):
+            click.echo(f"Health of node {reset} was reset")
+        else:
+            click.echo(f"No saved health for node {reset}")
+        return
+
+    for health in nodes_health(current_app.db):
+        latencies = [
+            f"{health[key]:.2f}s" if health[key] is not None else "-"
+            for key in ["latency_p50", "latency_p95", "latency_p99"]
+        ]
+        error_rate = f"{health['error_rate']:.0%}" if health["error_rate"] is not None else "-"
+        click.echo(
+            f"{health['id']}: {health['state']}, {health['requests']} requests, "
+            f"errors {error_rate}, latency p50/p95/p99 {'/'.join(latencies)}"
+        )
+        if health["last_error"]:
+            click.echo(f"  last error: {health['last_error']}")
+
+
 cli.add_command(test)
 test.add_command(name)
 test.add_command(email)
+test.add_command(similarity)
 cli.add_command(add)
 cli.add_command(update)
 cli.add_command(remove)
+cli.add_command(nodes)
@@ -5,8 +5,11 @@ import logging
 import click
 from flask.cli import current_app, with_appcontext
 from patientMatcher.parse.patient import EMAIL_REGEX, href_validate
+from patientMatcher.server.extensions import ensembl_cache, simgic
 from patientMatcher.utils.patient import patients
-from patientMatcher.utils.update import update_resources
+from patientMatcher.utils.phenotype_index import update_phenotype_fingerprints
+from patientMatcher.utils.update import update_resources, warm_up_ensembl_cache
+from patientMatcher.utils.variant_index import update_variant_indexes
 
 LOG = logging.getLogger(__name__)
 
@@ -79,3 +82,46 @@ def resources(test):
     https://github.com/obophenotype/human-phenotype-ontology/releases/latest/download/phenotype.hpoa
     """
     update_resources(test)
+
+
+@update.command()
+@with_appcontext
+def fingerprints():
+    """Updates the phenotype fingerprints of the patients created with older HPO resources.
+    Run it after the phenotype resources have been updated and the server restarted.
+    """
+    n_updated = update_phenotype_fingerprints(current_app.db, simgic)
+    click.echo(f"Phenotype fingerprint updated for {n_updated} patients.")
+
+
+@update.command(name="variant-keys")
+@with_appcontext
+@click.option(
+    "--retry-failed",
+    is_flag=True,
+    help="Update also the patients whose variants could not be lifted before",
+)
+def variant_keys(retry_failed):
+    """Creates the keys of the variants in both genome builds of the patients saved by older
+    versions of the software, used to match variants without lifting them.
+    """
+    n_updated, n_failed = update_variant_indexes(current_app.db, retry_failed)
+    click.echo(f"Variant keys created for {n_updated} patients.")
+    if n_failed:
+        click.echo(
+            f"Variants of {n_failed} patients could not be lifted to the other genome build. "
+            "Use the --retry-failed option to try again."
+        )
+
+
+@update.command(name="ensembl-cache")
+@with_appcontext
+def ensembl_cache_command():
+    """Saves in the Ensembl cache the responses used to convert the genes and lift the variants
+    of all patients in the database. Requires the ENSEMBL_CACHE_TTL config parameter.
+    """
+    if ensembl_cache.enabled is False:
+        click.echo("Ensembl cache is not enabled. Set the ENSEMBL_CACHE_TTL config parameter.")
+        return
+    n_genes, n_variants = warm_up_ensembl_cache(current_app.db)
+    click.echo(f"Ensembl cache updated for {n_genes} genes and {n_variants} variants.")
@@ -1,4 +1,10 @@
-from patientMatcher.resources import path_to_hpo_terms, path_to_phenotype_annotations
+from patientMatcher.resources import (
+    path_to_grch37_chain,
+    path_to_grch38_chain,
+    path_to_hgnc_genes,
+    path_to_hpo_terms,
+    path_to_phenotype_annotations,
+)
 
 # useful HTTP response status codes with messages
 STATUS_CODES = {
@@ -21,3 +27,48 @@ PHENOTYPE_TERMS = {
         "resource_path": path_to_phenotype_annotations,
     },
 }
+
+# gene identifiers used to convert genes of genomic features to Ensembl IDs and symbols
+# without calling the Ensembl REST API. Updated using the CLI
+GENE_TERMS = {
+    "hgnc_genes": {
+        "url": "https://storage.googleapis.com/public-download-files/hgnc/tsv/tsv/hgnc_complete_set.txt",
+        "resource_path": path_to_hgnc_genes,
+    },
+}
+
+# UCSC chain files used to lift variants between genome builds without calling the Ensembl REST API.
+# Updated using the CLI
+LIFTOVER_CHAINS = {
+    "grch37_to_grch38": {
+        "url": "https://hgdownload.soe.ucsc.edu/goldenPath/hg19/liftOver/hg19ToHg38.over.chain.gz",
+        "resource_path": path_to_grch37_chain,
+        "assembly": "GRCh37",
+    },
+    "grch38_to_grch37": {
+        "url": "https://hgdownload.soe.ucsc.edu/goldenPath/hg38/liftOver/hg38ToHg19.over.chain.gz",
+        "resource_path": path_to_grch38_chain,
+        "assembly": "GRCh38",
+    },
+}
+
+# Non-standard patient field, not returned by the APIs, containing the phenotype fingerprint of
+# the patient, created when the patient is saved:
+# - version: checksum of the phenotype resource files used to create the fingerprint
+# - terms: indexes of the HPO terms of the patient
+# - ancestors: indexes of the HPO terms of the patient and of all their ancestors
+# - ic: summed information content of the ancestors
+# A multikey index on the ancestors works as an inverted index
+# (HPO term -> patients annotated with the term or with any of its descendants)
+PHENOTYPE_INDEX = "_phenotypeIndex"
+PHENOTYPE_ANCESTORS = f"{PHENOTYPE_INDEX}.ancestors"
+PHENOTYPE_VERSION = f"{PHENOTYPE_INDEX}.version"
+
+# Non-standard patient field, not returned by the APIs, containing the canonical keys of the
+# patient's variants in both genome builds (see patientMatcher.parse.patient.variant_key),
+# created when the patient is saved. Example:
+# [{"feature": 0, "key": "37:12:14794076:C:T"}, {"feature": 0, "key": "38:12:14641142:C:T"}]
+# where feature is the index of the genomic feature containing the variant.
+# A multikey index on the keys allows finding the patients carrying a variant with one lookup
+VARIANT_INDEX = "_variantIndex"
+VARIANT_KEYS = f"{VARIANT_INDEX}.key"
@@ -35,6 +35,79 @@ MAX_RESULTS = int(os.getenv("MAX_RESULTS")) if os.getenv("MAX_RESULTS") else 5
 # Set this parameter to 0 to return all results with a score higher than 0
 SCORE_THRESHOLD = float(os.getenv("SCORE_THRESHOLD")) if os.getenv("SCORE_THRESHOLD") else 0
 
+# Algorithm used to compute the phenotype similarity between patients. Available algorithms:
+# simgic (default), resnik (Resnik best-match average), lin (Lin best-match average), jaccard
+PHENOTYPE_SIMILARITY = os.getenv("PHENOTYPE_SIMILARITY") or "simgic"
+
+# Resource files (phenotype terms, gene identifiers) are downloaded when a production server starts
+# only if they are missing or older than RESOURCES_MAX_AGE seconds (default 7 days).
+# Liftover chains are downloaded only with the command 'pmatcher update resources'
+RESOURCES_MAX_AGE = (
+    int(os.getenv("RESOURCES_MAX_AGE")) if os.getenv("RESOURCES_MAX_AGE") else 604800
+)
+
+# Directory where the HPO ontology and its information content are saved once compiled from the
+# phenotype resource files, to speed up the following server startups.
+# Default: patientMatcher/ontology in the user cache directory ($XDG_CACHE_HOME or ~/.cache)
+ONTOLOGY_CACHE_DIR = os.getenv("ONTOLOGY_CACHE_DIR") or None
+
+# Set ONTOLOGY_MMAP to True to memory-map the compiled ontology instead of loading it into the memory
+# of each server process. All server workers on the same host will share the same copy of the ontology
+ONTOLOGY_MMAP = os.getenv("ONTOLOGY_MMAP", "False") == "True"
+
+# Set ENSEMBL_CACHE_TTL to a number of seconds (for instance 2592000, 30 days) to save the responses of
+# the Ensembl REST API (gene conversion and liftover) in the database and reuse them for that time.
+# The cache is shared by all server workers. ENSEMBL_CACHE_SIZE is the max number of saved responses,
+# when exceeded the least recently used responses are removed
+ENSEMBL_CACHE_TTL = int(os.getenv("ENSEMBL_CACHE_TTL")) if os.getenv("ENSEMBL_CACHE_TTL") else None
+ENSEMBL_CACHE_SIZE = (
+    int(os.getenv("ENSEMBL_CACHE_SIZE")) if os.getenv("ENSEMBL_CACHE_SIZE") else 100000
+)
+
+# Set GENOTYPE_INDEX to True to keep the genes and variants of all patients in an in-memory index of each
+# server worker, used to compute genotype scores without querying the database. Only the documents
+# of the returned matches are then read from the database
+GENOTYPE_INDEX = os.getenv("GENOTYPE_INDEX", "False") == "True"
+
+# Set PATIENT_REPLICA to True to keep in the memory of each server worker a copy of the patient fields
+# used for matching. Queries are then scored without reading patients from the database, and only the
+# documents of the returned matches are read. The copy is loaded by the first request handled by a
+# server worker and kept up to date with MongoDB change streams
+# (replica sets) or, with standalone MongoDB servers, by checking for changes every
+# PATIENT_REPLICA_POLL_INTERVAL seconds
+PATIENT_REPLICA = os.getenv("PATIENT_REPLICA", "False") == "True"
+PATIENT_REPLICA_POLL_INTERVAL = (
+    int(os.getenv("PATIENT_REPLICA_POLL_INTERVAL"))
+    if os.getenv("PATIENT_REPLICA_POLL_INTERVAL")
+    else 10
+)
+
+# Max seconds waited for the response of each connected node (EXTERNAL_NODE_TIMEOUT) and for the
+# responses of all nodes (EXTERNAL_MATCH_TIMEOUT) when matching patients against external nodes.
+# Requests are sent to all nodes at the same time, nodes not responding in time are reported as errors
+EXTERNAL_NODE_TIMEOUT = (
+    float(os.getenv("EXTERNAL_NODE_TIMEOUT")) if os.getenv("EXTERNAL_NODE_TIMEOUT") else 30
+)
+EXTERNAL_MATCH_TIMEOUT = (
+    float(os.getenv("EXTERNAL_MATCH_TIMEOUT")) if os.getenv("EXTERNAL_MATCH_TIMEOUT") else 60
+)
+
+# Set EXTERNAL_RESULTS_TTL to a number of seconds (for instance 604800, 7 days) to reuse the results
+# returned by a connected node for a patient, instead of querying the node again, when the phenotype and
+# the genomic features of the patient didn't change. Use the "force" request argument to query the node anyway
+EXTERNAL_RESULTS_TTL = (
+    int(os.getenv("EXTERNAL_RESULTS_TTL")) if os.getenv("EXTERNAL_RESULTS_TTL") else None
+)
+
+# Set MATCHING_QUEUE to True to run the external matchings triggered by the /patient/add endpoint in
+# the background. The endpoint then responds right away with the ID of a job, whose status is returned
+# by the /jobs/<job_id> endpoint. Jobs are saved in the database and run by MATCHING_QUEUE_WORKERS
+# threads of each server worker
+MATCHING_QUEUE = os.getenv("MATCHING_QUEUE", "False") == "True"
+MATCHING_QUEUE_WORKERS = (
+    int(os.getenv("MATCHING_QUEUE_WORKERS")) if os.getenv("MATCHING_QUEUE_WORKERS") else 2
+)
+
 # Disclaimer. This text is returned along with match results or server metrics
 DISCLAIMER = (
     os.getenv("DISCLAIMER")
@@ -2,25 +2,30 @@
 # -*- coding: utf-8 -*-
 import logging
 
-from patientMatcher.parse.patient import (
-    gtfeatures_to_genes_symbols,
-    gtfeatures_to_variants,
-    lift_variant,
-)
+from patientMatcher.constants import VARIANT_INDEX, VARIANT_KEYS
+from patientMatcher.parse.patient import gtfeatures_to_genes_symbols, variant_key
+from patientMatcher.utils.genotype_index import genotype_index
+from patientMatcher.utils.patient_replica import PROJECTION, compact_patient, patient_replica
+from patientMatcher.utils.variant_index import features_variant_keys
 
 LOG = logging.getLogger(__name__)
 
 
-def match(database, gt_features, max_score):
+def match(database, gt_features, max_score, query=None, patients=None):
     """Handles genotype matching algorithm
 
     Args:
         database(pymongo.database.Database)
         gt_features(list): a list of genomic features (objects)
         max_score(float): a number between 0 and 1
+        query(dict): the genotype query of gt_features, as returned by genotype_query
+        patients(list): compact patients (see patientMatcher.utils.patient_replica.compact_patient)
+            already retrieved for this query. If None they are retrieved from the genotype index,
+            the patient replica or the database
 
     Returns:
-        matches(dict): a dictionary of patient matches with GT score
+        matches(dict): a dictionary of patient matches with GT score. patient_obj is None, the
+            documents of the returned matches have to be read from the database
     """
     matches = {}
     n_gtfeatures = len(gt_features)
@@ -37,99 +42,173 @@ def match(database, gt_features, max_score):
             )
         )
 
-        query = {}
-        query_fields = []
-
-        genes, symbols = gtfeatures_to_genes_symbols(gt_features)
-        if genes:
-            query_fields.append({"genomicFeatures.gene.id": {"$in": genes}})
-        if symbols:
-            query_fields.append({"genomicFeatures.gene._geneName": {"$in": symbols}})
-
-        # Obtain variants and the corresponding variants in the other genome build from the genotype features
-        variants = gtfeatures_to_variants(gt_features)
-        if variants:
-            query_fields.append({"genomicFeatures.variant": {"$in": variants}})
-
-        if len(query_fields) > 0:
-            # prepare a query that takes into account genes and variants in general (also outside genes!)
-            query = {"$or": query_fields}
-            LOG.info("Querying database for genomic features:{}".format(query))
-
-            # query patients collection
-            matching_patients = list(
-                database["patients"].find(query)
-            )  # a list of patients with genomic feature/s in one or more of the query genes
-            LOG.info("Found {0} matching patients".format(len(matching_patients)))
-
-            # assign a genetic similarity score to each of these patients
-            for patient in matching_patients:
-                gt_similarity = evaluate_gt_similarity(
-                    gt_features, patient["genomicFeatures"], max_feature_similarity
-                )
-                LOG.info("GT similarity score is {}".format(gt_similarity))
-                match = {
-                    "patient_obj": patient,
-                    "geno_score": gt_similarity,
-                }
-                matches[patient["_id"]] = match
-
-    LOG.info(
-        "\n\nFOUND {} patients matching patients's genomic tracts\n\n".format(
-            len(matching_patients)
-        )
-    )
+        query = query or genotype_query(gt_features)
+
+        if patients is None and (patient_replica.started or genotype_index.enabled):
+            index = (
+                patient_replica.genotype
+                if patient_replica.started
+                else genotype_index.current(database)
+            )
+            scores = index.scores(
+                query["plan"], query["genes"], query["symbols"], max_feature_similarity
+            )
+            LOG.info("Found {0} matching patients in the genotype index".format(len(scores)))
+            return {
+                patient_id: {"patient_obj": None, "geno_score": gt_similarity}
+                for patient_id, gt_similarity in scores.items()
+            }
+
+        if patients is None:
+            patients = []
+            if query["fields"]:
+                # prepare a query that takes into account genes and variants in general (also outside genes!)
+                db_query = {"$or": query["fields"]}
+                LOG.info("Querying database for genomic features:{}".format(db_query))
+                # only the fields used for matching are retrieved
+                patients = [
+                    compact_patient(patient)
+                    for patient in database["patients"].find(db_query, PROJECTION)
+                ]
+
+        # a list of patients with genomic feature/s in one or more of the query genes
+        matching_patients = [patient for patient in patients if genotype_candidate(patient, query)]
+        LOG.info("Found {0} matching patients".format(len(matching_patients)))
+
+        # assign a genetic similarity score to each of these patients
+        for patient in matching_patients:
+            gt_similarity = evaluate_gt_similarity(
+                query["plan"],
+                patient["genomicFeatures"],
+                max_feature_similarity,
+                patient.get(VARIANT_INDEX),
+            )
+            LOG.info("GT similarity score is {}".format(gt_similarity))
+            match = {
+                "patient_obj": None,
+                "geno_score": gt_similarity,
+            }
+            matches[patient["_id"]] = match
+
+    LOG.info("\n\nFOUND {} patients matching patients's genomic tracts\n\n".format(len(matches)))
     return matches
 
 
-def evaluate_gt_similarity(query_features, db_patient_features, max_feature_similarity):
+def genotype_query(gt_features):
+    """Prepare the database queries finding the patients which can match a query patient by genotype
+
+    Args:
+        gt_features(list): a list of genomic features (objects)
+
+    Returns:
+        query(dict): example {"genes": ["ENSG00000167468"], "symbols": ["GPX4"],
+            "variant_keys": ["37:19:1105813:G:T"], "plan": [..], "fields": [..]}, where plan is the
+            result of genotype_query_plan and fields are the database queries to be combined with $or
+    """
+    genes, symbols = gtfeatures_to_genes_symbols(gt_features)
+    query_plan = genotype_query_plan(gt_features)
+    # Saved patients contain the keys of their variants in both genome builds,
+    # so query variants are found without lifting them to the other genome build
+    variant_keys = [feature["variant_key"] for feature in query_plan if feature["variant_key"]]
+
+    query_fields = []
+    if genes:
+        query_fields.append({"genomicFeatures.gene.id": {"$in": genes}})
+    if symbols:
+        query_fields.append({"genomicFeatures.gene._geneName": {"$in": symbols}})
+    if variant_keys:
+        query_fields.append({VARIANT_KEYS: {"$in": variant_keys}})
+
+    return {
+        "genes": genes,
+        "symbols": symbols,
+        "variant_keys": variant_keys,
+        "plan": query_plan,
+        "fields": query_fields,
+    }
+
+
+def genotype_candidate(patient, query):
+    """Check if a patient is found by the database queries of a genotype query
+
+    Args:
+        patient(dict): a compact patient
+        query(dict): a genotype query, as returned by genotype_query
+
+    Returns:
+        bool
+    """
+    for feature in patient.get("genomicFeatures") or []:
+        gene = feature.get("gene") or {}
+        if gene.get("id") in query["genes"] or gene.get("_geneName") in query["symbols"]:
+            return True
+    keys = {item["key"] for item in patient.get(VARIANT_INDEX) or []}
+    return bool(keys.intersection(query["variant_keys"]))
+
+
+def genotype_query_plan(gt_features):
+    """Prepare the genomic features of a query patient for matching
+
+    Args:
+        gt_features(list): a list of genomic features (objects)
+
+    Returns:
+        query_plan(list of dict): one item for each feature, example:
+            {"gene_id": "ENSG00000167468", "gene_symbol": "GPX4", "variant_key": "37:19:1105813:G:T"}
+    """
+    return [
+        {
+            "gene_id": feature["gene"]["id"],
+            "gene_symbol": feature["gene"].get("_geneName"),
+            "variant_key": variant_key(feature.get("variant")),  # variant is not mandatory
+        }
+        for feature in gt_features
+    ]
+
+
+def evaluate_gt_similarity(
+    query_plan, db_patient_features, max_feature_similarity, db_variant_index=None
+):
     """Evaluates the genomic similarity of two patients based on genomic similarities
 
     Args:
-        query_patient(list of dictionaries): genomic features of the query patient
+        query_plan(list of dictionaries): genomic features of the query patient, as returned by genotype_query_plan
         db_patient_features(list of dictionaries): genomic features of a patient in patientMatcher database
         max_feature_similarity(float): a floating point number representing the highest value allowed for a single feature
 
             ## Explanation: for a query patient with one feature max_similarity will be equal to MAX_GT_SCORE
                For a patient with 2 features max_similarity will be MAX_GT_SCORE/2 and so on.
+        db_variant_index(list of dictionaries): canonical keys of the variants of the database patient
+            in both genome builds
 
     Returns:
         patient_similarity(float): the computed genetic similarity among the patients
     """
 
     matched_features = []
-    n_feature = 0
+    features_keys = features_variant_keys(db_patient_features, db_variant_index)
 
     # loop over the query patient's features
-    for feature in query_features:
-        matched_features.append(0)  # score for matching of every feature is initially 0
-        q_gene_id = feature["gene"]["id"]  # query feature's gene id
-        q_gene_symbol = feature["gene"].get("_geneName")  # query feature's gene symbol
-
-        # Do liftover for query variant in order to maximize perfect matching chances
-        q_variant = feature.get("variant")  # query feature's variant. Not mandatory.
-        lifted_q_variant = lift_variant(q_variant) if q_variant else []
+    for feature in query_plan:
+        feature_similarity = 0  # score for matching of every feature is initially 0
 
         # loop over the database patient's features:
-        for matching_feature in db_patient_features:
-            m_gene_id = matching_feature["gene"]["id"]  # matching feature's gene id
-            m_gene_symbol = matching_feature["gene"].get(
-                "_geneName"
-            )  # matching feature's gene symbol
-            m_variant = matching_feature.get(
-                "variant"
-            )  # matching feature's variant. Not mandatory.
-
-            # if variants are matching or lifted query variant matches with matched patients variant
+        for matching_feature, matching_keys in zip(db_patient_features, features_keys):
+            # if query variant matches with the variant of the matched patient in any genome build
             # ->assign max matching score
-            if q_variant == m_variant or m_variant in lifted_q_variant:
-                matched_features[n_feature] = max_feature_similarity
-
-            elif q_gene_id == m_gene_id or (q_gene_symbol and q_gene_symbol == m_gene_symbol):
-                matched_features[n_feature] = (
+            if feature["variant_key"] in matching_keys:
+                feature_similarity = max_feature_similarity
+                break
+
+            m_gene = matching_feature["gene"]
+            if feature["gene_id"] == m_gene["id"] or (
+                feature["gene_symbol"] and feature["gene_symbol"] == m_gene.get("_geneName")
+            ):
+                feature_similarity = (
                     max_feature_similarity / 4
                 )  # (0.25 of the max_feature_similarity)
-        n_feature += 1
+
+        matched_features.append(feature_similarity)
 
     features_sum = sum(matched_features)
     return features_sum
@@ -1,17 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import datetime
+import heapq
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import requests
+from flask import current_app, has_app_context
+from patientMatcher.match.genotype_matcher import genotype_query
 from patientMatcher.match.genotype_matcher import match as genomatch
 from patientMatcher.match.phenotype_matcher import match as phenomatch
-from patientMatcher.parse.patient import json_patient
-from werkzeug.datastructures import Headers
+from patientMatcher.match.phenotype_matcher import phenotype_candidates, phenotype_query_fields
+from patientMatcher.parse.patient import disorders_to_omim, json_patient
+from patientMatcher.utils.external_results import content_fingerprint, fresh_result, save_result
+from patientMatcher.utils.genotype_index import genotype_index
+from patientMatcher.utils.node_health import node_available, record_request
+from patientMatcher.utils.node_sessions import drop_sessions, node_session
+from patientMatcher.utils.patient_replica import PROJECTION, compact_patient, patient_replica
+from pymongo.errors import PyMongoError
 
 LOG = logging.getLogger(__name__)
 
+EXTERNAL_NODE_TIMEOUT = 30  # max seconds waited for the response of a node
+EXTERNAL_MATCH_TIMEOUT = 60  # max seconds waited for the responses of all nodes
+EXTERNAL_MATCH_WORKERS = 20  # max number of match requests sent at the same time by this process
+
+# Threads sending the match requests, shared by all external matchings of this process
+_executor = ThreadPoolExecutor(
+    max_workers=EXTERNAL_MATCH_WORKERS, thread_name_prefix="external-match"
+)
+
 
 def patient_matches(database, patient_id, type=None, with_results=True):
     """Retrieve all matches for a patient specified by an ID
@@ -60,56 +81,59 @@ def internal_matcher(
         internal_match(dict): a matching object with results(list) sorted by score
     """
     json_pat = json_patient(patient_obj)
-    pheno_matches = []
-    pheno_m_keys = []
-    geno_matches = []
-    geno_m_keys = []
-    matches = []
+    pheno_matches = {}
+    geno_matches = {}
+
+    features = patient_obj.get("features", [])
+    disorders = patient_obj.get("disorders", [])
+    gt_features = patient_obj.get("genomicFeatures") or []
+
+    if gt_features and (features or disorders):
+        pheno_matches, geno_matches = _staged_matches(
+            database,
+            features,
+            disorders,
+            gt_features,
+            max_pheno_score,
+            max_geno_score,
+            max_results,
+            score_threshold,
+        )
 
     # phenotype score can be obtained if patient has an associated phenotype (HPO or OMIM terms)
-    if patient_obj.get("features") or patient_obj.get("disorders"):
+    elif features or disorders:
         LOG.info("Matching phenotypes against database patients..")
+        # patients can be pruned by phenotype score since it's the only score they get
         pheno_matches = phenomatch(
-            database,
-            max_pheno_score,
-            patient_obj.get("features", []),
-            patient_obj.get("disorders", []),
+            database, max_pheno_score, features, disorders, max_results=max_results
         )
-        pheno_m_keys = list(pheno_matches.keys())
 
     # genomic score can be obtained if patient has at least one genomic feature
-    if patient_obj.get("genomicFeatures") and len(patient_obj["genomicFeatures"]) > 0:
+    elif gt_features:
         LOG.info("Matching variants/genes against database patients..")
-        geno_matches = genomatch(database, patient_obj["genomicFeatures"], max_geno_score)
-        geno_m_keys = list(geno_matches.keys())
+        geno_matches = genomatch(database, gt_features, max_geno_score)
 
-    # obtain unique list of all patient IDs returned by the 2 algorithms:
-    unique_patients = list(set(pheno_m_keys + geno_m_keys))
+    # keep only the best matches with the combined score from the 2 algorithms
+    sorted_matches = top_matches(pheno_matches, geno_matches, max_results, score_threshold)
 
-    # create matching result objects with combined score from the 2 algorithms
-    for key in unique_patients:
-        pheno_score = 0
-        geno_score = 0
-        patient_obj = None
-
-        if key in pheno_m_keys:
-            pheno_score = pheno_matches[key]["pheno_score"]
-            patient_obj = pheno_matches[key]["patient_obj"]
-
-        if key in geno_m_keys:
-            geno_score = geno_matches[key]["geno_score"]
-            patient_obj = geno_matches[key]["patient_obj"]
-
-        p_score = pheno_score + geno_score
-
-        score = {"patient": p_score, "_genotype": geno_score, "_phenotype": pheno_score}
-        match = {"patient": json_patient(patient_obj), "score": score}
-        # remove matches with patient score lower than SCORE_THRESHOLD (from confif settings)
-        if score["patient"] >= score_threshold:
-            matches.append(match)
-
-    # sort patient matches by patient (combined) score
-    sorted_matches = sorted(matches, key=lambda k: k["score"]["patient"], reverse=True)
+    # read from the database only the documents of the returned matches which are missing
+    missing_ids = [match["_id"] for match in sorted_matches if match["patient"] is None]
+    if missing_ids:
+        patients = {
+            patient["_id"]: patient
+            for patient in database["patients"].find({"_id": {"$in": missing_ids}})
+        }
+        # patients removed in the meantime are not returned
+        sorted_matches = [
+            match
+            for match in sorted_matches
+            if match["patient"] is not None or match["_id"] in patients
+        ]
+        for match in sorted_matches:
+            match["patient"] = match["patient"] or patients[match["_id"]]
+    for match in sorted_matches:
+        match.pop("_id")
+        match["patient"] = json_patient(match["patient"])
 
     # this is saved to server, regardless of the results returned by the nodes
     has_matches = bool(sorted_matches)
@@ -121,7 +145,7 @@ def internal_matcher(
         "results": [
             {
                 "node": {"id": "patientMatcher", "label": "patientMatcher server"},
-                "patients": sorted_matches[:max_results],
+                "patients": sorted_matches,
             }
         ],
         "match_type": "internal",
@@ -131,13 +155,192 @@ def internal_matcher(
     return internal_match
 
 
-def external_matcher(database, patient, node=None):
-    """Handles a query patient matching against all connected MME nodes
+def _merge_scores(pheno_matches, geno_matches, score_threshold):
+    """Combine the phenotype and genotype matches of the same patients, skipping the patients
+    with a combined score lower than score_threshold"""
+    for key, pheno_match in pheno_matches.items():
+        geno_match = geno_matches.get(key)
+        geno_score = geno_match["geno_score"] if geno_match else 0
+        p_score = pheno_match["pheno_score"] + geno_score
+        if p_score < score_threshold:
+            continue
+        # patient_obj is None for matches whose document wasn't read from the database
+        patient_obj = (geno_match and geno_match["patient_obj"]) or pheno_match["patient_obj"]
+        score = {
+            "patient": p_score,
+            "_genotype": geno_score,
+            "_phenotype": pheno_match["pheno_score"],
+        }
+        yield {"patient": patient_obj, "score": score, "_id": key}
+
+    for key, geno_match in geno_matches.items():
+        if key in pheno_matches or geno_match["geno_score"] < score_threshold:
+            continue
+        score = {
+            "patient": geno_match["geno_score"],
+            "_genotype": geno_match["geno_score"],
+            "_phenotype": 0,
+        }
+        yield {"patient": geno_match["patient_obj"], "score": score, "_id": key}
+
+
+def top_matches(pheno_matches, geno_matches, max_results, score_threshold=0):
+    """Return the patients with the highest combined phenotype and genotype score
+
+    Args:
+        pheno_matches(dict): phenotype matches, as returned by patientMatcher.match.phenotype_matcher.match
+        geno_matches(dict): genotype matches, as returned by patientMatcher.match.genotype_matcher.match
+        max_results(int): the maximum number of returned matches, or None to return all matches
+        score_threshold(float): minimum combined score of the returned matches
+
+    Returns:
+        matches(list of dict): example [{"patient": patient_obj, "score": {"patient": 0.75, "_genotype": 0.5,
+            "_phenotype": 0.25}, "_id": "P0001058"}], sorted by decreasing combined score
+    """
+    matches = _merge_scores(pheno_matches, geno_matches, score_threshold)
+    if max_results is None:
+        return sorted(matches, key=lambda k: k["score"]["patient"], reverse=True)
+    # only the best max_results matches are kept in a heap, instead of sorting all matches
+    return heapq.nlargest(max_results, matches, key=lambda k: k["score"]["patient"])
+
+
+def _retrieve_candidates(database, query_fields):
+    """Retrieve the fields used for matching of the patients which can match a query patient
+
+    Args:
+        database(pymongo.database.Database)
+        query_fields(list of dict): queries to be combined with $or
+
+    Returns:
+        patients(list of dict): compact patients
+    """
+    if not query_fields:
+        return []
+    query = {"$or": query_fields}
+    patients = [
+        compact_patient(patient) for patient in database["patients"].find(query, PROJECTION)
+    ]
+    LOG.info(f"Found {len(patients)} candidate patients matching query: {query}")
+    return patients
+
+
+def _staged_matches(
+    database,
+    features,
+    disorders,
+    gt_features,
+    max_pheno_score,
+    max_geno_score,
+    max_results,
+    score_threshold,
+):
+    """Match a query patient with phenotype and genomic features in 2 stages.
+
+    The genotype score of all patients is computed first. The combined score of a patient is at
+    least its genotype score and at most its genotype score + max_pheno_score, so the more expensive
+    phenotype score is computed, from the highest to the lowest upper bound, only for the patients
+    which can still beat score_threshold and the max_results-th best combined score.
+
+    Returns:
+        pheno_matches(dict), geno_matches(dict): as returned by the phenotype and the genotype matcher
+    """
+    geno_query = genotype_query(gt_features)
+    pheno_query_fields = phenotype_query_fields(features, disorders)
+    candidates = None
+
+    # patients which can match by phenotype or genotype are retrieved with a single database query
+    if patient_replica.started:
+        pheno_patients = patient_replica.patients()
+    elif genotype_index.enabled:
+        pheno_patients = _retrieve_candidates(database, pheno_query_fields)
+    else:
+        candidates = _retrieve_candidates(database, pheno_query_fields + geno_query["fields"])
+        pheno_patients = candidates
+    pheno_patients = phenotype_candidates(
+        pheno_patients, bool(features), disorders_to_omim(disorders)
+    )
+
+    LOG.info("Matching variants/genes against database patients..")
+    geno_matches = genomatch(
+        database, gt_features, max_geno_score, query=geno_query, patients=candidates
+    )
+    geno_scores = {key: match["geno_score"] for key, match in geno_matches.items()}
+
+    # patients sorted by upper bound of their combined score
+    pheno_patients.sort(key=lambda patient: geno_scores.get(patient["_id"], 0), reverse=True)
+    # lower bound of the combined score of each patient
+    scores = dict(geno_scores)
+
+    LOG.info("Matching phenotypes against database patients..")
+    pheno_matches = {}
+    position = 0
+    batch_size = max_results or len(pheno_patients)
+    while position < len(pheno_patients):
+        threshold = score_threshold
+        if max_results and len(scores) >= max_results:
+            threshold = max(threshold, heapq.nlargest(max_results, scores.values())[-1])
+        upper_bound = geno_scores.get(pheno_patients[position]["_id"], 0) + max_pheno_score
+        if upper_bound < threshold:
+            break
+
+        batch = pheno_patients[position : position + batch_size]
+        position += batch_size
+        batch_size *= 2  # few threshold updates when many patients can be among the best matches
+        batch_matches = phenomatch(database, max_pheno_score, features, disorders, patients=batch)
+        for key, match in batch_matches.items():
+            pheno_matches[key] = match
+            scores[key] = geno_scores.get(key, 0) + match["pheno_score"]
+
+    n_scored = min(position, len(pheno_patients))
+    LOG.info(
+        f"Genotype stage: {len(geno_matches)} patients scored, phenotype score of "
+        f"{len(pheno_patients) - n_scored} out of {len(pheno_patients)} patients pruned"
+    )
+    n_below = sum(score < score_threshold for score in scores.values())
+    LOG.info(
+        f"Phenotype stage: {n_scored} patients scored, {n_below} patients pruned by score threshold"
+    )
+    return pheno_matches, geno_matches
+
+
+def external_timeouts():
+    """Return the timeouts of external matching requests, from the app config if available
+
+    Returns:
+        node_timeout(float), match_timeout(float): max seconds waited for the response of each node
+            and for the responses of all nodes
+    """
+    config = current_app.config if has_app_context() else {}
+    return (
+        config.get("EXTERNAL_NODE_TIMEOUT") or EXTERNAL_NODE_TIMEOUT,
+        config.get("EXTERNAL_MATCH_TIMEOUT") or EXTERNAL_MATCH_TIMEOUT,
+    )
+
+
+def external_results_ttl():
+    """Return for how long the results returned by a node for a patient can be reused, from the app
+    config if available
+
+    Returns:
+        ttl(int): seconds, None if results are never reused
+    """
+    config = current_app.config if has_app_context() else {}
+    return config.get("EXTERNAL_RESULTS_TTL")
+
+
+def external_matcher(database, patient, node=None, force=False):
+    """Handles a query patient matching against all connected MME nodes.
+
+    Requests are sent to all nodes concurrently. Each node must send its whole response within
+    EXTERNAL_NODE_TIMEOUT seconds and all nodes within EXTERNAL_MATCH_TIMEOUT seconds, nodes not
+    responding in time are reported in the 'errors' field. Nodes that were queried with the same patient content less than
+    EXTERNAL_RESULTS_TTL seconds ago are not queried again, their saved results are returned.
 
     Args:
         database(pymongo.database.Database)
         patient(dict) : a MME patient entity
         node(str): id of the node to search in
+        force(bool): if True query all nodes, even if their results could be reused
 
     Returns:
         external_match(dict): a matching object containing a list of results in 'results' field
@@ -150,9 +353,11 @@ def external_matcher(database, patient, node=None):
     if not connected_nodes:
         LOG.error("Could't find any connected MME nodes. Aborting external matching.")
         return None
+    if not node:
+        drop_sessions(keep_ids=[connected["_id"] for connected in connected_nodes])
 
-    # create request headers
-    headers = Headers()
+    patient_id = patient.get("_id") or patient.get("id")
+    fingerprint = content_fingerprint(patient)
     data = {"patient": json_patient(patient)}  # convert into something that follows the API specs
 
     # this is saved to server, regardless of the results returned by the nodes
@@ -165,45 +370,142 @@ def external_matcher(database, patient, node=None):
         "match_type": "external",
     }
 
-    LOG.info("Matching patient against {} node(s)..".format(len(connected_nodes)))
+    results_ttl = None if force else external_results_ttl()
+    # skip the nodes that failed the last requests, until their cooldown is over
+    available_nodes = []
     for node in connected_nodes:
-        node_url = node["matching_url"]
-        token = node["auth_token"]
-        request_content_type = node["accepted_content"]
-
-        headers = {
-            "Content-Type": request_content_type,
-            "Accept": "application/vnd.ga4gh.matchmaker.v1.0+json",
-            "X-Auth-Token": token,
-        }
-        # send request and get response from server
-        json_response = None
-        server_return = None
+        saved_result = None
+        if results_ttl:
+            saved_result = fresh_result(database, patient_id, node, fingerprint, results_ttl)
+        if saved_result:
+            external_match["results"].append(saved_result)
+            external_match["has_matches"] = True
+            continue
+        if node_available(database, node["_id"]):
+            available_nodes.append(node)
+            continue
+        LOG.warning(f"Node {node['_id']} skipped, too many failed requests")
+        external_match["errors"].append(
+            {
+                "node": {"id": node["_id"], "label": node["label"]},
+                "error": "Node skipped after repeated failed requests, it will be retried later",
+            }
+        )
+    if not available_nodes:
+        return external_match
+
+    node_timeout, match_timeout = external_timeouts()
+    LOG.info("Matching patient against {} node(s)..".format(len(available_nodes)))
+    # the outcome of each request is recorded in the node's health either by its worker or, if the
+    # node doesn't respond in time, here. Whoever acquires the claim first records it
+    claims = [threading.Lock() for _ in available_nodes]
+    futures = [
+        _executor.submit(_match_node, database, node, data, node_timeout, claim)
+        for node, claim in zip(available_nodes, claims)
+    ]
+    timeout = min(node_timeout, match_timeout)
+    wait(futures, timeout=timeout)
+
+    for node, future, claim in zip(available_nodes, futures, claims):
+        # don't send the requests still waiting for a thread, the running ones end by node_timeout
+        cancelled = future.cancel()
+        if cancelled is False and claim.acquire(blocking=False) is False:
+            # the worker is done, or it's recording its outcome right now
+            result_obj, error_obj = future.result()
+        else:
+            LOG.error(f"Node {node['_id']} didn't respond within {timeout} seconds")
+            result_obj = None
+            error_obj = {
+                "node": {"id": node["_id"], "label": node["label"]},
+                "error": f"Timeout: no response within {timeout} seconds",
+            }
+            if cancelled is False:  # the request was sent
+                _record_request(database, node, timeout, error_obj["error"])
+        if result_obj:
+            external_match["results"].append(result_obj)
+            save_result(database, patient_id, node, fingerprint, result_obj)
+        if error_obj:
+            external_match["errors"].append(error_obj)
+    external_match["has_matches"] = len(external_match["results"]) > 0
 
-        try:
-            server_return = requests.request(
-                method="POST", url=node_url, headers=headers, json=data
-            )
-            json_response = server_return.json()
+    return external_match
 
-            LOG.info("server returns the following response: {}".format(json_response))
-            result_obj = {"node": {"id": node["_id"], "label": node["label"]}, "patients": []}
 
-            for match in json_response.get("results", []):
-                result_obj["patients"].append(match)
+def _match_node(database, node, data, timeout, claim=None):
+    """Send a match request to a connected MME node and save its outcome in the node's health
 
-            external_match["results"].append(result_obj)
-            external_match["has_matches"] = len(external_match["results"]) > 0
-
-        except Exception as exp:
-            error = exp
-            error_obj = {"node": None, "error": str(error)}
-            if server_return:  # There is a response, but it's not JSON
-                LOG.error("Server returned error:{}".format(error))
-                error_obj["node"] = {"id": node["_id"], "label": node["label"]}
-            else:  # Coudn't even send request
-                LOG.error("Error while sending external match request:{}".format(error))
-                error_obj["node"] = "PatientMatcher"
-            external_match["errors"].append(error_obj)
+    Args:
+        database(pymongo.database.Database)
+        node(dict): a node object from the database
+        data(dict): the request data, with the query patient
+        timeout(float): max seconds to wait for the whole response of the node
+        claim(threading.Lock): acquired before recording the outcome. If it was already acquired,
+            the request was abandoned after a timeout, recorded by external_matcher
 
-    return external_match
+    Returns:
+        result_obj(dict), error_obj(dict): the results returned by the node, or the error
+    """
+    # send request and get response from server, reusing the open connections to the node
+    server_return = None
+    result_obj = None
+    error_obj = None
+    start = time.monotonic()
+
+    try:
+        server_return = node_session(node).request(
+            method="POST", url=node["matching_url"], json=data, timeout=timeout, stream=True
+        )
+        json_response = _read_json(server_return, start + timeout)
+
+        LOG.info("server returns the following response: {}".format(json_response))
+        result_obj = {"node": {"id": node["_id"], "label": node["label"]}, "patients": []}
+
+        for match in json_response.get("results", []):
+            result_obj["patients"].append(match)
+
+    except Exception as exp:
+        error = exp
+        error_obj = {"node": None, "error": str(error)}
+        if server_return or isinstance(error, requests.Timeout):
+            # There is a response but it's not JSON, or the node didn't respond in time
+            LOG.error("Server returned error:{}".format(error))
+            error_obj["node"] = {"id": node["_id"], "label": node["label"]}
+        else:  # Coudn't even send request
+            LOG.error("Error while sending external match request:{}".format(error))
+            error_obj["node"] = "PatientMatcher"
+
+    if claim is not None and claim.acquire(blocking=False) is False:
+        LOG.info(f"Response of node {node['_id']} received after the match timeout, discarded")
+        return result_obj, error_obj
+    _record_request(
+        database, node, time.monotonic() - start, error_obj["error"] if error_obj else None
+    )
+    return result_obj, error_obj
+
+
+def _record_request(database, node, latency, error):
+    """Save the outcome of a match request in the node's health, without failing the matching"""
+    try:
+        record_request(database, node["_id"], latency, error)
+    except PyMongoError as err:
+        LOG.warning(f"Could not save the health of node {node['_id']}: {err}")
+
+
+def _read_json(response, deadline):
+    """Read the JSON content of a streamed response, which must be received before a deadline.
+    The timeout of the request only limits the wait for each chunk of the response
+
+    Args:
+        response(requests.Response): a response to a request sent with stream=True
+        deadline(float): time.monotonic() value
+
+    Returns:
+        json_response(dict)
+    """
+    chunks = []
+    for chunk in response.iter_content(chunk_size=65536):
+        if time.monotonic() > deadline:
+            response.close()
+            raise requests.Timeout("Response not received within the node timeout")
+        chunks.append(chunk)
+    return json.loads(b"".join(chunks))
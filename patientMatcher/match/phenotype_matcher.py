@@ -1,19 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import heapq
 import logging
 import os
 
+from patientMatcher.constants import PHENOTYPE_ANCESTORS, PHENOTYPE_INDEX, PHENOTYPE_VERSION
 from patientMatcher.parse.patient import disorders_to_omim, features_to_hpo
 from patientMatcher.resources import path_to_hpo_terms, path_to_phenotype_annotations
-from patientMatcher.server.extensions import hpo as hpo_extension
-from patientMatcher.server.extensions import hpoic
+from patientMatcher.utils.hpo import hpo as hpo_extension
+from patientMatcher.utils.hpo import hpoic
 from patientMatcher.utils.patient import Patient, pheno_similarity_score_simgic
+from patientMatcher.utils.patient_replica import PROJECTION, compact_patient, patient_replica
+from patientMatcher.utils.similarity import similarity as similarity_extension
 
 LOG = logging.getLogger(__name__)
 
 
-def match(database, max_score, features, disorders):
+def match(database, max_score, features, disorders, max_results=None, patients=None):
     """Handles phenotype matching algorithm
 
     Args:
@@ -21,52 +25,236 @@ def match(database, max_score, features, disorders):
         max_score(float): a number between 0 and 1
         features(list): a list of phenotype feature objects (example ID = HP:0008619)
         disorders(list): a list of OMIM diagnoses (example ID = MIM:616007 )
+        max_results(int): if provided, patients with an up-to-date phenotype fingerprint which
+            can't be among the max_results patients with the highest score are not returned
+        patients(list): compact patients (see patientMatcher.utils.patient_replica.compact_patient)
+            already retrieved for this query. If None they are retrieved from the patient replica
+            or from the database
 
     Returns:
-        matches(dict): a dictionary of patient matches with phenotype matching score
+        matches(dict): a dictionary of patient matches with phenotype matching score. patient_obj is
+            None unless the patient is one of the best max_results matches found in the phenotype index
     """
     matches = {}
 
     hpo_terms = []
     omim_terms = []
-    query_fields = []
+    query_profile = None
+    engine = similarity_extension.engine
+    # patients can be pruned using the phenotype index only if the engine provides an upper bound
+    max_results = max_results if engine.supports_pruning else None
 
     if features:  # at least one HPO term is specified
         hpo_terms = features_to_hpo(features)
-        # compare against all cases which also have features (HPO terms)
-        query_fields.append({"features": {"$exists": True, "$ne": []}})
+        # resolve HPO terms and their ancestors only once for all database patients
+        query_profile = engine.profile(hpo_terms)
 
     if disorders:  # at least one OMIM term was provided
         omim_terms = disorders_to_omim(disorders)
-        query_fields.append({"disorders.id": {"$in": omim_terms}})
+
+    if patients is None and patient_replica.started:
+        patients = patient_replica.patients()
+
+    if patients is not None:
+        patients = phenotype_candidates(patients, bool(features), omim_terms)
+        _score_patients(matches, patients, hpo_terms, query_profile, omim_terms, max_score)
+        return matches
 
     # build a database query taking into account patient features (HPO terms) and disorders (omim)
+    query_fields = phenotype_query_fields(features, disorders)
+    if features and max_results:
+        # patients with an up-to-date phenotype fingerprint are retrieved using the index
+        query_fields[0][PHENOTYPE_VERSION] = {"$ne": engine.version}
+
     if len(query_fields) > 0:
         query = {"$or": query_fields}
-        pheno_matching_patients = list(database["patients"].find(query))
+        # only the fields used for matching are retrieved
+        pheno_matching_patients = [
+            compact_patient(patient) for patient in database["patients"].find(query, PROJECTION)
+        ]
         LOG.info(
             "\n\nFOUND {} patients matching query: {}\n\n".format(
                 len(pheno_matching_patients), query
             )
         )
+        _score_patients(
+            matches, pheno_matching_patients, hpo_terms, query_profile, omim_terms, max_score
+        )
 
-        for i in range(len(pheno_matching_patients)):
-            patient = pheno_matching_patients[i]
-            similarity = evaluate_pheno_similariy(
-                hpoic, hpo_extension, hpo_terms, omim_terms, patient, max_score
-            )
+    if hpo_terms and max_results:
+        _top_indexed_matches(
+            database, matches, hpo_terms, query_profile, omim_terms, max_score, max_results
+        )
+
+    return matches
+
+
+def phenotype_query_fields(features, disorders):
+    """Return the database queries finding the patients which can match a query patient by phenotype
+
+    Args:
+        features(list): a list of phenotype feature objects (example ID = HP:0008619)
+        disorders(list): a list of OMIM diagnoses (example ID = MIM:616007 )
 
-            match = {
+    Returns:
+        query_fields(list of dict): queries to be combined with $or
+    """
+    query_fields = []
+    if features:
+        # compare against all cases which also have features (HPO terms)
+        query_fields.append({"features": {"$exists": True, "$ne": []}})
+    if disorders:
+        query_fields.append({"disorders.id": {"$in": disorders_to_omim(disorders)}})
+    return query_fields
+
+
+def phenotype_candidates(patients, with_features, omim_terms):
+    """Return the patients found by the queries of phenotype_query_fields
+
+    Args:
+        patients(list of dict): compact patients
+        with_features(bool): if True return all patients with phenotype features
+        omim_terms(list): example ["OMIM:616007"]
+
+    Returns:
+        patients(list of dict): compact patients
+    """
+    omim_terms = set(omim_terms)
+    return [
+        patient
+        for patient in patients
+        if (with_features and patient["features"])
+        or any(disorder["id"] in omim_terms for disorder in patient["disorders"])
+    ]
+
+
+def _score_patients(matches, patients, hpo_terms, query_profile, omim_terms, max_score):
+    """Compute the phenotype score of a list of database patients and add them to matches"""
+    engine = similarity_extension.engine
+    # compute HPO similarity scores against all patients in one pass
+    hpo_scores = [None] * len(patients)
+    if hpo_terms:
+        hpo_scores = engine.score(
+            query_profile,
+            [
+                # use the saved fingerprint if it was created from the current ontology
+                engine.stored_profile(patient.get(PHENOTYPE_INDEX))
+                or features_to_hpo(patient.get("features"))
+                for patient in patients
+            ],
+        )
+
+    for i in range(len(patients)):
+        patient = patients[i]
+        similarity = evaluate_pheno_similariy(
+            hpoic,
+            hpo_extension,
+            hpo_terms,
+            omim_terms,
+            patient,
+            max_score,
+            hpo_similarity=hpo_scores[i],
+        )
+
+        match = {
+            # the document of compact patients is read from the database only for returned matches
+            "patient_obj": None,
+            "pheno_score": similarity,
+        }
+        matches[patient["_id"]] = match
+
+
+def _top_indexed_matches(
+    database, matches, hpo_terms, query_profile, omim_terms, max_score, max_results
+):
+    """Add to matches the patients with an up-to-date phenotype fingerprint which are among the
+    max_results best matches.
+
+    Query terms are searched in the phenotype index from the most to the least informative
+    (MaxScore). With engines supporting pruning (simGIC, Jaccard) a patient sharing with the query
+    only terms that weren't searched yet can't have a score higher than the IC of these terms
+    divided by the IC of the query, so the search
+    stops when this upper bound can't beat the lowest score among the best max_results matches.
+    Patients found in the index are scored using their phenotype fingerprint, and the complete
+    patient objects are retrieved just for the best matches. As with a full scan of the patients,
+    if fewer than max_results matches are found the results are filled with patients sharing no
+    informative term with the query.
+    """
+    engine = similarity_extension.engine
+    query_terms = engine.informative_ancestors(query_profile)
+    remaining_ic = sum(ic for _, ic in query_terms)
+    query_ic = query_profile["ic"]
+
+    # scores of the best matches found so far (min-heap)
+    top_scores = heapq.nlargest(max_results, [match["pheno_score"] for match in matches.values()])
+    heapq.heapify(top_scores)
+    candidates = {}  # patient ID -> phenotype score
+
+    position = 0
+    batch_size = 1
+    while query_ic > 0 and position < len(query_terms):
+        threshold = top_scores[0] if len(top_scores) == max_results else 0
+        if max_score * remaining_ic / query_ic < threshold:
+            break
+
+        batch = query_terms[position : position + batch_size]
+        position += batch_size
+        batch_size *= 2  # few database queries for the less informative (and more common) terms
+        remaining_ic -= sum(ic for _, ic in batch)
+
+        query = {
+            PHENOTYPE_ANCESTORS: {"$in": [index for index, _ in batch]},
+            PHENOTYPE_VERSION: engine.version,
+        }
+        projection = {"features": 1, "disorders": 1, PHENOTYPE_INDEX: 1}
+        patients = [
+            patient
+            for patient in database["patients"].find(query, projection)
+            if patient["_id"] not in matches and patient["_id"] not in candidates
+        ]
+        scored = {}
+        _score_patients(scored, patients, hpo_terms, query_profile, omim_terms, max_score)
+        for key, match in scored.items():
+            candidates[key] = match["pheno_score"]
+            if len(top_scores) < max_results:
+                heapq.heappush(top_scores, match["pheno_score"])
+            elif match["pheno_score"] > top_scores[0]:
+                heapq.heapreplace(top_scores, match["pheno_score"])
+
+    threshold = top_scores[0] if len(top_scores) == max_results else 0
+    top_ids = [key for key, score in candidates.items() if score >= threshold]
+    for patient in database["patients"].find({"_id": {"$in": top_ids}}):
+        matches[patient["_id"]] = {
+            "patient_obj": patient,
+            "pheno_score": candidates[patient["_id"]],
+        }
+
+    # The search was exhaustive, patients not found have the lowest possible phenotype score
+    n_missing = max_results - len(matches)
+    if n_missing > 0:
+        query = {
+            PHENOTYPE_VERSION: engine.version,
+            "features": {"$exists": True, "$ne": []},
+            "_id": {"$nin": list(matches) + list(candidates)},
+        }
+        patients = list(database["patients"].find(query).limit(n_missing))
+        scored = {}
+        _score_patients(scored, patients, hpo_terms, query_profile, omim_terms, max_score)
+        for patient in patients:
+            matches[patient["_id"]] = {
                 "patient_obj": patient,
-                "pheno_score": similarity,
+                "pheno_score": scored[patient["_id"]]["pheno_score"],
             }
-            matches[patient["_id"]] = match
 
-    return matches
+    n_searched = min(position, len(query_terms))
+    LOG.info(
+        f"Phenotype index: {len(candidates)} patients scored after searching {n_searched} out of "
+        f"{len(query_terms)} query terms"
+    )
 
 
 def evaluate_pheno_similariy(
-    hpoic, hpo, hpo_terms, disorders, pheno_matching_patient, max_similarity
+    hpoic, hpo, hpo_terms, disorders, pheno_matching_patient, max_similarity, hpo_similarity=None
 ):
     """Evaluates the similarity of two patients based on phenotype features
 
@@ -77,6 +265,8 @@ def evaluate_pheno_similariy(
         disorders(list): OMIM disorders of the query patient
         pheno_matching_patient(patient_obj): a patient object from the database
         max_similarity(float): a floating point number representing the highest value allowed for a feature
+        hpo_similarity(float): similarity of the HPO terms (0 to 1) computed by the phenotype
+            similarity engine. If not provided the simGIC similarity is computed
 
     Returns:
         patient_similarity(float): the computed phenotype similarity among the patients
@@ -103,7 +293,10 @@ def evaluate_pheno_similariy(
         else:  # OMIM diagnoses are missing --> HPO score represents max similarity
             max_hpo_score = max_similarity
 
-        hpo_score = similarity_wrapper(hpoic, hpo, max_hpo_score, hpo_terms, matching_hpo_terms)
+        if hpo_similarity is None:
+            hpo_score = similarity_wrapper(hpoic, hpo, max_hpo_score, hpo_terms, matching_hpo_terms)
+        else:
+            hpo_score = float(hpo_similarity) * max_hpo_score
 
     else:  # HPO terms missing
         # similarity is computed using OMIM terms,
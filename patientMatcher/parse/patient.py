@@ -2,12 +2,23 @@
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from pkgutil import get_data
 from urllib.parse import urlparse
 
+from flask import g, has_app_context
 from jsonschema import FormatChecker, RefResolver, validate
-from patientMatcher.utils.gene import ensembl_to_symbol, entrez_to_symbol, symbol_to_ensembl
+from patientMatcher.constants import PHENOTYPE_INDEX, VARIANT_INDEX
+from patientMatcher.utils.ensembl_rest_client import MAX_WORKERS
+from patientMatcher.utils.gene import (
+    ensembl_to_symbol,
+    ensembl_to_symbols,
+    entrez_to_symbol,
+    symbol_to_ensembl,
+)
+from patientMatcher.utils.gene import genes as genes_extension
+from patientMatcher.utils.variant import chains as chains_extension
 from patientMatcher.utils.variant import liftover
 
 LOG = logging.getLogger(__name__)
@@ -85,6 +96,8 @@ def json_patient(mme_patient):
         json_patient["id"] = json_patient["_id"]
     if "_id" in json_patient:
         json_patient.pop("_id")
+    json_patient.pop(PHENOTYPE_INDEX, None)
+    json_patient.pop(VARIANT_INDEX, None)
 
     return json_patient
 
@@ -129,10 +142,17 @@ def format_genes(patient_obj):
         patient_obj(dict): A patient object with genotype features
     """
     formatted_features = []
+    converted = _convert_genes(
+        [
+            feature["gene"].get("id")
+            for feature in patient_obj.get("genomicFeatures", [])
+            if "gene" in feature
+        ]
+    )
     for feature in patient_obj.get("genomicFeatures", []):
         if "gene" in feature and feature["gene"].get("id"):
             gene = feature["gene"]["id"]
-            gene_id, symbol = _convert_gene(gene)
+            gene_id, symbol = converted[gene]
             if symbol:
                 feature["gene"]["_geneName"] = symbol  # add non-standard but informative field
             feature["gene"]["id"] = gene_id
@@ -142,6 +162,72 @@ def format_genes(patient_obj):
         patient_obj["genomicFeatures"] = formatted_features
 
 
+def _map_concurrently(function, items):
+    """Apply a function sending requests to the Ensembl REST API to a list of items, using a bounded
+    number of concurrent requests
+
+    Returns:
+        results(list): the result of the function for each item
+    """
+    if len(items) < 2:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(function, items))
+
+
+def resolved_genes():
+    """Return the genes converted during the current request (or app context), so that each gene id
+    is converted at most once per request. Outside an app context nothing is saved
+
+    Returns:
+        resolved(dict): gene -> (Ensembl gene ID, HGNC gene symbol)
+    """
+    if has_app_context() is False:
+        return {}
+    if "resolved_genes" not in g:
+        g.resolved_genes = {}
+    return g.resolved_genes
+
+
+def _convert_genes(genes):
+    """Convert a list of gene ids to Ensembl gene ids and HGNC gene symbols, with as few round-trips
+    to the Ensembl REST API as possible. Genes already converted during the same request are not
+    converted again
+
+    Args:
+        genes(list): entrez ids, HGNC gene symbols or Ensembl gene IDs
+
+    Returns:
+        converted(dict): gene -> (Ensembl gene ID, HGNC gene symbol), as returned by _convert_gene
+    """
+    resolved = resolved_genes()
+    genes = list(dict.fromkeys(gene for gene in genes if gene))
+    converted = {gene: resolved[gene] for gene in genes if gene in resolved}
+    ensembl_ids = [gene for gene in genes if gene.startswith("ENSG") and gene not in converted]
+    if ensembl_ids and genes_extension.loaded is False:
+        # One batch request for all the Ensembl IDs
+        try:
+            symbols = ensembl_to_symbols(ensembl_ids)
+        except Exception as ex:
+            LOG.error(
+                f"An error occurred while converting gene format using the Ensembl Rest API: {ex}"
+            )
+            symbols = {}
+        converted.update(
+            {ensembl_id: (ensembl_id, symbols.get(ensembl_id)) for ensembl_id in ensembl_ids}
+        )
+
+    other_genes = [gene for gene in genes if gene not in converted]
+    converted.update(zip(other_genes, _map_concurrently(_convert_gene, other_genes)))
+
+    for gene, (gene_id, symbol) in converted.items():
+        resolved[gene] = (gene_id, symbol)
+        # The Ensembl ID of a converted gene resolves to the same symbol
+        if gene_id and gene_id.startswith("ENSG") and symbol:
+            resolved.setdefault(gene_id, (gene_id, symbol))
+    return converted
+
+
 def _convert_gene(gene):
     """Convert provided gene id to Ensembl gene id return it with eventual HGNC gene symbol
 
@@ -155,6 +241,14 @@ def _convert_gene(gene):
         gene(str): An Ensembl gene ID, example: "ENSG00000167468"
         symbol(str): HGNC gene symbol, example: "GPX4"
     """
+    if genes_extension.loaded and gene:  # Convert using the local HGNC table
+        if gene.startswith("ENSG"):
+            return gene, genes_extension.ensembl_to_symbol(gene)
+        symbol = genes_extension.entrez_to_symbol(gene) if gene.isdigit() else gene
+        if symbol:
+            gene = genes_extension.symbol_to_ensembl(symbol) or gene
+        return gene, symbol
+
     symbol = None
     try:
         if gene.startswith("ENSG"):  # Ensembl gene ID
@@ -185,10 +279,13 @@ def gtfeatures_to_genes_symbols(gtfeatures):
     """
     genes = []
     symbols = []
+    converted = _convert_genes(
+        [feature["gene"].get("id") for feature in gtfeatures if "gene" in feature]
+    )
     for feature in gtfeatures:
         if "gene" in feature:
             gene = feature["gene"].get("id")
-            gene, symbol = _convert_gene(gene)
+            gene, symbol = converted.get(gene, (gene, None))
             if gene:
                 genes.append(gene)
             if symbol:
@@ -200,7 +297,8 @@ def gtfeatures_to_genes_symbols(gtfeatures):
 
 
 def lift_variant(variant):
-    """Perform a variant liftover using Ensebl REST API and return eventual variant in the other genome build
+    """Perform a variant liftover using the local chain files (or the Ensembl REST API if not available)
+    and return eventual variant in the other genome build
 
     Args:
         variant(dict): example:
@@ -209,9 +307,10 @@ def lift_variant(variant):
     Returns:
         lifted_variants(list of dict): example:
             [{'assembly': 'GRCh37', 'referenceName': '12', 'start': 14794076, 'end': 14794076, 'referenceBases': 'C', 'alternateBases': 'T'}]
+            or None if the liftover failed, so that it's not mistaken for a variant without mappings
     """
     lifted_vars = []
-    mappings = liftover(
+    mappings = (chains_extension.liftover if chains_extension.loaded else liftover)(
         variant.get("assembly"),
         variant.get("referenceName"),
         variant.get("start") + 1,  # coordinates are 0-based in MatchMaker
@@ -219,7 +318,7 @@ def lift_variant(variant):
     )
 
     if mappings is None:
-        return lifted_vars
+        return None
 
     for res in mappings:
         # Create a variant which is the copy of the original variant
@@ -238,6 +337,54 @@ def lift_variant(variant):
     return lifted_vars
 
 
+def variant_key(variant):
+    """Return a canonical key identifying a variant, used to compare variants by set lookup
+
+    Args:
+        variant(dict): example:
+            {'assembly': 'GRCh37', 'referenceName': '12', 'start': 14794076, 'end': 14794076, 'referenceBases': 'C', 'alternateBases': 'T'}
+
+    Returns:
+        key(str): example: '37:12:14794076:C:T' or '37:12:14794076-14794080:C:T' for variants spanning
+            more than one position. None if variant is None
+    """
+    if variant is None:
+        return None
+    chrom = str(variant.get("referenceName") or "")
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
+    if chrom == "M":
+        chrom = "MT"
+    position = str(variant.get("start"))
+    if variant.get("end") not in [None, variant.get("start")]:
+        position = f"{position}-{variant['end']}"
+    return ":".join(
+        [
+            (variant.get("assembly") or "").replace("GRCh", ""),
+            chrom,
+            position,
+            (variant.get("referenceBases") or "").upper(),
+            (variant.get("alternateBases") or "").upper(),
+        ]
+    )
+
+
+def lift_variants(variants):
+    """Lift a list of variants to the other genome build. Requests to the Ensembl REST API
+    (if the local chain files are not available) are sent concurrently
+
+    Args:
+        variants(list): a list of variants
+
+    Returns:
+        lifted_variants(list of list): the lifted variants of each variant, as returned by lift_variant
+            (None for the variants that couldn't be lifted)
+    """
+    if chains_extension.loaded:
+        return [lift_variant(variant) for variant in variants]
+    return _map_concurrently(lift_variant, variants)
+
+
 def gtfeatures_to_variants(gtfeatures):
     """Extracts all variants from a list of genomic features
 
@@ -248,19 +395,13 @@ def gtfeatures_to_variants(gtfeatures):
         variants(list): a list of variants
     """
     variants = []
-    for feature in gtfeatures:
-        if "variant" in feature:
-            variant = feature["variant"]
-            if variant is None:
-                continue
-            # Add variant to search terms
-            variants.append(feature["variant"])
-            # Add also corresponding variant in another genome build (GRCh38 if original variant was GRCh37, and the other way around)
-            lifted_variants = lift_variant(feature["variant"])
-            if not lifted_variants:
-                continue  # Variant could not be lifted to the other build
-            for lifted in lifted_variants:
-                variants.append(lifted)
+    gt_variants = [feature["variant"] for feature in gtfeatures if feature.get("variant")]
+    for variant, lifted_variants in zip(gt_variants, lift_variants(gt_variants)):
+        # Add variant to search terms
+        variants.append(variant)
+        # Add also corresponding variant in another genome build (GRCh38 if original variant was GRCh37, and the other way around)
+        for lifted in lifted_variants or []:
+            variants.append(lifted)
 
     return variants
 
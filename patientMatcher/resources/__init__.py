@@ -3,6 +3,9 @@ from importlib.resources import files
 ###### Files ######
 hpo_filename = "resources/hp.obo.txt"
 phenotype_annotation_filename = "resources/phenotype.hpoa"
+hgnc_genes_filename = "resources/hgnc_complete_set.txt"
+grch37_chain_filename = "resources/hg19ToHg38.over.chain.gz"
+grch38_chain_filename = "resources/hg38ToHg19.over.chain.gz"
 benchmark_patients = "resources/benchmark_patients.json"
 json_api = "resources/api.json"
 
@@ -11,5 +14,8 @@ base = files("patientMatcher")
 
 path_to_hpo_terms = str(base.joinpath(hpo_filename))
 path_to_phenotype_annotations = str(base.joinpath(phenotype_annotation_filename))
+path_to_hgnc_genes = str(base.joinpath(hgnc_genes_filename))
+path_to_grch37_chain = str(base.joinpath(grch37_chain_filename))
+path_to_grch38_chain = str(base.joinpath(grch38_chain_filename))
 path_to_benchmark_patients = str(base.joinpath(benchmark_patients))
 path_to_json_api = str(base.joinpath(json_api))
@@ -14,9 +14,19 @@ from pymongo.errors import (
     ServerSelectionTimeoutError,
 )
 
+from patientMatcher.constants import GENE_TERMS, PHENOTYPE_TERMS
 from patientMatcher.resources import path_to_hpo_terms, path_to_phenotype_annotations
 from patientMatcher.utils.notify import TlsSMTPHandler, admins_email_format
-from patientMatcher.utils.update import update_resources
+from patientMatcher.utils.ontology_cache import (
+    cache_dir_writable,
+    default_cache_dir,
+    load_ontology_cache,
+    resources_checksum,
+    save_ontology_cache,
+)
+from patientMatcher.utils.phenotype_index import create_phenotype_index
+from patientMatcher.utils.update import RESOURCES_MAX_AGE, update_resources
+from patientMatcher.utils.variant_index import create_variant_index
 
 from . import extensions, views
 
@@ -32,6 +42,44 @@ def available_phenotype_resources():
     return True
 
 
+def init_ontology(app):
+    """Initialize the HPO, its information content and the phenotype similarity engines.
+    Use the ontology compiled from the same resource files at a previous startup, if available.
+
+    Returns:
+        bool: False if the phenotype resources could not be parsed
+    """
+    cache_dir = app.config.get("ONTOLOGY_CACHE_DIR") or default_cache_dir()
+    mmap = app.config.get("ONTOLOGY_MMAP") in [True, "True"]
+    checksum = resources_checksum()
+    ontology = load_ontology_cache(cache_dir, checksum, mmap)
+    if ontology is None and cache_dir_writable(cache_dir) is False:
+        LOG.warning(
+            f"Directory {cache_dir} is not writable, the compiled ontology will not be saved. "
+            "Set ONTOLOGY_CACHE_DIR to a writable directory to speed up the server startups."
+        )
+
+    if ontology is None:
+        extensions.hpo.init_app()
+        extensions.diseases.init_app()
+        extensions.hpoic.init_app(app, extensions.hpo, extensions.diseases)
+        if not extensions.hpo.hps or not extensions.hpoic.term_ic:
+            return False
+        if save_ontology_cache(cache_dir, checksum, extensions.hpo, extensions.hpoic) and mmap:
+            ontology = load_ontology_cache(cache_dir, checksum, mmap)
+
+    if ontology is not None:
+        extensions.hpo.init_app(ontology, mmap)
+        extensions.diseases.init_app()
+        extensions.hpoic.init_app(app, extensions.hpo, extensions.diseases, ontology)
+
+    extensions.simgic.init_app(extensions.hpo, extensions.hpoic, ontology, checksum)
+    extensions.similarity.init_app(
+        app.config.get("PHENOTYPE_SIMILARITY"), extensions.simgic, extensions.hpoic, ontology
+    )
+    return bool(extensions.hpo.hps) and bool(extensions.hpoic.term_ic)
+
+
 def configure_email_error_logging(app):
     """Setup logging of error/exceptions to email."""
     LOG.debug(f"Configuring email error logging to notify server admins:{app.config['ADMINS']}")
@@ -95,9 +143,20 @@ def create_app():
     db_name = app.config["DB_NAME"]
     app.db = mongo_client[db_name]
     LOG.info(f"Connecting to database '{db_name}' on {app.db}")
+    create_phenotype_index(app.db)
+    create_variant_index(app.db)
+    extensions.ensembl_cache.init_app(
+        app.db, app.config.get("ENSEMBL_CACHE_TTL"), app.config.get("ENSEMBL_CACHE_SIZE")
+    )
 
     if app.config.get("TESTING") in ["False", False]:
-        update_resources(test=False)
+        # Only missing or outdated files are downloaded, not at every start of every server worker.
+        # Liftover chains are updated only with the command 'pmatcher update resources'
+        update_resources(
+            test=False,
+            resources={**PHENOTYPE_TERMS, **GENE_TERMS},
+            max_age=app.config.get("RESOURCES_MAX_AGE") or RESOURCES_MAX_AGE,
+        )
 
     # If phenotype resources are missing display error and exit
     if available_phenotype_resources() is False:
@@ -106,14 +165,18 @@ def create_app():
         )
         return
 
-    extensions.hpo.init_app()
-    extensions.diseases.init_app()
-    extensions.hpoic.init_app(app, extensions.hpo, extensions.diseases)
+    if init_ontology(app) is False:
+        LOG.error("An error occurred while parsing resource files.")
+        return
 
-    for terms in [extensions.hpo.hps, extensions.diseases.diseases]:
-        if not terms:
-            LOG.error("An error occurred while parsing resource files.")
-            return
+    extensions.genes.init_app()
+    extensions.chains.init_app()
+    extensions.genotype_index.init_app(app.db, app.config.get("GENOTYPE_INDEX") in [True, "True"])
+    extensions.patient_replica.init_app(
+        app.db,
+        app.config.get("PATIENT_REPLICA") in [True, "True"],
+        app.config.get("PATIENT_REPLICA_POLL_INTERVAL"),
+    )
 
     if app.config.get("MAIL_SERVER"):
         app.config["MAIL_SUPPRESS_SEND"] = False
@@ -126,6 +189,14 @@ def create_app():
         if app.debug is True and app.config.get("ADMINS"):
             configure_email_error_logging(app)
 
+    extensions.matching_queue.init_app(
+        app,
+        app.config.get("MATCHING_QUEUE") in [True, "True"],
+        app.config.get("MATCHING_QUEUE_WORKERS") or 2,
+    )
+    app.before_request(extensions.matching_queue.start)
+    app.before_request(extensions.patient_replica.start)
+
     app.register_blueprint(views.blueprint)
 
     return app
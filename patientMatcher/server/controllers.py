@@ -68,10 +68,10 @@ def patient(database, patient_id):
     return query_patient
 
 
-def match_external(database, query_patient, node=None):
+def match_external(database, query_patient, node=None, force=False):
     """Trigger an external patient matching for a given patient object"""
     # trigger the matching and save the matching id to variable
-    matching_obj = external_matcher(database, query_patient, node)
+    matching_obj = external_matcher(database, query_patient, node, force=force)
     # save matching object to database only if there are results or error messages
     if matching_obj and (matching_obj.get("has_matches") or matching_obj.get("errors")):
         database["matches"].insert_one(matching_obj)
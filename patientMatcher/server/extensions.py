@@ -1,6 +1,11 @@
-from patientMatcher.utils.disease import Diseases
-from patientMatcher.utils.hpo import HPO, HPOIC
-
-hpo = HPO()
-diseases = Diseases()
-hpoic = HPOIC()
+# Extensions initialized by the app. Each one is defined next to its class, so that the modules
+# using them don't depend on the server package
+from patientMatcher.utils.disease import diseases
+from patientMatcher.utils.ensembl_cache import ensembl_cache
+from patientMatcher.utils.gene import genes
+from patientMatcher.utils.genotype_index import genotype_index
+from patientMatcher.utils.hpo import hpo, hpoic
+from patientMatcher.utils.matching_queue import matching_queue
+from patientMatcher.utils.patient_replica import patient_replica
+from patientMatcher.utils.similarity import simgic, similarity
+from patientMatcher.utils.variant import chains
@@ -8,7 +8,10 @@ from flask import Blueprint, current_app, jsonify, render_template, request, sen
 from flask_negotiate import consumes, produces
 from patientMatcher.auth.auth import authorize
 from patientMatcher.match.handler import internal_matcher, patient_matches
+from patientMatcher.server.extensions import matching_queue
 from patientMatcher.utils.add import backend_add_patient
+from patientMatcher.utils.matching_queue import job_status
+from patientMatcher.utils.node_health import nodes_health as health_of_nodes
 from patientMatcher.utils.notify import notify_match_external, notify_match_internal
 
 from . import controllers
@@ -45,10 +48,14 @@ def add():
     match_external = False
     if controllers.get_nodes(database=current_app.db):
         match_external = True
+    force = request.args.get("force", "False").lower() == "true"
 
     # else import patient to database
     modified, inserted, matching_obj = backend_add_patient(
-        mongo_db=current_app.db, patient=formatted_patient, match_external=match_external
+        mongo_db=current_app.db,
+        patient=formatted_patient,
+        match_external=match_external and matching_queue.enabled is False,
+        force=force,
     )
     message = {}
 
@@ -59,6 +66,12 @@ def add():
     else:
         message["message"] = "Database content is unchanged."
 
+    # external matching is run in the background
+    if match_external and matching_queue.enabled and (modified or inserted):
+        message["job_id"] = matching_queue.enqueue(
+            current_app.db, formatted_patient["_id"], force=force
+        )
+
     # if patient is matching any other patient on other nodes
     # and match notifications are on
     if current_app.config.get("MAIL_SERVER") and matching_obj and len(matching_obj.get("results")):
@@ -75,6 +88,24 @@ def add():
     return resp
 
 
+@blueprint.route("/jobs/<job_id>", methods=["GET"])
+def job(job_id):
+    """Get the status of a background external matching triggered by /patient/add"""
+    resp = None
+    message = {}
+    if not authorize(current_app.db, request):  # not authorized, return a 401 status code
+        return controllers.bad_request(401)
+
+    job_obj = job_status(current_app.db, job_id)
+    if job_obj:
+        message = json.loads(json_util.dumps({"job": job_obj}))
+    else:
+        message["message"] = "Could not find any job with ID {}".format(job_id)
+    resp = jsonify(message)
+    resp.status_code = 200
+    return resp
+
+
 @blueprint.route("/patient/delete/<patient_id>", methods=["DELETE"])
 def delete(patient_id):
     """Delete a patient from the database using its ID"""
@@ -131,6 +162,18 @@ def nodes():
     return resp
 
 
+@blueprint.route("/nodes/health", methods=["GET"])
+def nodes_health():
+    """Get the health of the connected nodes, computed from the recent match requests sent to them"""
+    if not authorize(current_app.db, request):
+        return controllers.bad_request(401)
+
+    results = health_of_nodes(current_app.db)
+    resp = jsonify(json.loads(json_util.dumps({"nodes": results})))
+    resp.status_code = 200
+    return resp
+
+
 @blueprint.route("/matches/<patient_id>", methods=["GET"])
 def matches(patient_id):
     """Get all matches (external and internal) for a patient ID"""
@@ -182,7 +225,8 @@ def match_external(patient_id):
         resp.status_code = 200
         return resp
 
-    matching_obj = controllers.match_external(current_app.db, query_patient, node)
+    force = request.args.get("force", "False").lower() == "true"
+    matching_obj = controllers.match_external(current_app.db, query_patient, node, force=force)
 
     if not matching_obj:
         message["message"] = "Could not find any other node connected to this MatchMaker server"
@@ -6,7 +6,12 @@ import sys
 
 import enlighten
 from patientMatcher.match.handler import external_matcher
-from patientMatcher.parse.patient import mme_patient
+from patientMatcher.constants import PHENOTYPE_INDEX, VARIANT_INDEX
+from patientMatcher.parse.patient import features_to_hpo, mme_patient
+from patientMatcher.utils.generation import patients_changed
+from patientMatcher.utils.phenotype_index import phenotype_fingerprint
+from patientMatcher.utils.similarity import simgic
+from patientMatcher.utils.variant_index import variant_index
 from pymongo import MongoClient
 
 LOG = logging.getLogger(__name__)
@@ -49,13 +54,15 @@ def load_demo_patients(path_to_json_data, mongo_db, convert_to_ensembl=False):
     return inserted_ids
 
 
-def backend_add_patient(mongo_db, patient, match_external=False):
+def backend_add_patient(mongo_db, patient, match_external=False, force=False):
     """
     Insert or update a patient in patientMatcher database
 
     Args:
         mongo_db(pymongo.database.Database)
         patient(dict) : a MME patient entity
+        match_external(bool): if True match the patient against the connected nodes once saved
+        force(bool): if True query all nodes, even if their results for the patient could be reused
 
     Returns:
         inserted_id(str) : the ID of the inserted patient or None if patient couldn't be saved
@@ -64,10 +71,22 @@ def backend_add_patient(mongo_db, patient, match_external=False):
     upserted = None
     matching_obj = None
 
+    db_patient = dict(patient)
+    if patient.get("features"):
+        # save the resolved HPO terms and their ancestors to avoid recomputing them when matching
+        fingerprint = phenotype_fingerprint(simgic, features_to_hpo(patient["features"]))
+        if fingerprint:
+            db_patient[PHENOTYPE_INDEX] = fingerprint
+    if patient.get("genomicFeatures"):
+        # save the keys of the variants in both genome builds to avoid lifting them when matching.
+        # None if the variants couldn't be lifted, see `pmatcher update variant-keys --retry-failed`
+        db_patient[VARIANT_INDEX] = variant_index(patient["genomicFeatures"])
+
     try:
-        result = mongo_db["patients"].replace_one({"_id": patient["_id"]}, patient, upsert=True)
+        result = mongo_db["patients"].replace_one({"_id": patient["_id"]}, db_patient, upsert=True)
         modified = result.modified_count
         upserted = result.upserted_id
+        patients_changed(mongo_db, saved=[db_patient])
 
     except Exception as err:
         LOG.fatal("Error while inserting a patient into database: {}".format(err))
@@ -76,7 +95,7 @@ def backend_add_patient(mongo_db, patient, match_external=False):
     # and if there is a change in patients' collections (new patient or updated patient)
     # Matching is not triggered by inserting demo data into database
     if match_external and (modified or upserted):
-        matching_obj = external_matcher(mongo_db, patient)
+        matching_obj = external_matcher(mongo_db, patient, force=force)
         # save matching object to database
         mongo_db["matches"].insert_one(matching_obj)
 
@@ -2,6 +2,8 @@
 
 import logging
 
+from patientMatcher.utils.generation import patients_changed, patients_dropped
+
 LOG = logging.getLogger(__name__)
 
 
@@ -14,6 +16,7 @@ def drop_all_collections(mongo_db):
     LOG.warning(f"Dropping all existing collections in database")
     for collection in mongo_db.list_collection_names():
         mongo_db[collection].drop()
+    patients_dropped()
 
 
 def delete_by_query(query, mongo_db, mongo_collection):
@@ -32,8 +35,15 @@ def delete_by_query(query, mongo_db, mongo_collection):
     deleted_entries = 0
 
     try:
+        patient_ids = []
+        if mongo_collection == "patients":
+            patient_ids = [
+                patient["_id"] for patient in mongo_db["patients"].find(query, {"_id": 1})
+            ]
         result = mongo_db[mongo_collection].delete_many(query)
         deleted_entries = result.deleted_count
+        if mongo_collection == "patients" and deleted_entries:
+            patients_changed(mongo_db, removed_ids=patient_ids)
     except Exception as err:
         deleted_entries = err
 
@@ -51,11 +51,21 @@ class Diseases:
     """
 
     def init_app(self):
-        """Initialize the diseases object when the app is launched"""
+        """Initialize the diseases object when the app is launched.
+        The resource file is parsed the first time diseases are accessed, which doesn't happen
+        at all if the information content of the HPO is loaded from a compiled ontology.
+        """
         self.databases = ["DECIPHER", "OMIM", "ORPHA"]
-        self.diseases = {}
-        self._parse_diseases()
-        LOG.info(f"Parsed {len(self.diseases)} disease/phenotypes from resource file")
+        self._diseases = None
+
+    @property
+    def diseases(self):
+        """Return a dictionary of diseases, parsing them from the resource file if necessary"""
+        if self._diseases is None:
+            self._diseases = {}
+            self._parse_diseases()
+            LOG.info(f"Parsed {len(self._diseases)} disease/phenotypes from resource file")
+        return self._diseases
 
     def _parse_disease_frequency(self, field):
         """Parse disease frequency (col 8 in phenotype anno file)"""
@@ -152,4 +162,7 @@ class Diseases:
 
         for (db, db_id), phenotypes in disease_phenotypes.items():
             disease = Disease(db, db_id, phenotypes)
-            self.diseases[(db, db_id)] = disease
+            self._diseases[(db, db_id)] = disease
+
+
+diseases = Diseases()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import logging
+
+LOG = logging.getLogger(__name__)
+
+CACHE_COLLECTION = "ensembl_cache"
+
+
+class EnsemblCache:
+    """Responses of the Ensembl REST API (gene xrefs, lookups and liftover mappings) saved in a
+    database collection shared by all server processes.
+
+    Each response expires after a given time, and when the cache is full the least recently used
+    responses are removed.
+    """
+
+    def __init__(self):
+        self.collection = None
+        self.ttl = None
+        self.max_entries = None
+
+    def init_app(self, database, ttl=None, max_entries=None):
+        """Enable the cache
+
+        Args:
+            database(pymongo.database.Database)
+            ttl(int): number of seconds after which a saved response expires. If None the cache is disabled
+            max_entries(int): max number of saved responses or None for no limit
+        """
+        self.collection = None
+        if not ttl:
+            return
+        collection = database[CACHE_COLLECTION]
+        try:
+            # Expired responses are removed by the database
+            collection.create_index("expires", expireAfterSeconds=0)
+            collection.create_index("accessed")
+        except Exception as err:
+            LOG.warning(f"Could not create the indexes of the Ensembl cache, cache disabled: {err}")
+            return
+        self.collection = collection
+        self.ttl = int(ttl)
+        self.max_entries = int(max_entries) if max_entries else None
+
+    @property
+    def enabled(self):
+        return self.collection is not None
+
+    def get(self, url):
+        """Return the cached response for a request URL
+
+        Args:
+            url(str): ex. https://grch37.rest.ensembl.org/lookup/id/ENSG00000103591
+
+        Returns:
+            data(dict or list) or None if the response is not cached or it expired
+        """
+        if self.collection is None:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            cached = self.collection.find_one_and_update(
+                {"_id": url, "expires": {"$gt": now}}, {"$set": {"accessed": now}}
+            )
+        except Exception as err:
+            LOG.warning(f"Could not read from the Ensembl cache: {err}")
+            return None
+        if cached:
+            return json.loads(cached["data"])
+
+    def set(self, url, data):
+        """Save the response of a request URL, removing the least recently used responses if the cache is full
+
+        Args:
+            url(str): ex. https://grch37.rest.ensembl.org/lookup/id/ENSG00000103591
+            data(dict or list): the response of the Ensembl REST API
+        """
+        if self.collection is None:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cached = {
+            "data": json.dumps(data),
+            "accessed": now,
+            "expires": now + datetime.timedelta(seconds=self.ttl),
+        }
+        try:
+            self.collection.replace_one({"_id": url}, cached, upsert=True)
+            if self.max_entries:
+                self._evict()
+        except Exception as err:
+            LOG.warning(f"Could not write to the Ensembl cache: {err}")
+
+    def _evict(self):
+        """Remove the least recently used responses exceeding the max number of cached responses"""
+        n_evict = self.collection.estimated_document_count() - self.max_entries
+        if n_evict <= 0:
+            return
+        lru = self.collection.find({}, {"_id": 1}).sort("accessed", 1).limit(n_evict)
+        self.collection.delete_many({"_id": {"$in": [item["_id"] for item in lru]}})
+
+
+ensembl_cache = EnsemblCache()
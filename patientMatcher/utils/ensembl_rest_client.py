@@ -1,14 +1,59 @@
 # -*- coding: UTF-8 -*-
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from patientMatcher.utils.ensembl_cache import ensembl_cache
+from requests.adapters import HTTPAdapter
 
 LOG = logging.getLogger(__name__)
 
-HEADERS = {"Content-type": "application/json"}
+HEADERS = {"Content-type": "application/json", "Accept": "application/json"}
 RESTAPI_37 = "https://grch37.rest.ensembl.org"
 RESTAPI_38 = "https://rest.ensembl.org/"
 PING_ENDPOINT = "info/ping"
+TIMEOUT = 30  # seconds
+MAX_WORKERS = 4  # max number of concurrent requests. Ensembl allows 15 requests per second
+MAX_RETRIES = 3
+MAX_RETRY_WAIT = 30  # seconds, max time to wait before retrying a rate-limited request
+BATCH_SIZE = 1000  # max number of IDs accepted by the Ensembl POST lookup endpoints
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limited_until = 0  # time.monotonic() value before which no request should be sent
+_rate_limit_lock = threading.Lock()
+
+
+def get_session():
+    """Return the HTTP session shared by all clients of this process, keeping a pool of open
+    connections to the Ensembl servers"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=MAX_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return _session
+
+
+def _retry_wait(response):
+    """Return the number of seconds to wait before sending another request, according to the
+    rate-limit headers of an Ensembl response (https://github.com/Ensembl/ensembl-rest/wiki/Rate-Limits)
+
+    Returns:
+        wait(float): 0 if requests can be sent right away
+    """
+    for header in ["Retry-After", "X-RateLimit-Reset"]:
+        if header == "X-RateLimit-Reset" and response.headers.get("X-RateLimit-Remaining") != "0":
+            continue
+        try:
+            return min(float(response.headers[header]), MAX_RETRY_WAIT)
+        except (KeyError, ValueError):
+            continue
+    return 1.0 if response.status_code in [429, 503] else 0
 
 
 class EnsemblRestApiClient:
@@ -48,7 +93,8 @@ class EnsemblRestApiClient:
             )
 
     def send_request(self, url):
-        """Sends the actual request to the server and returns the response
+        """Sends the actual request to the server and returns the response.
+        Valid responses are saved in the Ensembl cache, if enabled
 
         Accepts:
             url(str): ex. https://grch37.rest.ensembl.org/lookup/id/ENSG00000103591
@@ -56,15 +102,17 @@ class EnsemblRestApiClient:
         Returns:
             data(dict): dictionary from json response
         """
+        cached = ensembl_cache.get(url)
+        if cached is not None:
+            return cached
+
         data = {}
         try:
-            response = requests.get(
-                url,
-                headers=HEADERS,
-            )
+            response = self._send("GET", url)
             data = response.json()
             if response.status_code != 200:
                 raise ValueError("The API did not return valid data")
+            ensembl_cache.set(url, data)
         except requests.exceptions.MissingSchema as ex:
             LOG.error("Request failed for url {0}: Missing Schrma error: {1}\n".format(url, ex))
             data = ex
@@ -73,3 +121,73 @@ class EnsemblRestApiClient:
             data = ex
 
         return data
+
+    def send_requests(self, urls):
+        """Sends GET requests for a list of URLs concurrently, using a bounded number of connections
+
+        Accepts:
+            urls(list): ex. ["https://grch37.rest.ensembl.org/lookup/id/ENSG00000103591", ..]
+
+        Returns:
+            data(dict): url -> dictionary from json response
+        """
+        urls = list(dict.fromkeys(urls))
+        if len(urls) < 2:
+            return {url: self.send_request(url) for url in urls}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            return dict(zip(urls, executor.map(self.send_request, urls)))
+
+    def lookup_ids(self, ensembl_ids):
+        """Look up a list of Ensembl IDs using the POST lookup endpoint, in batches
+
+        Accepts:
+            ensembl_ids(list): ex. ["ENSG00000103591", "ENSG00000167468"]
+
+        Returns:
+            data(dict): Ensembl ID -> lookup result (dict) or None if the ID was not found
+                ex. {"ENSG00000103591": {"display_name": "AAGAB", ..}}
+        """
+        data = {}
+        missing = []
+        for ensembl_id in dict.fromkeys(ensembl_ids):
+            # Saved with the same key of single lookups
+            cached = ensembl_cache.get(f"{self.server}/lookup/id/{ensembl_id}")
+            if cached is None:
+                missing.append(ensembl_id)
+            else:
+                data[ensembl_id] = cached
+
+        for start in range(0, len(missing), BATCH_SIZE):
+            batch = missing[start : start + BATCH_SIZE]
+            response = self._send("POST", f"{self.server}/lookup/id", json={"ids": batch})
+            if response.status_code != 200:
+                raise ValueError(f"The API did not return valid data: {response.status_code}")
+            for ensembl_id, result in response.json().items():
+                data[ensembl_id] = result
+                if result is not None:
+                    ensembl_cache.set(f"{self.server}/lookup/id/{ensembl_id}", result)
+        return data
+
+    def _send(self, method, url, **kwargs):
+        """Send a request through the shared HTTP session. Requests are delayed or retried according
+        to the rate-limit headers returned by the Ensembl REST API
+
+        Returns:
+            response(requests.Response)
+        """
+        global _rate_limited_until
+        for attempt in range(MAX_RETRIES + 1):
+            with _rate_limit_lock:
+                wait = _rate_limited_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            response = get_session().request(
+                method, url, headers=HEADERS, timeout=TIMEOUT, **kwargs
+            )
+            wait = _retry_wait(response)
+            if wait:
+                with _rate_limit_lock:
+                    _rate_limited_until = max(_rate_limited_until, time.monotonic() + wait)
+            if response.status_code not in [429, 503] or attempt == MAX_RETRIES:
+                return response
+            LOG.warning(f"Ensembl REST API returned {response.status_code}, retrying in {wait}s")
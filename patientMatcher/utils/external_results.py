@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import json
+import logging
+
+LOG = logging.getLogger(__name__)
+
+RESULTS_COLLECTION = "external_results"
+
+
+def content_fingerprint(patient):
+    """Return a fingerprint of the patient content used by other nodes for matching (phenotype,
+    diagnoses and genomic features). Contact info or labels changes don't change it
+
+    Args:
+        patient(dict): a MME patient entity
+
+    Returns:
+        fingerprint(str): a SHA-256 hex digest
+    """
+    content = {
+        "sex": patient.get("sex"),
+        "features": sorted(
+            [feature.get("id"), feature.get("observed", "yes")]
+            for feature in patient.get("features") or []
+        ),
+        "disorders": sorted(disorder.get("id") for disorder in patient.get("disorders") or []),
+        "genomicFeatures": sorted(
+            json.dumps(
+                {
+                    "gene": feature.get("gene", {}).get("id"),
+                    "variant": feature.get("variant"),
+                    "zygosity": feature.get("zygosity"),
+                    "type": (feature.get("type") or {}).get("id"),
+                },
+                sort_keys=True,
+            )
+            for feature in patient.get("genomicFeatures") or []
+        ),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _result_id(patient_id, node_id):
+    return f"{patient_id}|{node_id}"
+
+
+def fresh_result(database, patient_id, node, fingerprint, max_age):
+    """Return the results of the last successful query of a node with a patient, if the patient's
+    content and the node's matching URL are unchanged and the query is recent enough
+
+    Args:
+        database(pymongo.database.Database)
+        patient_id(str): ID of the patient
+        node(dict): a node object from the database
+        fingerprint(str): content fingerprint of the patient
+        max_age(int): max age of the results in seconds
+
+    Returns:
+        result_obj(dict): the results returned by the node, None if they should be queried again
+    """
+    saved = database[RESULTS_COLLECTION].find_one(
+        {
+            "_id": _result_id(patient_id, node["_id"]),
+            "fingerprint": fingerprint,
+            "matching_url": node["matching_url"],
+            "created": {"$gte": datetime.datetime.now() - datetime.timedelta(seconds=max_age)},
+        }
+    )
+    if saved is None:
+        return None
+    LOG.info(f"Reusing results returned by node {node['_id']} on {saved['created']}")
+    return saved["result"]
+
+
+def save_result(database, patient_id, node, fingerprint, result_obj):
+    """Save the results of a successful query of a node with a patient
+
+    Args:
+        database(pymongo.database.Database)
+        patient_id(str): ID of the patient
+        node(dict): a node object from the database
+        fingerprint(str): content fingerprint of the patient
+        result_obj(dict): the results returned by the node
+    """
+    database[RESULTS_COLLECTION].replace_one(
+        {"_id": _result_id(patient_id, node["_id"])},
+        {
+            "patient_id": patient_id,
+            "node_id": node["_id"],
+            "fingerprint": fingerprint,
+            "matching_url": node["matching_url"],
+            "created": datetime.datetime.now(),
+            "result": result_obj,
+        },
+        upsert=True,
+    )
@@ -1,6 +1,82 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import csv
+import logging
+import os
+
 import patientMatcher.utils.ensembl_rest_client as ensembl_client
+from patientMatcher.resources import path_to_hgnc_genes
+
+LOG = logging.getLogger(__name__)
+
+
+class GeneTable:
+    """Gene identifiers from the HGNC complete set, used to convert genes without the Ensembl REST API"""
+
+    def __init__(self):
+        self.loaded = False
+        self.symbol_ensembl = {}  # HGNC symbol -> Ensembl gene ID
+        self.ensembl_symbol = {}  # Ensembl gene ID -> HGNC symbol
+        self.entrez_symbol = {}  # Entrez ID -> HGNC symbol
+
+    def init_app(self, path=None):
+        """Load the HGNC complete set file into memory
+
+        Args:
+            path(str): path to the tab-separated HGNC complete set file. Default: the file
+                downloaded with 'pmatcher update resources'
+        """
+        path = path or path_to_hgnc_genes
+        if os.path.isfile(path) is False:
+            LOG.warning(
+                f"HGNC genes file not found at {path}, genes will be converted using the Ensembl REST API"
+            )
+            return
+
+        previous_symbols = {}
+        with open(path, encoding="utf-8") as genes_file:
+            for row in csv.DictReader(genes_file, delimiter="\t"):
+                symbol = row.get("symbol")
+                if not symbol:
+                    continue
+                ensembl_id = row.get("ensembl_gene_id")
+                if ensembl_id:
+                    self.symbol_ensembl[symbol] = ensembl_id
+                    self.ensembl_symbol[ensembl_id] = symbol
+                    for previous in _split_values(row.get("prev_symbol")):
+                        previous_symbols.setdefault(previous, set()).add(ensembl_id)
+                for entrez_id in _split_values(row.get("entrez_id")):
+                    self.entrez_symbol[entrez_id] = symbol
+
+        # Previous symbols are used only when they don't clash with an approved symbol or with each other
+        for previous, ensembl_ids in previous_symbols.items():
+            if previous not in self.symbol_ensembl and len(ensembl_ids) == 1:
+                self.symbol_ensembl[previous] = ensembl_ids.pop()
+
+        self.loaded = bool(self.ensembl_symbol)
+        LOG.info(f"Loaded {len(self.ensembl_symbol)} genes from {path}")
+
+    def symbol_to_ensembl(self, gene_symbol):
+        """Convert a HGNC gene symbol to Ensembl id. Example: LIMS2 -> ENSG00000072163"""
+        return self.symbol_ensembl.get(gene_symbol) or self.symbol_ensembl.get(gene_symbol.upper())
+
+    def ensembl_to_symbol(self, ensembl_id):
+        """Convert an Ensembl id to HGNC gene symbol. Example: ENSG00000103591 -> AAGAB"""
+        return self.ensembl_symbol.get(ensembl_id.split(".")[0])
+
+    def entrez_to_symbol(self, entrez_id):
+        """Convert an Entrez id to HGNC gene symbol. Example: 3735 -> KARS1"""
+        return self.entrez_symbol.get(entrez_id)
+
+
+genes = GeneTable()
+
+
+def _split_values(value):
+    """Split a multi-valued field of the HGNC complete set. Example: '"MYO5|GS1"' -> ['MYO5', 'GS1']"""
+    if not value:
+        return []
+    return [item.strip() for item in value.strip('"').split("|") if item.strip()]
 
 
 def entrez_to_symbol(entrez_id):
@@ -51,6 +127,24 @@ def symbol_to_ensembl(gene_symbol):
                 return ensembl_id
 
 
+def ensembl_to_symbols(ensembl_ids):
+    """Converts a list of ensembl ids to gene symbols with batch requests
+
+    Accepts:
+        ensembl_ids(list): ensembl gene ids. Ex: ["ENSG00000103591", "ENSG00000167468"]
+
+    Returns:
+        gene_symbols(dict): ensembl id -> official gene symbol. Ex: {"ENSG00000103591": "AAGAB", ..}
+    """
+    client = ensembl_client.EnsemblRestApiClient()
+    results = client.lookup_ids(ensembl_ids)
+    return {
+        ensembl_id: result.get("display_name")
+        for ensembl_id, result in results.items()
+        if isinstance(result, dict)
+    }
+
+
 def ensembl_to_symbol(ensembl_id):
     """Converts ensembl id to gene symbol
 
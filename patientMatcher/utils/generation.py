@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from pymongo import ReturnDocument
+
+LOG = logging.getLogger(__name__)
+
+GENERATION_COLLECTION = "generations"
+PATIENTS_GENERATION = "patients"
+# Number of recent changes of the patients collection saved together with its generation, so that
+# in-memory copies of other server processes apply them instead of reloading all patients
+CHANGES_LOG_SIZE = 1000
+
+_copies = []  # in-memory copies of the patients kept by this server process
+
+
+def keep_updated(copy):
+    """Update an in-memory copy of the patients whenever the patients collection is changed
+
+    Args:
+        copy(object): an object with an update(generation, saved, removed_ids) method, like
+            genotype_index.GenotypeIndex or patient_replica.PatientReplica
+    """
+    _copies.append(copy)
+
+
+def patients_generation(database):
+    """Return the number of changes of the patients collection saved by any server process
+
+    Args:
+        database(pymongo.database.Database)
+
+    Returns:
+        generation(int)
+    """
+    doc = database[GENERATION_COLLECTION].find_one({"_id": PATIENTS_GENERATION}, {"value": 1})
+    return doc["value"] if doc else 0
+
+
+def patients_changes(database, generation, current):
+    """Return the changes of the patients collection saved after a generation, from the log of the
+    most recent changes
+
+    Args:
+        database(pymongo.database.Database)
+        generation(int): generation of an in-memory copy of the patients
+        current(int): current generation of the patients collection, higher than generation
+
+    Returns:
+        current(int), changes(list of dict): the generation after the changes and the changes, with
+            the IDs of the "saved" and "removed" patients. None, None if the changes are no longer
+            in the log (or the patients collection was reloaded) and the copy must be reloaded
+    """
+    n_changes = current - generation
+    for _ in range(3):
+        doc = database[GENERATION_COLLECTION].find_one(
+            {"_id": PATIENTS_GENERATION}, {"value": 1, "changes": {"$slice": -n_changes}}
+        )
+        if doc is None or doc["value"] <= generation:
+            return None, None
+        if doc["value"] - generation == n_changes:
+            changes = doc.get("changes") or []
+            if len(changes) < n_changes:
+                return None, None
+            return doc["value"], changes
+        # Changed again in the meantime
+        n_changes = doc["value"] - generation
+    return None, None
+
+
+def patients_changed(database, saved=None, removed_ids=None):
+    """Increase the generation of the patients collection, save the IDs of the changed patients in the
+    log of the recent changes and update the in-memory copies of the patients kept by this server
+    process (genotype index and matching replica, see keep_updated)
+
+    Args:
+        database(pymongo.database.Database)
+        saved(list): patients saved to the database, as saved
+        removed_ids(list): IDs of the patients removed from the database.
+            If both saved and removed_ids are None the in-memory copies are reloaded from the database
+
+    Returns:
+        generation(int): the new generation of the patients collection
+    """
+    if saved is None and removed_ids is None:
+        # All patients must be reloaded, older changes can't be applied anymore
+        log = {"$set": {"changes": []}}
+    else:
+        change = {
+            "saved": [patient["_id"] for patient in saved or []],
+            "removed": list(removed_ids or []),
+        }
+        log = {"$push": {"changes": {"$each": [change], "$slice": -CHANGES_LOG_SIZE}}}
+    # The change is saved with the generation in one atomic update
+    doc = database[GENERATION_COLLECTION].find_one_and_update(
+        {"_id": PATIENTS_GENERATION},
+        {"$inc": {"value": 1}, **log},
+        projection={"value": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    generation = doc["value"]
+    _update_copies(generation, saved, removed_ids)
+    return generation
+
+
+def patients_dropped():
+    """Reload the in-memory copies of the patients kept by this server process after all collections
+    (including the generation of the patients collection) were dropped"""
+    _update_copies(None)
+
+
+def _update_copies(generation, saved=None, removed_ids=None):
+    for copy in _copies:
+        copy.update(generation, saved, removed_ids)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import defaultdict
+
+from patientMatcher.constants import VARIANT_INDEX
+from patientMatcher.utils.generation import keep_updated, patients_changes, patients_generation
+from patientMatcher.utils.variant_index import features_variant_keys
+
+LOG = logging.getLogger(__name__)
+
+
+class GenotypeIndex:
+    """In-memory index of the genes and variants of all database patients.
+
+    Ensembl gene IDs, gene symbols and canonical variant keys are mapped to the ordinals of the patients
+    carrying them, so that genotype scores are computed from the intersections of these posting lists
+    instead of querying the database and rescanning the genomic features of every candidate.
+
+    Every change of the patients collection increases a generation number saved in the database,
+    together with the IDs of the changed patients. An index at an older generation (for instance
+    changed by another server process) reads these patients again before use, and it's rebuilt only
+    if the changes are no longer available.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.generation = None
+        self.lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self.patient_ids = []  # ordinal -> patient ID, None for removed patients
+        self.free_ordinals = []  # ordinals of removed patients, reused by the next patients added
+        self.ordinals = {}  # patient ID -> ordinal
+        self.postings = {}  # ordinal -> (gene IDs, gene symbols, variant keys) of the patient
+        self.gene_ids = defaultdict(set)
+        self.gene_symbols = defaultdict(set)
+        self.variant_keys = defaultdict(set)
+
+    def init_app(self, database, enabled=False):
+        """Build the index from the patients saved in the database
+
+        Args:
+            database(pymongo.database.Database)
+            enabled(bool): if False the index is not used and genotype matching queries the database
+        """
+        self.enabled = enabled
+        with self.lock:
+            self._clear()
+            self.generation = None
+        if enabled:
+            self.build(database)
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def build(self, database):
+        """(Re)build the index from all patients with genomic features
+
+        Args:
+            database(pymongo.database.Database)
+        """
+        with self.lock:
+            generation = patients_generation(database)
+            query = {"genomicFeatures": {"$exists": True, "$ne": []}}
+            self.load(database["patients"].find(query, {"genomicFeatures": 1, VARIANT_INDEX: 1}))
+            self.generation = generation
+        LOG.info(f"Genotype index built with {len(self)} patients")
+
+    def load(self, patients):
+        """Replace the content of the index with a list of patients
+
+        Args:
+            patients(iterable): patients with genomic features and their variant keys
+        """
+        with self.lock:
+            self._clear()
+            for patient in patients:
+                self._add(patient)
+
+    def current(self, database):
+        """Return the index, updated with the patients changed by other server processes
+
+        Args:
+            database(pymongo.database.Database)
+
+        Returns:
+            self(GenotypeIndex)
+        """
+        with self.lock:
+            generation = patients_generation(database)
+            if self.generation is None or generation < self.generation:
+                self.build(database)
+            elif generation > self.generation:
+                generation, changes = patients_changes(database, self.generation, generation)
+                if changes is None:
+                    self.build(database)
+                else:
+                    self._apply(database, changes)
+                    self.generation = generation
+        return self
+
+    def _apply(self, database, changes):
+        """Read again the patients saved or removed by other server processes
+
+        Args:
+            database(pymongo.database.Database)
+            changes(list of dict): changes of the patients collection, as returned by patients_changes
+        """
+        patient_ids = set()
+        for change in changes:
+            patient_ids.update(change.get("saved") or [])
+            patient_ids.update(change.get("removed") or [])
+        found = set()
+        for patient in database["patients"].find(
+            {"_id": {"$in": list(patient_ids)}}, {"genomicFeatures": 1, VARIANT_INDEX: 1}
+        ):
+            self._add(patient)
+            found.add(patient["_id"])
+        for patient_id in patient_ids - found:
+            self._remove(patient_id)
+        LOG.debug(f"Genotype index updated with {len(patient_ids)} changed patients")
+
+    def _add(self, patient):
+        self._remove(patient["_id"])
+        features = patient.get("genomicFeatures") or []
+        if not features:
+            return
+        ids = {feature["gene"]["id"] for feature in features}
+        symbols = {
+            feature["gene"]["_geneName"] for feature in features if feature["gene"].get("_geneName")
+        }
+        keys = set().union(*features_variant_keys(features, patient.get(VARIANT_INDEX)))
+        keys.discard(None)
+
+        if self.free_ordinals:
+            ordinal = self.free_ordinals.pop()
+            self.patient_ids[ordinal] = patient["_id"]
+        else:
+            ordinal = len(self.patient_ids)
+            self.patient_ids.append(patient["_id"])
+        self.ordinals[patient["_id"]] = ordinal
+        self.postings[ordinal] = (ids, symbols, keys)
+        for postings, values in zip(
+            (self.gene_ids, self.gene_symbols, self.variant_keys), (ids, symbols, keys)
+        ):
+            for value in values:
+                postings[value].add(ordinal)
+
+    def _remove(self, patient_id):
+        ordinal = self.ordinals.pop(patient_id, None)
+        if ordinal is None:
+            return
+        self.patient_ids[ordinal] = None
+        self.free_ordinals.append(ordinal)
+        for postings, values in zip(
+            (self.gene_ids, self.gene_symbols, self.variant_keys), self.postings.pop(ordinal)
+        ):
+            for value in values:
+                postings[value].discard(ordinal)
+                if not postings[value]:
+                    del postings[value]
+
+    def add_patient(self, patient):
+        """Add a patient to the index, or update it if already present
+
+        Args:
+            patient(dict): a patient with genomic features and their variant keys
+        """
+        with self.lock:
+            self._add(patient)
+
+    def remove_patient(self, patient_id):
+        """Remove a patient from the index
+
+        Args:
+            patient_id(str): ID of the patient
+        """
+        with self.lock:
+            self._remove(patient_id)
+
+    def update(self, generation, saved=None, removed_ids=None):
+        """Update the index after patients were saved or removed by this server process
+
+        Args:
+            generation(int): the generation of the patients collection after the change
+            saved(list): patients saved to the database
+            removed_ids(list): IDs of the patients removed from the database
+        """
+        if self.enabled is False:
+            return
+        with self.lock:
+            if generation is None or (saved is None and removed_ids is None):
+                # All patients changed, rebuild before next use
+                self.generation = None
+                return
+            if self.generation is None or generation != self.generation + 1:
+                # Changed by another process too, the changes are read from the log before next use
+                return
+            for patient_id in removed_ids or []:
+                self._remove(patient_id)
+            for patient in saved or []:
+                self._add(patient)
+            self.generation = generation
+
+    def scores(self, query_plan, genes, symbols, max_feature_similarity):
+        """Compute the genotype score of all patients sharing genes or variants with a query patient.
+        Scores are the same as those computed by patientMatcher.match.genotype_matcher.evaluate_gt_similarity
+
+        Args:
+            query_plan(list of dict): genomic features of the query patient, as returned by genotype_query_plan
+            genes(list): Ensembl gene IDs of the query patient
+            symbols(list): gene symbols of the query patient
+            max_feature_similarity(float): the highest value allowed for a single feature
+
+        Returns:
+            scores(dict): patient ID -> genotype score
+        """
+        with self.lock:
+            candidates = set()
+            for postings, values in (
+                (self.gene_ids, genes),
+                (self.gene_symbols, symbols),
+                (self.variant_keys, [feature["variant_key"] for feature in query_plan]),
+            ):
+                for value in values:
+                    candidates |= postings.get(value, set())
+
+            scores = dict.fromkeys(candidates, 0)
+            for feature in query_plan:
+                variant_hits = self.variant_keys.get(feature["variant_key"], set())
+                gene_hits = self.gene_ids.get(feature["gene_id"], set()) | self.gene_symbols.get(
+                    feature["gene_symbol"], set()
+                )
+                for ordinal in variant_hits:
+                    scores[ordinal] += max_feature_similarity
+                for ordinal in (gene_hits - variant_hits) & candidates:
+                    scores[ordinal] += max_feature_similarity / 4
+
+            return {self.patient_ids[ordinal]: score for ordinal, score in scores.items()}
+
+
+genotype_index = GenotypeIndex()
+keep_updated(genotype_index)
@@ -3,14 +3,19 @@
 # originally developed by Orion Buske in patient-similarity (https://github.com/buske/patient-similarity)
 
 import logging
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import Mapping, Sequence
 from math import log
 
+import numpy as np
 from patientMatcher.resources import path_to_hpo_terms
+from patientMatcher.utils.ontology_cache import hpo_id_to_int, int_to_hpo_id
 
 LOG = logging.getLogger(__name__)
 
 ROOT = "HP:0000001"
+NODE_CACHE_SIZE = 4096  # max number of nodes of a memory-mapped ontology kept in memory
 
 ### Code required by the HPO class ###
 def get_ancestors(root, acc=None):
@@ -27,14 +32,16 @@ class HPNode(object):
 
     def __init__(self, hpo_lines):
         self.id = None
+        self.index = None  # Position of the term in the topologically sorted ontology
         self.name = None
         self.parents = set()
         self.children = set()
         self.alts = set()  # Alternative Ids
         self._parent_hps = set()
+        self._ancestors = None
         self.obsolete = False
 
-        if hpo_lines[0] != "[Term]":
+        if not hpo_lines or hpo_lines[0] != "[Term]":
             return
 
         for line in hpo_lines[1:]:
@@ -53,7 +60,9 @@ class HPNode(object):
 
     def ancestors(self):
         """return all node ancestors"""
-        return get_ancestors(self)
+        if self._ancestors is None:  # Ancestors were not precomputed by HPO.init_app
+            return get_ancestors(self)
+        return self._ancestors
 
     def validate(self):
         """Make sure a node has an ID, a name and parents (if node is not root)"""
@@ -70,15 +79,149 @@ class HPNode(object):
         return str(self.id)
 
 
+class MappedHPNode(HPNode):
+    """An HPO node created on demand from the memory-mapped arrays of a compiled ontology.
+    Relationships with other nodes are read from the arrays whenever they are requested.
+    Nodes with the same index are equal, since the same term might be created more than once."""
+
+    def __init__(self, hpo, index):
+        self._hpo = hpo
+        self.index = index
+        self.id = int_to_hpo_id(int(hpo._cache["term_ids"][index]))
+        self.name = hpo._cache["names"][index].decode("utf-8")
+        self.obsolete = False
+        self._ancestors = None
+
+    def __eq__(self, other):
+        return isinstance(other, MappedHPNode) and other.index == self.index
+
+    def __hash__(self):
+        return hash(self.index)
+
+    @property
+    def parents(self):
+        return {self._hpo.node(idx) for idx in self._hpo._related("parents", self.index)}
+
+    @property
+    def children(self):
+        return {self._hpo.node(idx) for idx in self._hpo._related("children", self.index)}
+
+    @property
+    def _parent_hps(self):
+        return {parent.id for parent in self.parents}
+
+    @property
+    def alts(self):
+        alt_ids = self._hpo._cache["alt_ids"][self._hpo._cache["alt_targets"] == self.index]
+        return {int_to_hpo_id(int(number)) for number in alt_ids}
+
+    def ancestors(self):
+        """return all node ancestors"""
+        if self._ancestors is None:
+            self._ancestors = frozenset(
+                self._hpo.node(idx) for idx in self._hpo.ancestor_indexes(self.index).tolist()
+            )
+        return self._ancestors
+
+
+class MappedTerms(Mapping):
+    """Read-only dictionary HPO ID -> HPO node (alternative IDs included) of a memory-mapped ontology"""
+
+    def __init__(self, hpo):
+        self._hpo = hpo
+
+    def __getitem__(self, hp_id):
+        index = self._hpo.term_index(hp_id)
+        if index is None:
+            raise KeyError(hp_id)
+        return self._hpo.node(index)
+
+    def __iter__(self):
+        for number in self._hpo._cache["lookup_ids"]:
+            yield int_to_hpo_id(int(number))
+
+    def __len__(self):
+        return len(self._hpo._cache["lookup_ids"])
+
+
+class MappedNodes(Sequence):
+    """Read-only list of the HPO nodes of a memory-mapped ontology, sorted topologically"""
+
+    def __init__(self, hpo):
+        self._hpo = hpo
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self._hpo.node(index)
+
+    def __len__(self):
+        return len(self._hpo._cache["term_ids"])
+
+
 class HPO(object):
     """Parse and HPO ontology to make it available for phenotype matching"""
 
-    def init_app(self):
-        """Initialize the HPO ontology when the app is launched."""
+    def init_app(self, cache=None, mmap=False):
+        """Initialize the HPO ontology when the app is launched.
+
+        Args:
+            cache(dict): a compiled ontology returned by ontology_cache.load_ontology_cache.
+                If provided, the ontology is loaded from it instead of parsing the resource file.
+            mmap(bool): if True, the cache arrays are memory-mapped and HPO nodes are created
+                only when requested, instead of creating all nodes when the app is launched.
+        """
         self.hps = {}
-        self._parse_ontolology()
+        self.mmap = bool(cache) and mmap
+        self._cache = cache
+        self._nodes = OrderedDict()  # Most recently used nodes of a memory-mapped ontology
+        self._nodes_lock = threading.Lock()
+        if self.mmap:
+            self.hps = MappedTerms(self)
+            self.terms = MappedNodes(self)
+            self.ancestors_indptr = cache["ancestors_indptr"]
+            self.ancestors_indices = cache["ancestors_indices"]
+            LOG.info(f"Memory-mapped compiled ontology with {len(self.terms)} HPO terms")
+        elif cache:
+            self._load_cache(cache)
+        else:
+            self._parse_ontolology()
+            self._build_ancestors()
         self.root = self.hps[ROOT]
 
+    def _load_cache(self, cache):
+        """Create HPO nodes from the arrays of a compiled ontology"""
+        self.terms = []
+        for number, name in zip(cache["term_ids"].tolist(), cache["names"].tolist()):
+            node = HPNode([])
+            node.id = int_to_hpo_id(number)
+            node.name = name.decode("utf-8")
+            node.index = len(self.terms)
+            self.terms.append(node)
+            self.hps[node.id] = node
+
+        parents_indptr = cache["parents_indptr"].tolist()
+        parents_indices = cache["parents_indices"].tolist()
+        ancestors_indptr = cache["ancestors_indptr"].tolist()
+        ancestors_indices = cache["ancestors_indices"].tolist()
+        for idx, node in enumerate(self.terms):
+            for parent_idx in parents_indices[parents_indptr[idx] : parents_indptr[idx + 1]]:
+                parent = self.terms[parent_idx]
+                node._parent_hps.add(parent.id)
+                node.parents.add(parent)
+                parent.children.add(node)
+            start, end = ancestors_indptr[idx], ancestors_indptr[idx + 1]
+            node._ancestors = frozenset(self.terms[i] for i in ancestors_indices[start:end])
+
+        for number, target in zip(cache["alt_ids"].tolist(), cache["alt_targets"].tolist()):
+            node = self.terms[target]
+            node.alts.add(int_to_hpo_id(number))
+            self.hps[int_to_hpo_id(number)] = node
+
+        self.ancestors_indptr = cache["ancestors_indptr"]
+        self.ancestors_indices = cache["ancestors_indices"]
+        LOG.info(f"Loaded {len(self.terms)} HPO terms from compiled ontology")
+
     def _parse_ontolology(self):
         """Parse HPO ontology file, that is available under patientMatcher/resources"""
         with open(path_to_hpo_terms, encoding="utf-8") as hpofile:
@@ -111,11 +254,140 @@ class HPO(object):
 
         LOG.info(f"Parsed {len(nodes)} HPO terms into HPO nodes from resource file")
 
+    def _build_ancestors(self):
+        """Precompute the ancestors of all HPO terms.
+        Terms are visited in topological order (parents before children), so that the ancestors
+        of a term are the union of the ancestors of its parents.
+
+        Ancestors are saved as a frozenset on each node and in CSR form in 2 arrays: the ancestors
+        of term i are ancestors_indices[ancestors_indptr[i] : ancestors_indptr[i + 1]]
+        """
+        nodes = set(self.hps.values())
+        n_parents = {node: len(node.parents) for node in nodes}
+        queue = deque(sorted([node for node in nodes if not node.parents], key=lambda n: n.id))
+
+        self.terms = []  # All terms, sorted topologically
+        while queue:
+            node = queue.popleft()
+            node.index = len(self.terms)
+            ancestors = {node}
+            for parent in node.parents:
+                ancestors.update(parent._ancestors)
+            node._ancestors = frozenset(ancestors)
+            self.terms.append(node)
+
+            for child in sorted(node.children, key=lambda n: n.id):
+                n_parents[child] -= 1
+                if n_parents[child] == 0:
+                    queue.append(child)
+
+        if len(self.terms) != len(nodes):
+            LOG.warning(
+                f"{len(nodes) - len(self.terms)} HPO terms are part of a cycle and were ignored"
+            )
+
+        indptr = [0]
+        indices = []
+        for node in self.terms:
+            indices.extend(sorted(ancestor.index for ancestor in node._ancestors))
+            indptr.append(len(indices))
+        self.ancestors_indptr = np.array(indptr, dtype=np.int64)
+        self.ancestors_indices = np.array(indices, dtype=np.int32)
+        LOG.info(f"Ancestors precomputed for {len(self.terms)} HPO terms")
+
+    def ancestor_indexes(self, index):
+        """Return the indexes of the ancestors of a term (the term itself included)
+
+        Args:
+            index(int): index of an HPO term
+
+        Returns:
+            indexes(numpy.ndarray): array of int32
+        """
+        return self.ancestors_indices[
+            self.ancestors_indptr[index] : self.ancestors_indptr[index + 1]
+        ]
+
+    def _related(self, relation, index):
+        """Return the indexes of the parents or the children of a term from a compiled ontology"""
+        indptr = self._cache[f"{relation}_indptr"]
+        return self._cache[f"{relation}_indices"][indptr[index] : indptr[index + 1]]
+
+    def term_index(self, hp_id):
+        """Return the index of an HPO term or alternative ID, or None if it's not in the ontology
+
+        Args:
+            hp_id(str): example 'HP:0001250'
+
+        Returns:
+            index(int)
+        """
+        if self.mmap is False:
+            node = self.hps.get(hp_id)
+            return node.index if node else None
+        try:
+            number = hpo_id_to_int(hp_id)
+        except (AttributeError, IndexError, ValueError):
+            return None
+        lookup_ids = self._cache["lookup_ids"]
+        position = int(np.searchsorted(lookup_ids, number))
+        if position < len(lookup_ids) and lookup_ids[position] == number:
+            return int(self._cache["lookup_targets"][position])
+        return None
+
+    def term_indexes(self, hp_ids):
+        """Return the indexes of a list of HPO terms or alternative IDs, skipping unknown terms
+
+        Args:
+            hp_ids(list): example ['HP:0001250', 'HP:0000252']
+
+        Returns:
+            indexes(list): list of int
+        """
+        if self.mmap is False:
+            return [self.hps[hp_id].index for hp_id in hp_ids if hp_id in self.hps]
+        numbers = []
+        for hp_id in hp_ids:
+            try:
+                numbers.append(hpo_id_to_int(hp_id))
+            except (AttributeError, IndexError, ValueError):
+                continue
+        lookup_ids = self._cache["lookup_ids"]
+        positions = np.minimum(np.searchsorted(lookup_ids, numbers), len(lookup_ids) - 1)
+        found = lookup_ids[positions] == numbers
+        return self._cache["lookup_targets"][positions[found]].tolist()
+
+    def node(self, index):
+        """Return the HPO node with a given index
+
+        Args:
+            index(int): index of an HPO term
+
+        Returns:
+            node(HPNode)
+        """
+        if self.mmap is False:
+            return self.terms[index]
+        with self._nodes_lock:
+            node = self._nodes.get(index)
+            if node is not None:
+                self._nodes.move_to_end(index)
+                return node
+        node = MappedHPNode(self, index)
+        with self._nodes_lock:
+            node = self._nodes.setdefault(index, node)
+            if len(self._nodes) > NODE_CACHE_SIZE:
+                self._nodes.popitem(last=False)
+        return node
+
     def __getitem__(self, key):
         return self.hps[key]
 
     def __len__(self):
-        return len(set(self.hps.values()))
+        return len(self.terms)
+
+
+hpo = HPO()
 
 
 ### End of  code required by the HPO class ###
@@ -129,14 +401,57 @@ def _bound(p, eps=EPS):
     return min(max(p, eps), 1 - eps)
 
 
+class MappedValues(Mapping):
+    """Read-only dictionary HPO node -> value, reading values from a memory-mapped array.
+    Terms with a NaN value are not included."""
+
+    def __init__(self, hpo, values):
+        self._hpo = hpo
+        self._values = values
+
+    def __getitem__(self, node):
+        value = float(self._values[node.index])
+        if value != value:  # NaN
+            raise KeyError(node)
+        return value
+
+    def __iter__(self):
+        for index in np.flatnonzero(~np.isnan(self._values)):
+            yield self._hpo.node(int(index))
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self._values)))
+
+
 ###  Class handling the information-content functionality for the HPO
 class HPOIC(object):
-    def init_app(self, app, hpo, diseases):
-        """Initialize the HPO ontology when the app is launched."""
+    def init_app(self, app, hpo, diseases, cache=None):
+        """Initialize the HPO ontology when the app is launched.
+
+        Args:
+            cache(dict): a compiled ontology returned by ontology_cache.load_ontology_cache.
+                If provided, information content and link strengths are read from it.
+        """
+        if cache and hpo.mmap:
+            self.term_ic = MappedValues(hpo, cache["ic"])
+            self.lss = MappedValues(hpo, cache["lss"])
+            LOG.info("HPO information content memory-mapped from compiled ontology")
+            return
+        if cache:
+            self.term_ic = {}
+            self.lss = {}
+            for node, ic, ls in zip(hpo.terms, cache["ic"].tolist(), cache["lss"].tolist()):
+                if ic == ic:  # Not NaN
+                    self.term_ic[node] = ic
+                if ls == ls:
+                    self.lss[node] = ls
+            LOG.info("HPO information content loaded from compiled ontology")
+            return
+
         LOG.info("Initializing the HPO information content")
         term_freq = self._get_term_frequencies(diseases, hpo)
         LOG.info("Total term frequency mass: {}".format(sum(term_freq.values())))
-        term_ic = self._get_ics(hpo.root, term_freq)
+        term_ic = self._get_ics(hpo, term_freq)
         LOG.info("IC calculated for {}/{} terms".format(len(term_ic), len(hpo)))
         lss = self._get_link_strengths(term_ic)
         LOG.info("Link strength calculated for {}/{} terms".format(len(lss), len(hpo)))
@@ -174,28 +489,17 @@ class HPOIC(object):
 
         return term_freq
 
-    def _get_descendant_lookup(self, root, accum=None):
-        if accum is None:
-            accum = {}
-        if root in accum:
-            return
-
-        descendants = set([root])
-        for child in root.children:
-            self._get_descendant_lookup(child, accum)
-            descendants.update(accum[child])
-        accum[root] = descendants
-        return accum
-
-    def _get_ics(self, root, term_freq):
-        term_descendants = self._get_descendant_lookup(root)
+    def _get_ics(self, hpo, term_freq):
+        """The probability mass of a term is the sum of the frequencies of the term and its
+        descendants. It is collected by adding the frequency of each term to all its ancestors"""
+        term_prob_mass = defaultdict(float)
+        for term, freq in term_freq.items():
+            for ancestor in term.ancestors():
+                term_prob_mass[ancestor] += freq
 
         term_ic = {}
-        for node, descendants in term_descendants.items():
-            prob_mass = 0.0
-            for descendant in descendants:
-                prob_mass += term_freq.get(descendant, 0)
-
+        for node in hpo.terms:
+            prob_mass = term_prob_mass.get(node, 0.0)
             if prob_mass > EPS:
                 prob_mass = _bound(prob_mass)
                 term_ic[node] = -log(prob_mass)
@@ -221,4 +525,7 @@ class HPOIC(object):
         return sum([self.term_ic.get(term, 0) for term in terms])
 
 
+hpoic = HPOIC()
+
+
 ### END of Code required by the HPOIC class ###
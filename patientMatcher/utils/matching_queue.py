@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import threading
+import uuid
+
+from flask import current_app
+from patientMatcher.match.handler import external_matcher
+from patientMatcher.utils.notify import notify_match_external
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+LOG = logging.getLogger(__name__)
+
+JOBS_COLLECTION = "jobs"
+MAX_ATTEMPTS = 3
+STALE_JOB_TIMEOUT = 900  # seconds after which a running job is considered abandoned by its worker
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def run_external_matching(database, patient_id, force=False):
+    """Match a database patient against the connected nodes, save the matching object and notify
+    the patient's contact of the results. Must be called in an app context
+
+    Args:
+        database(pymongo.database.Database)
+        patient_id(str): ID of the patient
+        force(bool): if True query all nodes, even if their results could be reused
+
+    Returns:
+        match_id(ObjectId): ID of the saved matching object, None if patient or nodes were not found
+    """
+    patient = database["patients"].find_one({"_id": patient_id})
+    if patient is None:
+        LOG.warning(f"Patient {patient_id} was removed before external matching")
+        return None
+
+    matching_obj = external_matcher(database, patient, force=force)
+    if matching_obj is None:
+        return None
+    match_id = database["matches"].insert_one(matching_obj).inserted_id
+
+    # if patient is matching any other patient on other nodes and match notifications are on
+    if current_app.config.get("MAIL_SERVER") and matching_obj.get("results"):
+        notify_match_external(
+            match_obj=matching_obj,
+            admin_email=current_app.config.get("MAIL_USERNAME"),
+            mail=current_app.mail,
+            notify_complete=current_app.config.get("NOTIFY_COMPLETE"),
+        )
+    return match_id
+
+
+class MatchingQueue:
+    """Queue of the external matchings triggered by patients saved with the /patient/add endpoint,
+    so that the endpoint responds without waiting for the connected nodes.
+
+    Jobs are saved in the database, so that they are not lost when the server is restarted, and run
+    in the background by worker threads of every server process. Each job is claimed by a single
+    worker with an atomic update. Failed jobs, and jobs left running by a stopped server process
+    for STALE_JOB_TIMEOUT seconds, are run again, at most MAX_ATTEMPTS times.
+
+    The worker threads are started by the first request received by a server process, so that they
+    are not started by command line calls, nor before server processes are forked.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.workers = 0
+        self.poll_interval = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._threads = []
+
+    def init_app(self, app, enabled=False, workers=2, poll_interval=5):
+        """Configure the queue, stopping the worker threads started with a previous configuration
+
+        Args:
+            app(flask.Flask)
+            enabled(bool): if False external matchings are run before /patient/add responds
+            workers(int): number of worker threads of this server process
+            poll_interval(int): seconds between checks for jobs queued by other server processes
+        """
+        self.stop()
+        self.app = app
+        self.enabled = enabled
+        self.workers = workers
+        self.poll_interval = poll_interval or 5
+
+    def start(self):
+        """Start the worker threads running the queued jobs, if the queue is enabled and they were
+        not started yet. Called before each request handled by the server"""
+        if self._started or self.enabled is False:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._work, name=f"matching-queue-{nr}", daemon=True)
+                for nr in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._started = True
+
+    def stop(self):
+        """Stop the worker threads after their running jobs"""
+        with self._start_lock:
+            self._stop.set()
+            self._wake.set()
+            for thread in self._threads:
+                thread.join(timeout=self.poll_interval)
+            self._threads = []
+            self._started = False
+            self._wake.clear()
+
+    def enqueue(self, database, patient_id, force=False):
+        """Queue the external matching of a patient
+
+        Args:
+            database(pymongo.database.Database)
+            patient_id(str): ID of the patient
+            force(bool): if True query all nodes, even if their results could be reused
+
+        Returns:
+            job_id(str)
+        """
+        job = {
+            "_id": uuid.uuid4().hex,
+            "type": "external_match",
+            "patient_id": patient_id,
+            "force": force,
+            "status": QUEUED,
+            "created": datetime.datetime.now(),
+            "attempts": 0,
+        }
+        database[JOBS_COLLECTION].insert_one(job)
+        self._wake.set()
+        return job["_id"]
+
+    def claim(self, database):
+        """Mark the oldest queued or abandoned job as running by this worker
+
+        Args:
+            database(pymongo.database.Database)
+
+        Returns:
+            job(dict): the claimed job, None if there are no jobs to run
+        """
+        now = datetime.datetime.now()
+        stale = now - datetime.timedelta(seconds=STALE_JOB_TIMEOUT)
+        # Abandoned jobs that can't be run again are not left running forever
+        database[JOBS_COLLECTION].update_many(
+            {"status": RUNNING, "started": {"$lt": stale}, "attempts": {"$gte": MAX_ATTEMPTS}},
+            {"$set": {"status": FAILED, "error": "Job abandoned by its worker"}},
+        )
+        return database[JOBS_COLLECTION].find_one_and_update(
+            {
+                "$or": [
+                    {"status": QUEUED},
+                    {"status": RUNNING, "started": {"$lt": stale}},
+                ],
+                "attempts": {"$lt": MAX_ATTEMPTS},
+            },
+            {"$set": {"status": RUNNING, "started": now}, "$inc": {"attempts": 1}},
+            sort=[("created", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def run_next(self):
+        """Run the oldest queued job. Must be called in an app context
+
+        Returns:
+            job(dict): the job as saved after running it, None if there were no jobs to run
+        """
+        database = self.app.db
+        job = self.claim(database)
+        if job is None:
+            return None
+
+        try:
+            match_id = run_external_matching(database, job["patient_id"], job.get("force", False))
+            update = {"status": DONE, "finished": datetime.datetime.now(), "match_id": match_id}
+        except Exception as err:
+            LOG.error(f"Error while running job {job['_id']}: {err}")
+            update = {"status": FAILED if job["attempts"] >= MAX_ATTEMPTS else QUEUED}
+            update["error"] = str(err)
+        database[JOBS_COLLECTION].update_one({"_id": job["_id"]}, {"$set": update})
+        job.update(update)
+        return job
+
+    def _work(self):
+        """Run the queued jobs until the queue is stopped"""
+        with self.app.app_context():
+            while self._stop.is_set() is False:
+                try:
+                    job = self.run_next()
+                except PyMongoError as err:
+                    LOG.warning(f"Error while reading the matching queue: {err}")
+                    job = None
+                if job is None:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+
+
+matching_queue = MatchingQueue()
+
+
+def job_status(database, job_id):
+    """Return a job of the matching queue
+
+    Args:
+        database(pymongo.database.Database)
+        job_id(str)
+
+    Returns:
+        job(dict): None if the job doesn't exist
+    """
+    return database[JOBS_COLLECTION].find_one({"_id": job_id})
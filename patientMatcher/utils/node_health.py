@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import math
+
+from pymongo import ReturnDocument
+
+LOG = logging.getLogger(__name__)
+
+HEALTH_COLLECTION = "node_health"
+WINDOW = 100  # number of recent requests to a node used to compute its latency and error rate
+FAILURE_THRESHOLD = 5  # consecutive failed requests opening the circuit of a node
+COOLDOWN = 60  # seconds before a request is sent again to a node with an open circuit
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def node_available(database, node_id):
+    """Check whether match requests can be sent to a node.
+
+    The circuit of a node is opened after FAILURE_THRESHOLD consecutive failed requests, and no
+    requests are sent to the node for COOLDOWN seconds. The circuit is then half-open: a single
+    trial request is sent by any server process, and the circuit is closed if it succeeds.
+
+    Args:
+        database(pymongo.database.Database)
+        node_id(str)
+
+    Returns:
+        bool: False if the circuit of the node is open
+    """
+    health = database[HEALTH_COLLECTION].find_one({"_id": node_id}, {"state": 1})
+    if health is None or health.get("state", CLOSED) == CLOSED:
+        return True
+
+    now = datetime.datetime.now()
+    cooled_down = now - datetime.timedelta(seconds=COOLDOWN)
+    # Only one process gets the trial request, if it's lost another one is sent after COOLDOWN
+    trial = database[HEALTH_COLLECTION].find_one_and_update(
+        {
+            "_id": node_id,
+            "$or": [
+                {"state": OPEN, "opened": {"$lte": cooled_down}},
+                {"state": HALF_OPEN, "trial_started": {"$lte": cooled_down}},
+            ],
+        },
+        {"$set": {"state": HALF_OPEN, "trial_started": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    return trial is not None
+
+
+def record_request(database, node_id, latency, error=None):
+    """Save the outcome of a match request to a node and update the state of its circuit
+
+    Args:
+        database(pymongo.database.Database)
+        node_id(str)
+        latency(float): seconds waited for the response
+        error(str): the error, if the request failed
+    """
+    now = datetime.datetime.now()
+    update = {
+        "$push": {
+            "latencies": {"$each": [latency], "$slice": -WINDOW},
+            "failures": {"$each": [error is not None], "$slice": -WINDOW},
+        },
+        "$set": {"updated": now},
+    }
+    if error is None:
+        update["$set"].update({"state": CLOSED, "consecutive_failures": 0})
+    else:
+        update["$set"]["last_error"] = error
+        update["$inc"] = {"consecutive_failures": 1}
+
+    health = database[HEALTH_COLLECTION].find_one_and_update(
+        {"_id": node_id}, update, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    if error is None:
+        return
+    if health.get("state") == HALF_OPEN or (
+        health.get("state", CLOSED) == CLOSED
+        and health["consecutive_failures"] >= FAILURE_THRESHOLD
+    ):
+        LOG.warning(f"Node {node_id} failed {health['consecutive_failures']} times, circuit open")
+        database[HEALTH_COLLECTION].update_one(
+            {"_id": node_id}, {"$set": {"state": OPEN, "opened": now}}
+        )
+
+
+def reset_node(database, node_id):
+    """Close the circuit of a node and forget its past requests
+
+    Args:
+        database(pymongo.database.Database)
+        node_id(str)
+
+    Returns:
+        bool: False if there was no saved health for the node
+    """
+    return database[HEALTH_COLLECTION].delete_one({"_id": node_id}).deleted_count > 0
+
+
+def _percentile(values, percent):
+    """Return a percentile of a list of sorted values, using the nearest-rank method"""
+    if not values:
+        return None
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+def nodes_health(database):
+    """Return the health of all connected nodes, computed from their recent match requests
+
+    Args:
+        database(pymongo.database.Database)
+
+    Returns:
+        health(list of dict): example [{"id": "node_1", "label": "A node", "state": "closed",
+            "requests": 100, "error_rate": 0.02, "latency_p50": 0.4, "latency_p95": 1.2,
+            "latency_p99": 2.5, "consecutive_failures": 0, "last_error": None, "opened": None}]
+    """
+    saved = {health["_id"]: health for health in database[HEALTH_COLLECTION].find()}
+    results = []
+    for node in database["nodes"].find():
+        health = saved.get(node["_id"], {})
+        latencies = sorted(health.get("latencies", []))
+        failures = health.get("failures", [])
+        results.append(
+            {
+                "id": node["_id"],
+                "label": node.get("label"),
+                "state": health.get("state", CLOSED),
+                "requests": len(failures),
+                "error_rate": sum(failures) / len(failures) if failures else None,
+                "latency_p50": _percentile(latencies, 50),
+                "latency_p95": _percentile(latencies, 95),
+                "latency_p99": _percentile(latencies, 99),
+                "consecutive_failures": health.get("consecutive_failures", 0),
+                "last_error": health.get("last_error"),
+                "opened": health.get("opened"),
+            }
+        )
+    return results
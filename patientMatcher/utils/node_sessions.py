@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOG = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 10  # default max number of open connections to a node
+
+_sessions = {}  # node ID -> (node settings, session)
+_sessions_lock = threading.Lock()
+
+
+def _node_settings(node):
+    """Return the settings of a node used to create its session"""
+    return (
+        node["matching_url"],
+        node["auth_token"],
+        node["accepted_content"],
+        node.get("max_connections") or MAX_CONNECTIONS,
+    )
+
+
+def node_session(node):
+    """Return the HTTP session used to send match requests to a connected node, keeping a pool of
+    open connections to the node shared by all threads of this process.
+    The session is created again if the matching URL, the token or the pool size of the node changed.
+    The old session is not closed, since other threads might still be using it: its connections are
+    closed when it's garbage collected, after the requests sent with it are completed
+
+    Args:
+        node(dict): a node object from the database
+
+    Returns:
+        session(requests.Session)
+    """
+    settings = _node_settings(node)
+    with _sessions_lock:
+        saved = _sessions.get(node["_id"])
+        if saved and saved[0] == settings:
+            return saved[1]
+        if saved:
+            LOG.info(f"Settings of node {node['_id']} changed, opening new connections")
+
+        matching_url, token, accepted_content, max_connections = settings
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {
+                "Content-Type": accepted_content,
+                "Accept": "application/vnd.ga4gh.matchmaker.v1.0+json",
+                "X-Auth-Token": token,
+            }
+        )
+        _sessions[node["_id"]] = (settings, session)
+    return session
+
+
+def drop_sessions(keep_ids=None):
+    """Forget the sessions of the nodes that are no longer connected. Like sessions replaced by
+    node_session, they are closed when garbage collected, after their running requests
+
+    Args:
+        keep_ids(list): IDs of the connected nodes. If None all sessions are dropped
+    """
+    with _sessions_lock:
+        for node_id in list(_sessions):
+            if keep_ids is None or node_id not in keep_ids:
+                _sessions.pop(node_id)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from patientMatcher.resources import path_to_hpo_terms, path_to_phenotype_annotations
+from patientMatcher.utils.similarity import byte_information_content
+
+LOG = logging.getLogger(__name__)
+
+# Increase this number whenever the content of the cache changes
+CACHE_VERSION = 2
+META_FILE = "meta.json"
+TMP_PREFIX = ".tmp-"
+ARRAYS = [
+    "term_ids",  # Numerical part of the HPO IDs, sorted topologically
+    "names",  # UTF-8 encoded term names
+    "parents_indptr",
+    "parents_indices",
+    "children_indptr",
+    "children_indices",
+    "ancestors_indptr",
+    "ancestors_indices",
+    "alt_ids",  # Numerical part of the alternative HPO IDs
+    "alt_targets",  # Index of the term each alternative ID refers to
+    "lookup_ids",  # Numerical part of all HPO IDs and alternative IDs, sorted
+    "lookup_targets",  # Index of the term each lookup ID refers to
+    "ic",  # Information content of each term (NaN if not available)
+    "lss",  # Link strength of each term (NaN if not available)
+    "byte_ic",  # Information content lookup table used by the simGIC engine
+]
+
+
+def default_cache_dir(name="ontology"):
+    """Return the default directory of the compiled ontologies (or of other compiled resources), in
+    the cache directory of the user running the server (the package directory might not be writable)
+
+    Args:
+        name(str): name of the subdirectory, example 'ontology' or 'liftover'
+
+    Returns:
+        cache_dir(str): example '/home/user/.cache/patientMatcher/ontology'
+    """
+    user_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(user_cache, "patientMatcher", name)
+
+
+def cache_dir_writable(cache_dir):
+    """Check that compiled ontologies can be saved in a directory, creating it if necessary
+
+    Args:
+        cache_dir(str): path to the directory containing the compiled ontologies
+
+    Returns:
+        bool: False if the directory can't be created or written
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(cache_dir, os.W_OK | os.X_OK)
+
+
+def hpo_id_to_int(hpo_id):
+    """Convert an HPO term ID to an integer. Example: 'HP:0001250' -> 1250"""
+    return int(hpo_id.split(":")[1])
+
+
+def int_to_hpo_id(number):
+    """Convert an integer to an HPO term ID. Example: 1250 -> 'HP:0001250'"""
+    return f"HP:{number:07d}"
+
+
+def resources_checksum(resource_paths=None):
+    """Return the sha256 checksum of the content of the phenotype resource files
+
+    Args:
+        resource_paths(list): paths to resource files. Default: HPO terms and phenotype annotations
+
+    Returns:
+        checksum(str)
+    """
+    sha = hashlib.sha256()
+    for path in resource_paths or [path_to_hpo_terms, path_to_phenotype_annotations]:
+        with open(path, "rb") as resource:
+            for chunk in iter(lambda: resource.read(1024 * 1024), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _cache_path(cache_dir, checksum):
+    return os.path.join(cache_dir, f"v{CACHE_VERSION}-{checksum}")
+
+
+def _to_csr(groups):
+    """Convert a list of lists of integers to 2 arrays (indptr and indices) in CSR form"""
+    indptr = [0]
+    indices = []
+    for group in groups:
+        indices.extend(sorted(group))
+        indptr.append(len(indices))
+    return np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32)
+
+
+def load_ontology_cache(cache_dir, checksum, mmap=False):
+    """Load the compiled ontology saved for resource files with a given checksum
+
+    Args:
+        cache_dir(str): path to the directory containing the compiled ontologies
+        checksum(str): checksum of the phenotype resource files
+        mmap(bool): if True arrays are memory-mapped read-only instead of being read into memory,
+            so that all server processes on a host share the same copy of the ontology
+
+    Returns:
+        cache(dict) or None if a compiled ontology for these resource files is not available
+    """
+    path = _cache_path(cache_dir, checksum)
+    if os.path.isdir(path) is False:
+        return None
+    try:
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as meta_file:
+            cache = json.load(meta_file)
+        for key in ARRAYS:
+            array = np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r" if mmap else None)
+            # A plain array view is faster to slice than a numpy.memmap and still shares its pages
+            cache[key] = np.asarray(array)
+    except Exception as ex:
+        LOG.warning(f"Compiled ontology at {path} could not be loaded: {ex}")
+        return None
+
+    LOG.info(f"Loaded compiled ontology with {len(cache['term_ids'])} HPO terms from {path}")
+    return cache
+
+
+def save_ontology_cache(cache_dir, checksum, hpo, hpoic):
+    """Save the parsed HPO and its information content as a set of arrays in a cache directory.
+    Compiled ontologies from older resource files are removed.
+
+    Args:
+        cache_dir(str): path to the directory containing the compiled ontologies
+        checksum(str): checksum of the phenotype resource files
+        hpo(patientMatcher.utils.hpo.HPO): an initialized HPO object
+        hpoic(patientMatcher.utils.hpo.HPOIC): an initialized HPOIC object
+
+    Returns:
+        path(str): path to the saved cache or None if it couldn't be saved
+    """
+    path = _cache_path(cache_dir, checksum)
+    ic = np.array([hpoic.term_ic.get(node, np.nan) for node in hpo.terms])
+    arrays = {
+        "term_ids": np.array([hpo_id_to_int(node.id) for node in hpo.terms], dtype=np.int32),
+        "names": np.array([node.name.encode("utf-8") for node in hpo.terms]),
+        "ancestors_indptr": hpo.ancestors_indptr,
+        "ancestors_indices": hpo.ancestors_indices,
+        "ic": ic,
+        "lss": np.array([hpoic.lss.get(node, np.nan) for node in hpo.terms]),
+        "byte_ic": byte_information_content(np.nan_to_num(ic)),
+    }
+    arrays["parents_indptr"], arrays["parents_indices"] = _to_csr(
+        [[parent.index for parent in node.parents] for node in hpo.terms]
+    )
+    arrays["children_indptr"], arrays["children_indices"] = _to_csr(
+        [[child.index for child in node.children] for node in hpo.terms]
+    )
+
+    alts = [(hp_id, node) for hp_id, node in hpo.hps.items() if hp_id != node.id]
+    arrays["alt_ids"] = np.array([hpo_id_to_int(hp_id) for hp_id, _ in alts], dtype=np.int32)
+    arrays["alt_targets"] = np.array([node.index for _, node in alts], dtype=np.int32)
+
+    lookup_ids = np.concatenate([arrays["term_ids"], arrays["alt_ids"]])
+    lookup_targets = np.concatenate(
+        [np.arange(len(hpo.terms), dtype=np.int32), arrays["alt_targets"]]
+    )
+    order = np.argsort(lookup_ids, kind="stable")
+    arrays["lookup_ids"] = lookup_ids[order]
+    arrays["lookup_targets"] = lookup_targets[order]
+
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary folder first, so that other processes never read a partial cache
+        tmp_path = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=cache_dir)
+        os.chmod(tmp_path, 0o755)  # Readable by all server processes
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{key}.npy"), array)
+        with open(os.path.join(tmp_path, META_FILE), "w", encoding="utf-8") as meta_file:
+            json.dump({"version": CACHE_VERSION, "checksum": checksum}, meta_file)
+        os.rename(tmp_path, path)
+    except Exception as ex:
+        LOG.warning(f"Could not save compiled ontology to {cache_dir}: {ex}")
+        if tmp_path:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return None
+
+    # Remove compiled ontologies created from older resource files
+    for item in os.listdir(cache_dir):
+        item_path = os.path.join(cache_dir, item)
+        if item.startswith(TMP_PREFIX) or item_path == path:
+            continue
+        if os.path.isdir(item_path):
+            shutil.rmtree(item_path, ignore_errors=True)
+
+    LOG.info(f"Compiled ontology saved to {path}")
+    return path
@@ -14,10 +14,8 @@ class Patient(object):
     def ancestors(self):
         """Return all the HPO terms ancestors for a patient"""
         if self._ancestors is None:
-            ancestors = set()
-            for term in self.hp_terms:
-                ancestors.update(term.ancestors())
-            self._ancestors = ancestors
+            # Ancestors of each term are precomputed when the HPO is initialized
+            self._ancestors = set().union(*[term.ancestors() for term in self.hp_terms])
         return self._ancestors
 
 
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from patientMatcher.constants import PHENOTYPE_INDEX, VARIANT_INDEX
+from patientMatcher.parse.patient import disorders_to_omim, features_to_hpo
+from patientMatcher.utils.generation import keep_updated, patients_generation
+from patientMatcher.utils.genotype_index import GenotypeIndex
+from pymongo.errors import PyMongoError
+
+LOG = logging.getLogger(__name__)
+
+# Fields of the patients used for matching
+PROJECTION = {
+    "features._id": 1,
+    "features.id": 1,
+    "disorders.id": 1,
+    "genomicFeatures.gene.id": 1,
+    "genomicFeatures.gene._geneName": 1,
+    "genomicFeatures.variant": 1,
+    PHENOTYPE_INDEX: 1,
+    VARIANT_INDEX: 1,
+}
+MAX_AWAIT_TIME_MS = 1000
+
+
+def compact_patient(patient):
+    """Return the fields of a database patient used for matching
+
+    Args:
+        patient(dict): a patient as saved in the database
+
+    Returns:
+        record(dict): example {"_id": "p1", "features": [{"id": "HP:0001250"}], "disorders": [],
+            "genomicFeatures": [{"gene": {"id": "ENSG00000167468", "_geneName": "GPX4"}}]}
+    """
+    record = {
+        "_id": patient["_id"],
+        "features": [{"id": term} for term in features_to_hpo(patient.get("features"))],
+        "disorders": [{"id": term} for term in disorders_to_omim(patient.get("disorders"))],
+        "genomicFeatures": [
+            {
+                "gene": {
+                    key: value
+                    for key, value in feature.get("gene", {}).items()
+                    if key in ["id", "_geneName"]
+                },
+                "variant": feature.get("variant"),
+            }
+            for feature in patient.get("genomicFeatures") or []
+        ],
+    }
+    for key in [PHENOTYPE_INDEX, VARIANT_INDEX]:
+        if patient.get(key) is not None:
+            record[key] = patient[key]
+    return record
+
+
+class PatientReplica:
+    """In-memory copy of the fields of all database patients used for matching, so that matching
+    queries are scored without reading the patients from the database.
+
+    The replica is loaded when the server handles its first request (not by command line processes)
+    and kept up to date with a MongoDB change stream.
+    Change streams are available only on replica sets and sharded clusters: with standalone servers
+    the replica is reloaded when the generation of the patients collection changes, checked every
+    poll_interval seconds.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = False  # True once the patients are loaded
+        self.mode = None  # "change_stream" or "polling"
+        self.generation = None
+        self.database = None
+        self.poll_interval = None
+        self.records = {}  # patient ID -> compact patient
+        self.genotype = GenotypeIndex()
+        self.lock = threading.RLock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def init_app(self, database, enabled=False, poll_interval=10):
+        """Configure the replica, stopping the replica started with a previous configuration.
+        Patients are loaded by start, until then matching queries the database
+
+        Args:
+            database(pymongo.database.Database)
+            enabled(bool): if False the replica is not used and matching queries the database
+            poll_interval(int): seconds between checks of the patients collection when change
+                streams are not available
+        """
+        self.stop()
+        self.enabled = enabled
+        self.database = database
+        self.poll_interval = poll_interval or 10
+
+    def start(self):
+        """Load the replica and start following the changes of the patients collection, if the replica
+        is enabled and it was not started yet. Called before each request handled by the server"""
+        if self.started or self.enabled is False:
+            return
+        with self._start_lock:
+            if self.started:
+                return
+            stream = None
+            try:
+                # Open the stream before loading the patients, so that no change is missed
+                stream = self.database["patients"].watch(
+                    full_document="updateLookup", max_await_time_ms=MAX_AWAIT_TIME_MS
+                )
+                self.mode = "change_stream"
+            except PyMongoError as err:
+                LOG.info(f"Change streams not available, patient replica updated by polling: {err}")
+                self.mode = "polling"
+
+            self.load(self.database)
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._follow,
+                args=(self.database, stream),
+                name="patient-replica",
+                daemon=True,
+            )
+            self._thread.start()
+            self.started = True
+
+    def stop(self):
+        """Stop following the changes of the patients collection and empty the replica"""
+        with self._start_lock:
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join(timeout=(self.poll_interval or 0) + MAX_AWAIT_TIME_MS / 1000)
+            self._thread = None
+            self.started = False
+            with self.lock:
+                self.records = {}
+                self.genotype.load([])
+                self.generation = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def load(self, database):
+        """Replace the content of the replica with the patients saved in the database
+
+        Args:
+            database(pymongo.database.Database)
+        """
+        generation = patients_generation(database)
+        records = {
+            patient["_id"]: compact_patient(patient)
+            for patient in database["patients"].find({}, PROJECTION)
+        }
+        with self.lock:
+            self.records = records
+            self.genotype.load(record for record in records.values() if record["genomicFeatures"])
+            self.generation = generation
+        LOG.info(f"Patient replica loaded with {len(records)} patients")
+
+    def add_patient(self, patient):
+        """Add a patient to the replica, or update it if already present
+
+        Args:
+            patient(dict): a patient as saved in the database
+        """
+        record = compact_patient(patient)
+        with self.lock:
+            self.records[record["_id"]] = record
+            self.genotype.add_patient(record)
+
+    def remove_patient(self, patient_id):
+        """Remove a patient from the replica
+
+        Args:
+            patient_id(str): ID of the patient
+        """
+        with self.lock:
+            self.records.pop(patient_id, None)
+            self.genotype.remove_patient(patient_id)
+
+    def update(self, generation, saved=None, removed_ids=None):
+        """Update the replica after patients were saved or removed by this server process
+
+        Args:
+            generation(int): the generation of the patients collection after the change
+            saved(list): patients saved to the database
+            removed_ids(list): IDs of the patients removed from the database
+        """
+        if self.started is False:
+            return
+        with self.lock:
+            for patient_id in removed_ids or []:
+                self.remove_patient(patient_id)
+            for patient in saved or []:
+                self.add_patient(patient)
+            if (
+                self.generation is not None
+                and generation == self.generation + 1
+                and (saved is not None or removed_ids is not None)
+            ):
+                self.generation = generation
+            else:
+                # Reloaded by the polling thread. With change streams, all changes are streamed anyway
+                self.generation = None
+
+    def apply_change(self, change):
+        """Apply an event of the change stream of the patients collection
+
+        Args:
+            change(dict): a change event, see https://www.mongodb.com/docs/manual/reference/change-events
+
+        Returns:
+            bool: False if the stream was closed because the collection was dropped or renamed
+        """
+        operation = change["operationType"]
+        if operation in ["insert", "replace", "update"]:
+            if change.get("fullDocument"):
+                self.add_patient(change["fullDocument"])
+            else:  # Removed before the update was looked up
+                self.remove_patient(change["documentKey"]["_id"])
+        elif operation == "delete":
+            self.remove_patient(change["documentKey"]["_id"])
+        elif operation in ["drop", "rename", "dropDatabase", "invalidate"]:
+            return False
+        return True
+
+    def _follow(self, database, stream):
+        """Follow the changes of the patients collection until the replica is stopped"""
+        while self._stop.is_set() is False:
+            try:
+                if stream is not None:
+                    self._follow_stream(database, stream)
+                    stream = None
+                elif self.mode == "change_stream":
+                    stream = database["patients"].watch(
+                        full_document="updateLookup", max_await_time_ms=MAX_AWAIT_TIME_MS
+                    )
+                    self.load(database)
+                else:
+                    self._stop.wait(self.poll_interval)
+                    if self.generation != patients_generation(database):
+                        self.load(database)
+            except PyMongoError as err:
+                LOG.warning(f"Error while updating the patient replica: {err}")
+                stream = None
+                self._stop.wait(self.poll_interval)
+
+    def _follow_stream(self, database, stream):
+        with stream:
+            while self._stop.is_set() is False and stream.alive:
+                change = stream.try_next()
+                if change is not None and self.apply_change(change) is False:
+                    return  # Collection dropped or renamed, open a new stream and reload
+
+    def patients(self):
+        """Return all patients of the replica
+
+        Returns:
+            patients(list of dict): compact patients
+        """
+        with self.lock:
+            return list(self.records.values())
+
+
+patient_replica = PatientReplica()
+keep_updated(patient_replica)
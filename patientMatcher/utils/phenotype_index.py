@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from patientMatcher.constants import PHENOTYPE_ANCESTORS, PHENOTYPE_INDEX, PHENOTYPE_VERSION
+from patientMatcher.parse.patient import features_to_hpo
+from patientMatcher.utils.generation import patients_changed
+
+LOG = logging.getLogger(__name__)
+
+
+def phenotype_fingerprint(engine, hpo_terms):
+    """Create the phenotype fingerprint of a patient from its HPO terms
+
+    Args:
+        engine(patientMatcher.utils.similarity.SimGICEngine)
+        hpo_terms(list): example ['HP:0100026', 'HP:0009882']
+
+    Returns:
+        fingerprint(dict): example {"version": "3f2a..", "terms": [1250, 2341],
+            "ancestors": [0, 1, 23, .., 1250, 2341], "ic": 12.3} or None if the HPO is not available
+    """
+    if engine.hpo is None or engine.version is None:
+        return None
+    profile = engine.profile(hpo_terms)
+    return {
+        "version": engine.version,
+        "terms": sorted(engine.resolve_terms(hpo_terms)),
+        "ancestors": engine.ancestors(hpo_terms).tolist(),
+        "ic": profile["ic"],
+    }
+
+
+def update_phenotype_fingerprints(database, engine):
+    """Create the phenotype fingerprint of all patients with phenotype features whose fingerprint
+    is missing or was created from other phenotype resource files
+
+    Args:
+        database(pymongo.database.Database)
+        engine(patientMatcher.utils.similarity.SimGICEngine)
+
+    Returns:
+        n_updated(int): number of updated patients
+    """
+    if engine.hpo is None or engine.version is None:
+        return 0
+
+    query = {"features": {"$exists": True, "$ne": []}, PHENOTYPE_VERSION: {"$ne": engine.version}}
+    n_updated = 0
+    for patient in database["patients"].find(query, {"features": 1}):
+        fingerprint = phenotype_fingerprint(engine, features_to_hpo(patient["features"]))
+        result = database["patients"].update_one(
+            {"_id": patient["_id"]}, {"$set": {PHENOTYPE_INDEX: fingerprint}}
+        )
+        n_updated += result.modified_count
+
+    if n_updated:
+        patients_changed(database)
+    LOG.info(f"Phenotype fingerprint updated for {n_updated} patients")
+    return n_updated
+
+
+def create_phenotype_index(database):
+    """Create the database index used to find patients sharing phenotype terms with a query
+
+    Args:
+        database(pymongo.database.Database)
+    """
+    try:
+        database["patients"].create_index(PHENOTYPE_ANCESTORS)
+    except Exception as err:
+        LOG.warning(f"Could not create the phenotype index of the patients collection: {err}")
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+import functools
+import logging
+import time
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# Number of candidate patients scored at the same time. Keeps the temporary
+# (patients x bytes) arrays small when the database contains many patients
+CHUNK_SIZE = 1024
+
+# Number of candidate patient profiles kept in memory between queries
+PROFILE_CACHE_SIZE = 10000
+
+# Number of rows of the most informative common ancestor (MICA) table kept in memory. Each row
+# contains the IC of the MICA of an HPO term and every term of the ontology
+MICA_CACHE_SIZE = 128
+
+# The 8 bits of each possible byte value, most significant bit first (like numpy.packbits)
+BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.float64)
+
+
+def byte_information_content(ic):
+    """Create a lookup table with the summed information content of the terms encoded by any byte
+    of a packed bit vector: table[i][b] = IC of the terms encoded by value b at byte position i
+
+    Args:
+        ic(numpy.ndarray): information content of each HPO term, by term index
+
+    Returns:
+        table(numpy.ndarray): 2D array of float64 with shape (number of bytes, 256)
+    """
+    n_bytes = (len(ic) + 7) // 8
+    padded_ic = np.zeros(n_bytes * 8, dtype=np.float64)
+    padded_ic[: len(ic)] = ic
+    return padded_ic.reshape(n_bytes, 8) @ BYTE_BITS.T
+
+
+class PhenotypeEngine:
+    """Base class of the engines computing the phenotype similarity between a query patient and
+    many database patients at once.
+
+    Every HPO term of the ontology has a dense integer index (HPNode.index). Engines compare
+    phenotype profiles: the HPO terms of a patient resolved and preprocessed once, so that they can
+    be reused for all the comparisons involving the patient.
+    """
+
+    name = None
+    # True if the score of a patient can't be higher than the summed information content of the
+    # query ancestors shared with the patient divided by the information content of the query
+    supports_pruning = False
+
+    def __init__(self):
+        self.hpo = None
+        self.version = None
+
+    def init_app(self, hpo, hpoic, cache=None, version=None):
+        """Index the HPO terms and their information content when the app is launched
+
+        Args:
+            hpo(patientMatcher.utils.hpo.HPO)
+            hpoic(patientMatcher.utils.hpo.HPOIC)
+            cache(dict): a compiled ontology. If provided, the information content is read from it
+            version(str): checksum of the phenotype resource files the ontology was created from
+        """
+        self.hpo = hpo
+        self.version = version
+        self.n_terms = len(hpo)
+
+        if cache:
+            self.term_ic = np.nan_to_num(cache["ic"])
+        else:
+            self.term_ic = np.zeros(self.n_terms, dtype=np.float64)
+            for node in hpo.terms:
+                self.term_ic[node.index] = hpoic.term_ic.get(node, 0)
+        self._init_engine(cache)
+        # Profiles depend on the ontology, so they are memoized again every time the app is launched
+        self._candidate_profile = functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)(self._profile)
+        LOG.info(f"{self.name} engine initialized with {self.n_terms} HPO terms")
+
+    def _init_engine(self, cache):
+        """Precompute the data used by the engine"""
+        pass
+
+    def resolve_terms(self, term_ids):
+        """Return the indexes of the HPO terms in a list of HPO term IDs, skipping unknown terms
+
+        Args:
+            term_ids(list): example ['HP:0100026', 'HP:0009882']
+
+        Returns:
+            indexes(set): a set of term indexes
+        """
+        return set(self.hpo.term_indexes(term_ids or []))
+
+    def profile(self, term_ids):
+        """Compute the phenotype profile of a patient, to be reused for all the comparisons
+        involving the patient
+
+        Args:
+            term_ids(list): example ['HP:0100026', 'HP:0009882']
+
+        Returns:
+            profile(dict)
+        """
+        return self._profile(tuple(sorted(set(term_ids or []))))
+
+    def _profile(self, term_ids):
+        raise NotImplementedError
+
+    def candidate_profile(self, term_ids):
+        """Return the phenotype profile of a database patient, memoized by HPO terms. A patient
+        whose terms are updated gets a new profile, while the old one is eventually discarded.
+
+        Args:
+            term_ids(list): example ['HP:0100026', 'HP:0009882']
+
+        Returns:
+            profile(dict)
+        """
+        return self._candidate_profile(tuple(sorted(set(term_ids or []))))
+
+    def _valid_fingerprint(self, fingerprint):
+        """Return True if a saved fingerprint was created from the ontology used by the engine"""
+        return (
+            bool(fingerprint)
+            and self.version is not None
+            and (fingerprint.get("version") == self.version)
+        )
+
+    def stored_profile(self, fingerprint):
+        """Create the phenotype profile of a patient from the fingerprint saved with the patient
+
+        Args:
+            fingerprint(dict): a fingerprint created by patientMatcher.utils.phenotype_index
+
+        Returns:
+            profile(dict): None if the saved fingerprint was created from a different ontology
+        """
+        raise NotImplementedError
+
+    def score(self, query, candidates_terms):
+        """Compute the phenotype similarity between a query patient and a list of patients
+
+        Args:
+            query(dict or list): phenotype profile or HPO term IDs of the query patient
+            candidates_terms(list): a list of lists of HPO term IDs (or of phenotype profiles),
+                one for each patient to compare
+
+        Returns:
+            scores(numpy.ndarray): scores from 0 (no similarity) to 1 (same phenotype)
+        """
+        scores = np.zeros(len(candidates_terms), dtype=np.float64)
+        if not candidates_terms:
+            return scores
+
+        if not isinstance(query, dict):
+            query = self.profile(query)
+
+        for start in range(0, len(candidates_terms), CHUNK_SIZE):
+            chunk = [
+                terms if isinstance(terms, dict) else self.candidate_profile(terms)
+                for terms in candidates_terms[start : start + CHUNK_SIZE]
+            ]
+            scores[start : start + len(chunk)] = self._score_chunk(query, chunk)
+
+        return scores
+
+    def _score_chunk(self, query, profiles):
+        raise NotImplementedError
+
+
+class SimGICEngine(PhenotypeEngine):
+    """Compute simGIC similarity scores between a query patient and many database patients at once.
+
+    The ancestors of the phenotype terms of a patient are encoded as a packed bit vector over the
+    term indexes, so that the terms shared by two patients are obtained with a bitwise AND, and
+    their information content with a weighted popcount.
+    """
+
+    name = "simGIC"
+    supports_pruning = True
+
+    def _init_engine(self, cache):
+        self.n_bytes = (self.n_terms + 7) // 8
+        if cache:
+            self.byte_ic = cache["byte_ic"]
+        else:
+            self.byte_ic = byte_information_content(self.term_ic)
+        self._byte_positions = np.arange(self.n_bytes)
+
+    def fingerprint(self, term_ids):
+        """Encode the ancestors of a list of HPO terms into a packed bit vector
+
+        Args:
+            term_ids(list): example ['HP:0100026', 'HP:0009882']
+
+        Returns:
+            fingerprint(numpy.ndarray): array of uint8 with n_bytes elements
+        """
+        bits = np.zeros(self.n_bytes * 8, dtype=bool)
+        for index in self.resolve_terms(term_ids):
+            bits[self.hpo.ancestor_indexes(index)] = True
+        return np.packbits(bits)
+
+    def ancestors(self, term_ids):
+        """Return the indexes of the ancestors of a list of HPO terms (terms themselves included)
+
+        Args:
+            term_ids(list): example ['HP:0100026', 'HP:0009882']
+
+        Returns:
+            indexes(numpy.ndarray): sorted array of term indexes
+        """
+        return np.flatnonzero(np.unpackbits(self.fingerprint(term_ids)))
+
+    def _profile(self, term_ids):
+        """The profile contains the fingerprint of the patient and its information content"""
+        fingerprint = self.fingerprint(term_ids)
+        fingerprint.flags.writeable = False  # profiles are shared by queries
+        return {"fingerprint": fingerprint, "ic": float(self.information_content(fingerprint))}
+
+    def stored_profile(self, fingerprint):
+        if not self._valid_fingerprint(fingerprint):
+            return None
+        bits = np.zeros(self.n_bytes * 8, dtype=bool)
+        bits[fingerprint["ancestors"]] = True
+        return {"fingerprint": np.packbits(bits), "ic": fingerprint["ic"]}
+
+    def informative_ancestors(self, profile):
+        """Return the ancestors of the HPO terms of a phenotype profile having an information
+        content greater than 0, the most informative first
+
+        Args:
+            profile(dict): a profile returned by the profile method
+
+        Returns:
+            ancestors(list): a list of tuples (HPO term index, information content)
+        """
+        indexes = np.flatnonzero(np.unpackbits(profile["fingerprint"]))
+        ic = self.term_ic[indexes]
+        return [
+            (int(indexes[i]), float(ic[i])) for i in np.argsort(-ic, kind="stable") if ic[i] > 0
+        ]
+
+    def information_content(self, fingerprints):
+        """Return the summed information content of the terms set in one or more fingerprints
+
+        Args:
+            fingerprints(numpy.ndarray): a fingerprint or a 2D array of fingerprints (one per row)
+
+        Returns:
+            ic(float or numpy.ndarray)
+        """
+        return self.byte_ic[self._byte_positions, fingerprints].sum(axis=-1)
+
+    def _score_chunk(self, query, profiles):
+        fingerprints = np.vstack([profile["fingerprint"] for profile in profiles])
+        candidates_ic = np.array([profile["ic"] for profile in profiles])
+        common_ic = self.information_content(fingerprints & query["fingerprint"])  # min
+        all_ic = query["ic"] + candidates_ic - common_ic  # max
+        return np.divide(common_ic, all_ic, out=np.zeros_like(common_ic), where=all_ic > 0)
+
+
+simgic = SimGICEngine()
+
+
+class JaccardEngine(SimGICEngine):
+    """Compute the Jaccard index of the ancestors of the HPO terms of two patients: the number of
+    shared ancestors divided by the number of ancestors of any of the patients. This is simGIC
+    computed as if every HPO term had an information content of 1.
+    """
+
+    name = "Jaccard"
+
+    def _init_engine(self, cache):
+        self.term_ic = np.ones(self.n_terms, dtype=np.float64)
+        super()._init_engine(None)
+
+    def stored_profile(self, fingerprint):
+        profile = super().stored_profile(fingerprint)
+        if profile:
+            profile["ic"] = float(len(fingerprint["ancestors"]))
+        return profile
+
+
+class BestMatchAverageEngine(PhenotypeEngine):
+    """Base class of the engines comparing each HPO term of a patient to the most similar HPO term
+    of the other patient (best-match average, BMA).
+
+    The similarity of two terms is based on the information content of their most informative
+    common ancestor (MICA). Rows of the MICA table are computed for the terms of a query patient
+    and memoized, so that the similarity between the query terms and all the terms of many patients
+    is obtained with a single lookup.
+    """
+
+    def _init_engine(self, cache):
+        # Descendants of each term (the term included), obtained transposing the ancestors table
+        indptr, indices = self.hpo.ancestors_indptr, self.hpo.ancestors_indices
+        terms = np.repeat(np.arange(self.n_terms, dtype=np.int32), np.diff(indptr))
+        self.descendants_indices = terms[np.argsort(indices, kind="stable")]
+        self.descendants_indptr = np.zeros(self.n_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=self.n_terms), out=self.descendants_indptr[1:])
+        self.max_ic = float(self.term_ic.max()) if self.n_terms else 0
+        self._mica_row = functools.lru_cache(maxsize=MICA_CACHE_SIZE)(self._mica_ic)
+
+    def _mica_ic(self, index):
+        """Return the IC of the MICA of a term and of each term of the ontology
+
+        Args:
+            index(int): index of an HPO term
+
+        Returns:
+            row(numpy.ndarray): array of float64 with n_terms elements
+        """
+        row = np.zeros(self.n_terms, dtype=np.float64)
+        for ancestor in self.hpo.ancestor_indexes(index):
+            descendants = self.descendants_indices[
+                self.descendants_indptr[ancestor] : self.descendants_indptr[ancestor + 1]
+            ]
+            row[descendants] = np.maximum(row[descendants], self.term_ic[ancestor])
+        row.flags.writeable = False
+        return row
+
+    def _profile(self, term_ids):
+        """The profile contains the indexes of the HPO terms of the patient"""
+        return {"terms": np.array(sorted(self.resolve_terms(term_ids)), dtype=np.int64)}
+
+    def stored_profile(self, fingerprint):
+        if not self._valid_fingerprint(fingerprint):
+            return None
+        return {"terms": np.array(fingerprint["terms"], dtype=np.int64)}
+
+    def term_similarity(self, query_terms, candidate_terms, mica_ic):
+        """Return the similarity of each query term with each candidate term
+
+        Args:
+            query_terms(numpy.ndarray): indexes of Q query terms
+            candidate_terms(numpy.ndarray): indexes of C candidate terms
+            mica_ic(numpy.ndarray): Q x C array with the IC of the MICA of each pair of terms
+
+        Returns:
+            similarity(numpy.ndarray): Q x C array of similarity values between 0 and 1
+        """
+        raise NotImplementedError
+
+    def _score_chunk(self, query, profiles):
+        scores = np.zeros(len(profiles), dtype=np.float64)
+        query_terms = query["terms"]
+        lengths = np.array([len(profile["terms"]) for profile in profiles])
+        matched = lengths > 0
+        if len(query_terms) == 0 or not matched.any():
+            return scores
+
+        mica = np.vstack([self._mica_row(int(index)) for index in query_terms])
+        candidate_terms = np.concatenate([profile["terms"] for profile in profiles])
+        similarity = self.term_similarity(query_terms, candidate_terms, mica[:, candidate_terms])
+
+        # Patients without terms don't have any column, so they are skipped by reduceat
+        offsets = np.concatenate([[0], np.cumsum(lengths[matched])[:-1]])
+        query_best = np.maximum.reduceat(similarity, offsets, axis=1).mean(axis=0)
+        candidate_best = np.add.reduceat(similarity.max(axis=0), offsets) / lengths[matched]
+        scores[matched] = (query_best + candidate_best) / 2
+        return scores
+
+
+class ResnikEngine(BestMatchAverageEngine):
+    """Resnik best-match average. The similarity of two terms is the IC of their MICA, divided by
+    the highest IC of the ontology to obtain scores between 0 and 1.
+    """
+
+    name = "Resnik"
+
+    def term_similarity(self, query_terms, candidate_terms, mica_ic):
+        if self.max_ic == 0:
+            return np.zeros_like(mica_ic)
+        return mica_ic / self.max_ic
+
+
+class LinEngine(BestMatchAverageEngine):
+    """Lin best-match average. The similarity of two terms is twice the IC of their MICA divided
+    by the sum of the IC of the two terms.
+    """
+
+    name = "Lin"
+
+    def term_similarity(self, query_terms, candidate_terms, mica_ic):
+        terms_ic = self.term_ic[query_terms][:, None] + self.term_ic[candidate_terms][None, :]
+        return np.divide(
+            2 * mica_ic, terms_ic, out=np.zeros(mica_ic.shape, dtype=np.float64), where=terms_ic > 0
+        )
+
+
+ENGINES = {
+    "simgic": SimGICEngine,
+    "resnik": ResnikEngine,
+    "lin": LinEngine,
+    "jaccard": JaccardEngine,
+}
+
+
+class PhenotypeSimilarity:
+    """The phenotype similarity engine used for matching, selected with the PHENOTYPE_SIMILARITY
+    parameter of the config file"""
+
+    def __init__(self):
+        self.engine = None
+
+    def init_app(self, name, simgic, hpoic, cache=None):
+        """Select and initialize the phenotype similarity engine when the app is launched
+
+        Args:
+            name(str): one of the keys of ENGINES. Default: simgic
+            simgic(SimGICEngine): an initialized simGIC engine, also used to create fingerprints
+            hpoic(patientMatcher.utils.hpo.HPOIC)
+            cache(dict): a compiled ontology
+        """
+        name = (name or "simgic").lower()
+        if name not in ENGINES:
+            LOG.warning(f"Unknown phenotype similarity engine '{name}', using simgic instead")
+            name = "simgic"
+        if name == "simgic":
+            self.engine = simgic
+            return
+        self.engine = ENGINES[name]()
+        self.engine.init_app(simgic.hpo, hpoic, cache, simgic.version)
+
+
+similarity = PhenotypeSimilarity()
+
+
+def benchmark(engine, patients_terms, repeats=1):
+    """Measure how many patients per second an engine compares, scoring a list of patients
+    against themselves
+
+    Args:
+        engine(PhenotypeEngine): an initialized engine
+        patients_terms(list): a list of lists of HPO term IDs, one for each patient
+        repeats(int): number of times the patients are compared
+
+    Returns:
+        throughput(float): number of comparisons per second
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for terms in patients_terms:
+            engine.score(engine.profile(terms), patients_terms)
+    elapsed = time.perf_counter() - start
+    return repeats * len(patients_terms) ** 2 / elapsed if elapsed else 0
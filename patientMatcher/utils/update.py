@@ -1,22 +1,61 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
+import tempfile
+import time
 
 import requests
 from clint.textui import progress
-from patientMatcher.constants import PHENOTYPE_TERMS
+from patientMatcher.constants import GENE_TERMS, LIFTOVER_CHAINS, PHENOTYPE_TERMS
+from patientMatcher.parse.patient import variant_key
+from patientMatcher.utils.gene import ensembl_to_symbol, entrez_to_symbol, symbol_to_ensembl
+from patientMatcher.utils.variant import liftover
 
 LOG = logging.getLogger(__name__)
 
+DOWNLOAD_TIMEOUT = 60  # max seconds waited for each chunk of a resource file
+RESOURCES_MAX_AGE = 604800  # seconds after which resource files are downloaded again at startup
 
-def update_resources(test=True):
-    """Download phenotype files necessary to perform phenotype matching"""
 
-    for key, item in PHENOTYPE_TERMS.items():
+def _is_fresh(path, max_age):
+    """Check that a resource file exists and it was downloaded less than max_age seconds ago"""
+    try:
+        return time.time() - os.path.getmtime(path) < max_age
+    except OSError:  # missing file
+        return False
+
+
+def update_resources(test=True, resources=None, max_age=None):
+    """Download phenotype files necessary to perform phenotype matching, the gene identifiers
+    used to convert genes of genomic features and the chain files used to lift variants.
+
+    Files are written to a temporary file first and moved into place once downloaded, so that other
+    server processes never read a partially written resource.
+
+    Args:
+        test(bool): if True files are checked but not downloaded
+        resources(dict): resources to download, by default all resources
+        max_age(int): if provided, files downloaded less than max_age seconds ago are not updated
+    """
+    if resources is None:
+        resources = {**PHENOTYPE_TERMS, **GENE_TERMS, **LIFTOVER_CHAINS}
+
+    for key, item in resources.items():
         destination = item["resource_path"]
         url = item["url"]
 
-        r = requests.get(url, stream=True)
-        total_length = int(r.headers.get("content-length"))
+        if max_age is not None and _is_fresh(destination, max_age):
+            LOG.debug(f"File {key} is up to date")
+            continue
+
+        try:
+            r = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        except requests.RequestException as ex:
+            LOG.warning(f"File {key} could not be downloaded from {url}, keeping local file: {ex}")
+            continue
+        # Length is unknown for chunked or compressed responses
+        content_length = r.headers.get("content-length")
+        total_length = int(content_length) if content_length is not None else None
 
         if total_length == 0:  # read file and get its size
             LOG.warning(f"Could not verify file {key} at the requested url:{url}")
@@ -25,11 +64,67 @@ def update_resources(test=True):
             LOG.warning(f"File {key} has a length of {total_length}")
             continue
 
-        with open(destination, "wb") as f:  # overwrite file
-            for chunk in progress.bar(
-                r.iter_content(chunk_size=1024), expected_size=(total_length / 1024) + 1
-            ):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
+        tmp_file = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(destination), prefix=".tmp-", delete=False
+        )
+        try:
+            with tmp_file as f:
+                chunks = r.iter_content(chunk_size=1024)
+                if total_length:
+                    chunks = progress.bar(chunks, expected_size=(total_length / 1024) + 1)
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+            os.chmod(tmp_file.name, 0o644)
+            os.replace(tmp_file.name, destination)
+        except Exception:
+            if os.path.exists(tmp_file.name):
+                os.remove(tmp_file.name)
+            raise
         LOG.debug(f"File {key} written to disk")
+
+
+def warm_up_ensembl_cache(database):
+    """Send to the Ensembl REST API the requests needed to convert the genes and lift the variants
+    of all patients in the database, so that their responses are saved in the cache
+
+    Args:
+        database(pymongo.database.Database)
+
+    Returns:
+        n_genes(int), n_variants(int): number of genes and variants sent to the Ensembl REST API
+    """
+    genes = set(database["patients"].distinct("genomicFeatures.gene.id"))
+    symbols = set(database["patients"].distinct("genomicFeatures.gene._geneName"))
+    for gene in genes | symbols:
+        if not gene:
+            continue
+        try:
+            if gene.startswith("ENSG"):
+                ensembl_to_symbol(gene)
+            elif gene.isdigit():
+                entrez_to_symbol(gene)
+            else:
+                symbol_to_ensembl(gene)
+        except Exception as ex:
+            LOG.warning(f"Gene {gene} could not be converted using the Ensembl REST API: {ex}")
+
+    variants = {}
+    for variant in database["patients"].distinct("genomicFeatures.variant"):
+        if variant:
+            variants[variant_key(variant)] = variant
+    for variant in variants.values():
+        try:
+            # Same coordinates used by patientMatcher.parse.patient.lift_variant
+            liftover(
+                variant.get("assembly"),
+                variant.get("referenceName"),
+                variant.get("start") + 1,
+                variant.get("end") + 1 if variant.get("end") else variant.get("end"),
+            )
+        except Exception as ex:
+            LOG.warning(
+                f"Variant {variant_key(variant)} could not be lifted using the Ensembl REST API: {ex}"
+            )
+
+    return len(genes | symbols), len(variants)
@@ -1,5 +1,263 @@
 # -*- coding: utf-8 -*-
+import gzip
+import logging
+import os
+import tempfile
+
+import numpy as np
 import patientMatcher.utils.ensembl_rest_client as ensembl_client
+from patientMatcher.constants import LIFTOVER_CHAINS
+from patientMatcher.utils.ontology_cache import TMP_PREFIX, default_cache_dir
+
+LOG = logging.getLogger(__name__)
+
+
+def _chrom_name(chrom):
+    """Convert a UCSC chromosome name to the name used by MatchMaker. Example: 'chrM' -> 'MT'"""
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
+    return "MT" if chrom == "M" else chrom
+
+
+class ChainLiftOver:
+    """Variant liftover between GRCh37 and GRCh38 using UCSC chain files.
+
+    The ungapped blocks of the chains of each chromosome are saved as arrays sorted by start
+    coordinate, so the blocks containing a position are found with a binary search.
+    The arrays parsed from a chain file are saved in a cache directory, so that the following
+    server startups (and the other server workers) load them instead of parsing the file again.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.blocks = {}  # assembly -> chromosome -> dict of arrays
+
+    def init_app(self, chains=None, cache_dir=None):
+        """Load the chain files of both genome builds. Chain files are never downloaded here, they
+        are updated with the command 'pmatcher update resources'
+
+        Args:
+            chains(dict): example {"GRCh37": {"resource_path": "hg19ToHg38.over.chain.gz",
+                "assembly": "GRCh37"}}. Default: the files downloaded with 'pmatcher update resources'
+            cache_dir(str): directory of the parsed chain files. Default: patientMatcher/liftover
+                in the user cache directory
+        """
+        cache_dir = cache_dir or default_cache_dir("liftover")
+        for item in (chains or LIFTOVER_CHAINS).values():
+            path = item["resource_path"]
+            if os.path.isfile(path) is False:
+                LOG.warning(
+                    f"Liftover chain file not found at {path}, variants will be lifted using the Ensembl REST API. Download it with the command 'pmatcher update resources'"
+                )
+                return
+            self.blocks[item["assembly"]] = self._load_chains(path, cache_dir)
+
+        self.loaded = len(self.blocks) == 2
+        LOG.info(f"Loaded liftover chains for {', '.join(self.blocks)}")
+
+    @staticmethod
+    def _cache_path(path, cache_dir):
+        """Return the path of the parsed arrays of a chain file, which changes with the file"""
+        stat = os.stat(path)
+        return os.path.join(
+            cache_dir, f"{os.path.basename(path)}-{stat.st_size}-{stat.st_mtime_ns}.npz"
+        )
+
+    def _load_chains(self, path, cache_dir):
+        """Load the arrays parsed from a chain file from the cache directory, or parse the chain file
+        and save its arrays in the cache directory
+
+        Returns:
+            blocks(dict): chromosome -> dict of arrays, as returned by _parse_chains
+        """
+        cache_path = self._cache_path(path, cache_dir)
+        if os.path.isfile(cache_path):
+            try:
+                blocks = {}
+                with np.load(cache_path) as arrays:
+                    for key in arrays.files:
+                        chrom, column = key.split("/")
+                        blocks.setdefault(chrom, {})[column] = arrays[key]
+                LOG.info(f"Loaded parsed liftover chains from {cache_path}")
+                return blocks
+            except Exception as ex:
+                LOG.warning(f"Parsed liftover chains at {cache_path} could not be loaded: {ex}")
+
+        blocks = self._parse_chains(path)
+        self._save_chains(blocks, path, cache_path)
+        return blocks
+
+    @staticmethod
+    def _save_chains(blocks, path, cache_path):
+        """Save the arrays parsed from a chain file and remove those parsed from older versions of
+        the same file"""
+        cache_dir = os.path.dirname(cache_path)
+        tmp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first, so that other processes never read a partial file
+            with tempfile.NamedTemporaryFile(
+                dir=cache_dir, prefix=TMP_PREFIX, suffix=".npz", delete=False
+            ) as tmp_file:
+                tmp_path = tmp_file.name
+                np.savez(
+                    tmp_file,
+                    **{
+                        f"{chrom}/{column}": array
+                        for chrom, columns in blocks.items()
+                        for column, array in columns.items()
+                    },
+                )
+            os.chmod(tmp_path, 0o644)  # Readable by all server processes
+            os.replace(tmp_path, cache_path)
+        except Exception as ex:
+            LOG.warning(f"Could not save parsed liftover chains to {cache_dir}: {ex}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        prefix = f"{os.path.basename(path)}-"
+        for item in os.listdir(cache_dir):
+            item_path = os.path.join(cache_dir, item)
+            if item.startswith(prefix) and item_path != cache_path:
+                try:
+                    os.remove(item_path)
+                except OSError:
+                    pass
+        LOG.info(f"Parsed liftover chains saved to {cache_path}")
+
+    @staticmethod
+    def _parse_chains(path):
+        """Parse a chain file (https://genome.ucsc.edu/goldenPath/help/chain.html) into arrays of
+        aligned blocks, grouped by source chromosome
+
+        Returns:
+            blocks(dict): chromosome -> {"start", "end", "max_end", "chain", "target", "target_start",
+                "reverse"} where coordinates are 0-based, half-open
+        """
+        open_chains = gzip.open if path.endswith(".gz") else open
+        targets = []  # target chromosome names, indexed by the "target" array
+        rows = {}  # chromosome -> list of (start, end, chain, target, target_start, reverse)
+        with open_chains(path, "rt") as chain_file:
+            for line in chain_file:
+                fields = line.split()
+                if not fields:
+                    continue
+                if fields[0] == "chain":
+                    chain_id = int(fields[12])
+                    source = rows.setdefault(_chrom_name(fields[2]), [])
+                    t_pos = int(fields[5])
+                    target = _chrom_name(fields[7])
+                    target_size = int(fields[8])
+                    reverse = fields[9] == "-"
+                    q_pos = int(fields[10])
+                    if target not in targets:
+                        targets.append(target)
+                    target_index = targets.index(target)
+                    continue
+                size = int(fields[0])
+                # Alignments to alternate and unplaced contigs are not used by MatchMaker
+                if "_" not in target:
+                    # Coordinates on the reverse strand are converted to the forward strand
+                    q_start = target_size - q_pos - size if reverse else q_pos
+                    source.append((t_pos, t_pos + size, chain_id, target_index, q_start, reverse))
+                if len(fields) == 3:
+                    t_pos += size + int(fields[1])
+                    q_pos += size + int(fields[2])
+
+        blocks = {}
+        for chrom, chrom_rows in rows.items():
+            if not chrom_rows:
+                continue
+            chrom_rows.sort()
+            columns = list(zip(*chrom_rows))
+            end = np.array(columns[1], dtype=np.int64)
+            blocks[chrom] = {
+                "start": np.array(columns[0], dtype=np.int64),
+                "end": end,
+                # Blocks of different chains may overlap. The running maximum of the block ends
+                # tells where to stop when looking back for blocks containing a position
+                "max_end": np.maximum.accumulate(end),
+                "chain": np.array(columns[2], dtype=np.int64),
+                "target": np.array([targets[index] for index in columns[3]]),
+                "target_start": np.array(columns[4], dtype=np.int64),
+                "reverse": np.array(columns[5], dtype=bool),
+            }
+        return blocks
+
+    def _lift_position(self, blocks, position):
+        """Return the positions a 0-based position is mapped to
+
+        Returns:
+            lifted(dict): chain id -> (target chromosome, 0-based target position, reverse)
+        """
+        lifted = {}
+        index = int(np.searchsorted(blocks["start"], position, side="right")) - 1
+        while index >= 0 and blocks["max_end"][index] > position:
+            if blocks["end"][index] > position:
+                offset = position - int(blocks["start"][index])
+                target_start = int(blocks["target_start"][index])
+                reverse = bool(blocks["reverse"][index])
+                size = int(blocks["end"][index] - blocks["start"][index])
+                lifted[int(blocks["chain"][index])] = (
+                    str(blocks["target"][index]),
+                    target_start + size - 1 - offset if reverse else target_start + offset,
+                    reverse,
+                )
+            index -= 1
+        return lifted
+
+    def liftover(self, build, chrom, start, end=None):
+        """Perform variant liftover using the chain files
+
+        Accepts:
+            build(str): genome build: GRCh37 or GRCh38
+            chrom(str): 1-22,X,Y,MT
+            start(int): start coordinate (1-based)
+            stop(int): stop coordinate (1-based) or None
+
+        Returns
+            mappings(list of dict): in the same format of the Ensembl REST API liftover, example:
+                [{"original": {"assembly": "GRCh37", "seq_region_name": "X", "start": 1000000, "end": 1000000, "strand": 1},
+                "mapped": {"assembly": "GRCh38", "seq_region_name": "X", "start": 1039265, "end": 1039265, "strand": 1}}]
+        """
+        blocks = self.blocks.get(build, {}).get(str(chrom))
+        if blocks is None:
+            return []
+        end = end or start
+        assembly2 = "GRCh37" if build == "GRCh38" else "GRCh38"
+        original = {
+            "assembly": build,
+            "seq_region_name": str(chrom),
+            "start": start,
+            "end": end,
+            "strand": 1,
+        }
+
+        # Both ends of the interval must be mapped by the same chain
+        lifted_start = self._lift_position(blocks, start - 1)
+        lifted_end = self._lift_position(blocks, end - 1) if end != start else lifted_start
+        mappings = []
+        for chain_id in sorted(lifted_start.keys() & lifted_end.keys()):
+            target, mapped_start, reverse = lifted_start[chain_id]
+            mapped_end = lifted_end[chain_id][1]
+            mapped_start, mapped_end = sorted([mapped_start, mapped_end])
+            mappings.append(
+                {
+                    "original": original,
+                    "mapped": {
+                        "assembly": assembly2,
+                        "seq_region_name": target,
+                        "start": mapped_start + 1,
+                        "end": mapped_end + 1,
+                        "strand": -1 if reverse else 1,
+                    },
+                }
+            )
+        return mappings
+
+
+chains = ChainLiftOver()
 
 
 def liftover(build, chrom, start, end=None):
@@ -14,6 +272,8 @@ def liftover(build, chrom, start, end=None):
     Returns
         mappings(list of dict):
             example: https://rest.ensembl.org/map/human/GRCh37/X:1000000..1000100:1/GRCh38?content-type=application/json
+            An empty list if the variant has no mapping in the other build, or None if the liftover
+            failed (service not available or invalid response)
     """
     assembly2 = "GRCh38"
     if build == "GRCh38":
@@ -30,5 +290,7 @@ def liftover(build, chrom, start, end=None):
         ]
     )
     result = client.send_request(url)
-    if isinstance(result, dict):
-        return result.get("mappings")
+    # send_request returns the raised exception when the request fails
+    if isinstance(result, dict) is False or isinstance(result.get("mappings"), list) is False:
+        return None
+    return result["mappings"]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from patientMatcher.constants import VARIANT_INDEX, VARIANT_KEYS
+from patientMatcher.parse.patient import lift_variants, variant_key
+from patientMatcher.utils.generation import patients_changed
+
+LOG = logging.getLogger(__name__)
+
+
+def variant_index(gt_features):
+    """Create the canonical keys of the variants of a patient in both genome builds
+
+    Args:
+        gt_features(list): a list of genomic features (objects)
+
+    Returns:
+        index(list of dict): example [{"feature": 0, "key": "37:12:14794076:C:T"},
+            {"feature": 0, "key": "38:12:14641142:C:T"}] or None if a variant couldn't be lifted
+    """
+    features = [
+        (n_feature, feature["variant"])
+        for n_feature, feature in enumerate(gt_features)
+        if feature.get("variant")
+    ]
+    # Lift the variants once here, so that they are never lifted when matching
+    try:
+        lifted_variants = lift_variants([variant for _, variant in features])
+    except Exception as ex:
+        LOG.warning(f"Variants could not be lifted to the other genome build: {ex}")
+        return None
+    # A failed liftover must not be saved as a variant without mappings, or it would never be retried
+    if any(lifted is None for lifted in lifted_variants):
+        LOG.warning("Variants could not be lifted to the other genome build")
+        return None
+
+    index = []
+    for (n_feature, variant), lifted in zip(features, lifted_variants):
+        keys = {variant_key(variant)} | {variant_key(lifted_variant) for lifted_variant in lifted}
+        index.extend({"feature": n_feature, "key": key} for key in sorted(keys))
+    return index
+
+
+def features_variant_keys(db_patient_features, db_variant_index):
+    """Return the keys of the variants of each genomic feature of a database patient
+
+    Args:
+        db_patient_features(list of dictionaries): genomic features of a patient in patientMatcher database
+        db_variant_index(list of dictionaries): canonical keys of the variants of the patient in both
+            genome builds or None if the patient was saved without them
+
+    Returns:
+        features_keys(list of set): the keys of the variant of each feature
+    """
+    if db_variant_index is None:
+        return [
+            {variant_key(feature["variant"])} if feature.get("variant") else set()
+            for feature in db_patient_features
+        ]
+    features_keys = [set() for _ in db_patient_features]
+    for item in db_variant_index:
+        features_keys[item["feature"]].add(item["key"])
+    return features_keys
+
+
+def update_variant_indexes(database, retry_failed=False):
+    """Create the canonical variant keys of all patients with genomic features saved without them.
+    Patients with variants that can't be lifted are saved with empty (None) variant keys, and they
+    are updated again only if retry_failed is True
+
+    Args:
+        database(pymongo.database.Database)
+        retry_failed(bool): if True update also the patients whose variants couldn't be lifted before
+
+    Returns:
+        n_updated(int), n_failed(int): number of updated patients and of patients whose variants
+            couldn't be lifted
+    """
+    query = {"genomicFeatures": {"$exists": True, "$ne": []}}
+    # a None value matches both patients without keys and patients that couldn't be updated
+    query[VARIANT_INDEX] = None if retry_failed else {"$exists": False}
+    n_updated = 0
+    n_failed = 0
+    for patient in database["patients"].find(query, {"genomicFeatures": 1}):
+        index = variant_index(patient["genomicFeatures"])
+        if index is None:
+            n_failed += 1
+        result = database["patients"].update_one(
+            {"_id": patient["_id"]}, {"$set": {VARIANT_INDEX: index}}
+        )
+        if index is not None:
+            n_updated += result.modified_count
+
+    if n_updated:
+        patients_changed(database)
+        LOG.info(f"Variant keys created for {n_updated} patients")
+    if n_failed:
+        LOG.warning(
+            f"Variants of {n_failed} patients could not be lifted to the other genome build"
+        )
+    return n_updated, n_failed
+
+
+def create_variant_index(database):
+    """Create the database index used to find patients carrying the variants of a query
+
+    Args:
+        database(pymongo.database.Database)
+    """
+    try:
+        database["patients"].create_index(VARIANT_KEYS)
+    except Exception as err:
+        LOG.warning(f"Could not create the variant index of the patients collection: {err}")
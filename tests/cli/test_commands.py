@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 from flask_mail import Message
 from patientMatcher.cli.commands import cli
+from patientMatcher.utils.node_health import record_request
+from patientMatcher.utils.similarity import ENGINES
 
 
 def test_appname(mock_app):
@@ -35,3 +37,36 @@ def test_sendemail(mock_app, mock_mail):
     # Make sure that mock mail send method was called and mock email is sent
     assert mock_mail._send_was_called
     assert mock_mail._message
+
+
+def test_benchmark_similarity(mock_app):
+    """Test the command that benchmarks the phenotype similarity engines"""
+    runner = mock_app.test_cli_runner()
+    # When invoking the similarity benchmark command
+    result = runner.invoke(cli, ["test", "similarity", "--repeats", "1"])
+    assert result.exit_code == 0
+    # Then the throughput of every engine should be returned
+    for engine_name in ENGINES:
+        assert f"{engine_name}: " in result.output
+
+
+def test_nodes_health(mock_app, database, test_node):
+    """Test the command showing the health of the connected nodes"""
+
+    # GIVEN a connected node that failed the last request
+    database["nodes"].insert_one(test_node)
+    record_request(database, test_node["_id"], 2.0, "Connection refused")
+
+    runner = mock_app.test_cli_runner()
+    # WHEN invoking the nodes command
+    result = runner.invoke(cli, ["nodes"])
+    assert result.exit_code == 0
+    # THEN the health of the node should be returned
+    assert f"{test_node['_id']}: closed, 1 requests, errors 100%" in result.output
+    assert "last error: Connection refused" in result.output
+
+    # WHEN the health of the node is reset
+    result = runner.invoke(cli, ["nodes", "--reset", test_node["_id"]])
+    assert result.exit_code == 0
+    # THEN its failed requests should be forgotten
+    assert database["node_health"].find_one() is None
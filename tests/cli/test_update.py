@@ -1,6 +1,14 @@
 import responses
 from patientMatcher.cli.commands import cli
-from patientMatcher.constants import PHENOTYPE_TERMS
+from patientMatcher.constants import (
+    GENE_TERMS,
+    LIFTOVER_CHAINS,
+    PHENOTYPE_INDEX,
+    PHENOTYPE_TERMS,
+    VARIANT_INDEX,
+)
+from patientMatcher.server.extensions import ensembl_cache, simgic
+from patientMatcher.utils.ensembl_cache import CACHE_COLLECTION
 
 CONTACT_HREF = "contact.href"
 NEW_NAME = "New Name"
@@ -27,6 +35,29 @@ def test_update_resources(mock_app):
                 stream=True,
             )
 
+    # And a mocked response containing the HGNC gene identifiers
+    responses.add(
+        responses.GET,
+        GENE_TERMS["hgnc_genes"]["url"],
+        body="symbol\tentrez_id\tensembl_gene_id\nKARS1\t3735\tENSG00000065427\n",
+        status=200,
+        content_type="application/octet-stream",
+        auto_calculate_content_length=True,
+        stream=True,
+    )
+
+    # And mocked responses containing the liftover chain files
+    for item in LIFTOVER_CHAINS.values():
+        responses.add(
+            responses.GET,
+            item["url"],
+            body=b"chain 1000 chr1 1000 + 100 200 chr1 1000 + 300 400 1\n100\n",
+            status=200,
+            content_type="application/octet-stream",
+            auto_calculate_content_length=True,
+            stream=True,
+        )
+
     runner = mock_app.test_cli_runner()
 
     # run resources update command with --test flag:
@@ -146,3 +177,99 @@ def test_update_contact_multiple_href_match(mock_app, gpx4_patients):
 
     # THEN no patients contact should be updated
     assert patients_collection.find_one({CONTACT_HREF: ":".join(["mailto", new_href])}) is None
+
+
+def test_update_fingerprints(mock_app, gpx4_patients):
+    """Test the command that updates the phenotype fingerprints of the patients"""
+
+    runner = mock_app.test_cli_runner()
+    patients_collection = mock_app.db.patients
+
+    # GIVEN a database with patients saved without a phenotype fingerprint
+    patients_collection.insert_many(gpx4_patients)
+    assert patients_collection.count_documents({PHENOTYPE_INDEX: {"$exists": True}}) == 0
+
+    # WHEN the fingerprints are updated using the cli
+    result = runner.invoke(cli, ["update", "fingerprints"])
+    assert result.exit_code == 0
+
+    # THEN all patients should have a fingerprint created from the current ontology
+    assert f"updated for {len(gpx4_patients)} patients" in result.output
+    for patient in patients_collection.find():
+        assert patient[PHENOTYPE_INDEX]["version"] == simgic.version
+
+
+def test_update_variant_keys(mock_app, database):
+    """Test the command that creates the variant keys of the patients saved without them"""
+
+    runner = mock_app.test_cli_runner()
+    # GIVEN a patient saved without variant keys
+    variant = {
+        "assembly": "GRCh37",
+        "referenceName": "19",
+        "start": 1105813,
+        "end": 1105813,
+        "referenceBases": "G",
+        "alternateBases": "T",
+    }
+    features = [{"gene": {"id": "ENSG00000167468"}, "variant": variant}]
+    database["patients"].insert_one({"_id": "p1", "genomicFeatures": features})
+
+    # WHEN the variant keys are created using the cli
+    result = runner.invoke(cli, ["update", "variant-keys"])
+    assert result.exit_code == 0
+
+    # THEN the patient should have variant keys
+    assert "Variant keys created for 1 patients" in result.output
+    assert database["patients"].find_one()[VARIANT_INDEX]
+
+
+def test_update_ensembl_cache_disabled(mock_app):
+    """Test the command that warms up the Ensembl cache when the cache is not enabled"""
+    runner = mock_app.test_cli_runner()
+    result = runner.invoke(cli, ["update", "ensembl-cache"])
+    assert "Ensembl cache is not enabled" in result.output
+
+
+@responses.activate
+def test_update_ensembl_cache(mock_app, monkeypatch):
+    """Test the command that warms up the Ensembl cache with the genes and variants of all patients"""
+
+    # GIVEN an enabled Ensembl cache
+    monkeypatch.setattr(ensembl_cache, "collection", mock_app.db[CACHE_COLLECTION])
+    monkeypatch.setattr(ensembl_cache, "ttl", 60)
+
+    # GIVEN a database with a patient with a variant in a gene
+    variant = {
+        "assembly": "GRCh37",
+        "referenceName": "19",
+        "start": 1105812,
+        "end": 1105813,
+        "referenceBases": "G",
+        "alternateBases": "T",
+    }
+    mock_app.db.patients.insert_one(
+        {"_id": "p1", "genomicFeatures": [{"gene": {"id": "ENSG00000167468"}, "variant": variant}]}
+    )
+
+    # GIVEN a mocked Ensembl REST API
+    responses.add(
+        responses.GET,
+        "https://grch37.rest.ensembl.org/lookup/id/ENSG00000167468",
+        json={"display_name": "GPX4"},
+        status=200,
+    )
+    responses.add(
+        responses.GET,
+        "https://grch37.rest.ensembl.org/map/human/GRCh37/19:1105813..1105814/GRCh38?content-type=application/json",
+        json={"mappings": []},
+        status=200,
+    )
+
+    # WHEN the Ensembl cache is updated using the cli
+    runner = mock_app.test_cli_runner()
+    result = runner.invoke(cli, ["update", "ensembl-cache"])
+
+    # THEN the responses for the gene and the variant should be saved in the cache
+    assert "1 genes and 1 variants" in result.output
+    assert mock_app.db[CACHE_COLLECTION].count_documents({}) == 2
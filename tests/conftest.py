@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import mongomock
 import pytest
 import responses
+from patientMatcher.parse import patient as parse_patient
 from patientMatcher.resources import path_to_benchmark_patients
 from patientMatcher.server import create_app
 
@@ -60,6 +64,13 @@ def mock_app(database, pymongo_client):
     return app
 
 
+@pytest.fixture(autouse=True)
+def no_remote_liftover(monkeypatch):
+    """Variants are lifted when patients are saved. Without the local chain files the Ensembl REST API
+    would be called, so tests use a liftover returning no mappings unless they mock it themselves"""
+    monkeypatch.setattr(parse_patient, "liftover", lambda *args: [])
+
+
 @pytest.fixture
 def mock_mail():
     return MockMail()
@@ -307,3 +318,87 @@ def mocked_ensemble_responses():
         )
 
         yield mock
+
+
+class EnsemblStubHandler(BaseHTTPRequestHandler):
+    """Handles requests to a local server mocking the Ensembl REST API"""
+
+    protocol_version = "HTTP/1.1"  # keep connections open
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _record(self):
+        stub = self.server.stub
+        with stub["lock"]:
+            stub["requests"].append((self.command, self.path))
+            stub["ports"].add(self.client_address[1])
+            stub["active"] += 1
+            stub["max_active"] = max(stub["max_active"], stub["active"])
+        time.sleep(0.01)  # simulate network latency
+        with stub["lock"]:
+            stub["active"] -= 1
+
+    def do_GET(self):
+        self._record()
+        stub = self.server.stub
+        if self.path.startswith("/rate-limited"):
+            if self.path not in stub["rate_limited"]:  # first request is refused
+                stub["rate_limited"].add(self.path)
+                self._respond({"error": "Too many requests"}, 429, {"Retry-After": "0.05"})
+                return
+            self._respond({"ok": True})
+        elif self.path.startswith("/xrefs/symbol/homo_sapiens/"):
+            symbol = self.path.split("/")[4].split("?")[0]
+            ensembl_id = HGNC_SYMBOLS_2_ENSEMBL_IDS.get(symbol)
+            self._respond([{"id": ensembl_id, "type": "gene"}] if ensembl_id else [])
+        else:
+            self._respond({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        self._record()
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/lookup/id":
+            symbols = {
+                ensembl_id: symbol for symbol, ensembl_id in HGNC_SYMBOLS_2_ENSEMBL_IDS.items()
+            }
+            self._respond(
+                {
+                    ensembl_id: {"id": ensembl_id, "display_name": symbols[ensembl_id]}
+                    if ensembl_id in symbols
+                    else None
+                    for ensembl_id in payload["ids"]
+                }
+            )
+        else:
+            self._respond({"error": "Not found"}, 404)
+
+
+@pytest.fixture
+def ensembl_stub_server():
+    """Runs a local server mocking the Ensembl REST API and returns its URL and the received requests"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EnsemblStubHandler)
+    server.stub = {
+        "lock": threading.Lock(),
+        "requests": [],
+        "ports": set(),
+        "active": 0,
+        "max_active": 0,
+        "rate_limited": set(),
+    }
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    server.stub["url"] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server.stub
+    server.shutdown()
+    server.server_close()
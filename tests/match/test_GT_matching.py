@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import responses
+from patientMatcher.constants import VARIANT_KEYS
 from patientMatcher.match.genotype_matcher import match
+from patientMatcher.parse import patient as parse_patient
 from patientMatcher.parse.patient import mme_patient
+from patientMatcher.utils.add import backend_add_patient
 
 
 @responses.activate
@@ -78,3 +81,55 @@ def test_genotype_matching(database, gpx4_patients):
     matches = match(database, gt_features, 0.5)
     # same patients should be returned, because of gene matching instead
     assert len(matches.keys()) == 2
+
+
+def test_genotype_matching_variant_keys(database, monkeypatch):
+    """Test that variants are lifted when patients are saved and not when they are matched"""
+
+    # GIVEN a mocked liftover, counting its calls
+    lifted = []
+
+    def mock_lift_variant(variant):
+        lifted.append(variant)
+        return [
+            dict(
+                variant, assembly="GRCh38", start=variant["start"] + 1000, end=variant["end"] + 1000
+            )
+        ]
+
+    monkeypatch.setattr(parse_patient, "lift_variant", mock_lift_variant)
+
+    # GIVEN a database with 2 patients saved with variants in genome build 37
+    variant = {
+        "assembly": "GRCh37",
+        "referenceName": "19",
+        "start": 1105813,
+        "end": 1105813,
+        "referenceBases": "G",
+        "alternateBases": "T",
+    }
+    other_variant = dict(variant, start=1, end=1)
+    for patient_id, patient_variant in [("p1", variant), ("p2", other_variant)]:
+        patient = {
+            "_id": patient_id,
+            "genomicFeatures": [{"gene": {"id": "ENSG00000167468"}, "variant": patient_variant}],
+        }
+        backend_add_patient(database, patient)
+    assert len(lifted) == 2
+    assert database["patients"].find_one({VARIANT_KEYS: "38:19:1106813:G:T"})["_id"] == "p1"
+
+    # WHEN a query patient with the first variant in genome build 38 is matched against the database
+    query_variant = dict(variant, assembly="GRCh38", start=1106813, end=1106813)
+    query_features = [{"gene": {"id": "ENSG00000167468"}, "variant": query_variant}]
+    matches = match(database, query_features, 0.5)
+
+    # THEN the query variant should not be lifted
+    assert len(lifted) == 2
+    # And the patient with the same variant in the other genome build should get the highest score
+    assert matches["p1"]["geno_score"] == 0.5
+    # While the patient with a variant in the same gene should get a lower score
+    assert matches["p2"]["geno_score"] == 0.125
+
+    # And the patient should be found by variant even without gene
+    query_features[0]["gene"]["id"] = ""
+    assert list(match(database, query_features, 0.5)) == ["p1"]
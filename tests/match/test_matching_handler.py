@@ -1,9 +1,34 @@
 # -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
 import requests
 import responses
-from patientMatcher.match.handler import external_matcher, internal_matcher
+from patientMatcher.match import genotype_matcher, handler
+from patientMatcher.match.handler import external_matcher, internal_matcher, top_matches
+from patientMatcher.parse import patient as parse_patient
 from patientMatcher.parse.patient import mme_patient
+from patientMatcher.server.extensions import genotype_index
 from patientMatcher.utils.add import backend_add_patient
+from patientMatcher.utils.node_health import FAILURE_THRESHOLD, HEALTH_COLLECTION, record_request
+
+
+class MockNodeResponse(object):
+    """Streamed response of a connected node, sending its JSON content in chunks"""
+
+    def __init__(self, content, chunk_delay=0):
+        self.status_code = 200
+        self.content = json.dumps(content).encode()
+        self.chunk_delay = chunk_delay
+
+    def iter_content(self, chunk_size):
+        for position in range(0, len(self.content), 100):
+            time.sleep(self.chunk_delay)
+            yield self.content[position : position + 100]
+
+    def close(self):
+        pass
 
 
 @responses.activate
@@ -131,21 +156,346 @@ def test_external_matching(database, test_node, gpx4_patients, monkeypatch):
     inserted_ids = backend_add_patient(mongo_db=database, patient=patient, match_external=False)
     assert inserted_ids
 
-    class MockResponse(object):
-        def __init__(self):
-            self.status_code = 200
-
-        def json(self):
-            resp = {"disclaimer": "This is a test disclaimer", "results": gpx4_patients}
-            return resp
-
     def mock_response(*args, **kwargs):
-        return MockResponse()
+        return MockNodeResponse(
+            {"disclaimer": "This is a test disclaimer", "results": gpx4_patients}
+        )
 
-    monkeypatch.setattr(requests, "request", mock_response)
+    monkeypatch.setattr(requests.Session, "request", mock_response)
 
     ext_m_result = external_matcher(database, patient, test_node["_id"])
     assert isinstance(ext_m_result, dict)
     assert ext_m_result["data"]["patient"]["id"] == patient["id"]
     assert ext_m_result["has_matches"] == True
     assert ext_m_result["match_type"] == "external"
+
+
+def test_external_matching_timeout(database, test_node, gpx4_patients, monkeypatch):
+    """Test that nodes are matched concurrently and nodes not responding in time are reported as errors"""
+
+    # GIVEN 2 connected nodes, one of them responding too slowly
+    slow_node = dict(test_node, _id="slow_node", matching_url="https://slow.node/match")
+    database["nodes"].insert_many([test_node, slow_node])
+    monkeypatch.setattr(handler, "EXTERNAL_MATCH_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def mock_response(session, method, url, **kwargs):
+        if url == slow_node["matching_url"]:
+            release.wait(5)
+        return MockNodeResponse({"results": gpx4_patients})
+
+    monkeypatch.setattr(requests.Session, "request", mock_response)
+
+    # WHEN matching a patient against the nodes
+    start = time.time()
+    ext_m_result = external_matcher(database, gpx4_patients[0])
+    release.set()
+
+    # THEN the results of the fast node should be returned without waiting for the slow one
+    assert time.time() - start < 2
+    assert [result["node"]["id"] for result in ext_m_result["results"]] == [test_node["_id"]]
+    assert ext_m_result["has_matches"] is True
+    # AND the slow node should be reported as an error
+    assert len(ext_m_result["errors"]) == 1
+    assert ext_m_result["errors"][0]["node"]["id"] == "slow_node"
+
+
+def test_external_matching_timeout_health(database, test_node, gpx4_patients, monkeypatch):
+    """Test that a node not responding in time is recorded as failed, also if it responds later"""
+
+    # GIVEN a connected node responding after the match timeout
+    database["nodes"].insert_one(test_node)
+    monkeypatch.setattr(handler, "EXTERNAL_MATCH_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def mock_response(*args, **kwargs):
+        release.wait(5)
+        return MockNodeResponse({"results": gpx4_patients})
+
+    monkeypatch.setattr(requests.Session, "request", mock_response)
+    finished = threading.Event()
+    match_node = handler._match_node
+
+    def tracked_match_node(*args):
+        try:
+            return match_node(*args)
+        finally:
+            finished.set()
+
+    monkeypatch.setattr(handler, "_match_node", tracked_match_node)
+
+    # WHEN matching a patient against the node
+    ext_m_result = external_matcher(database, gpx4_patients[0])
+    assert ext_m_result["errors"][0]["error"].startswith("Timeout")
+    # AND the node responds afterwards
+    release.set()
+    assert finished.wait(5)
+
+    # THEN only the timeout should be recorded in the health of the node
+    health = database[HEALTH_COLLECTION].find_one({"_id": test_node["_id"]})
+    assert health["failures"] == [True]
+    assert health["last_error"].startswith("Timeout")
+
+
+def test_external_matching_slow_response(database, test_node, gpx4_patients, monkeypatch):
+    """Test that a node must send its whole response within the node timeout"""
+
+    # GIVEN a node sending each chunk of its response in time, but not the whole response
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda *args, **kwargs: MockNodeResponse({"results": gpx4_patients}, chunk_delay=0.05),
+    )
+
+    # WHEN a match request is sent to the node with a timeout shorter than the whole response
+    start = time.time()
+    result_obj, error_obj = handler._match_node(database, test_node, {"patient": {}}, 0.2)
+
+    # THEN the request should stop at the timeout and the node should be reported as an error
+    assert time.time() - start < 1
+    assert result_obj is None
+    assert error_obj["node"]["id"] == test_node["_id"]
+    assert "timeout" in error_obj["error"]
+
+
+def test_external_matching_open_circuit(database, test_node, gpx4_patients, monkeypatch):
+    """Test that no requests are sent to the nodes that failed the last requests"""
+
+    # GIVEN a node that failed repeatedly
+    database["nodes"].insert_one(test_node)
+    for _ in range(FAILURE_THRESHOLD):
+        record_request(database, test_node["_id"], 1.0, "Connection refused")
+
+    def mock_response(*args, **kwargs):
+        raise AssertionError("Request sent to a node with an open circuit")
+
+    monkeypatch.setattr(requests.Session, "request", mock_response)
+
+    # WHEN matching a patient against the connected nodes
+    ext_m_result = external_matcher(database, gpx4_patients[0])
+
+    # THEN the node should be skipped and reported in the errors
+    assert ext_m_result["has_matches"] is False
+    assert ext_m_result["errors"][0]["node"]["id"] == test_node["_id"]
+
+
+def test_external_matching_reused_results(
+    mock_app, database, test_node, gpx4_patients, monkeypatch
+):
+    """Test that nodes are not queried again with an unchanged patient"""
+
+    # GIVEN a connected node returning results, and reusable results
+    database["nodes"].insert_one(test_node)
+    mock_app.config["EXTERNAL_RESULTS_TTL"] = 3600
+    sent = []
+
+    def mock_response(*args, **kwargs):
+        sent.append(kwargs["url"])
+        return MockNodeResponse({"results": gpx4_patients[1:]})
+
+    monkeypatch.setattr(requests.Session, "request", mock_response)
+    patient = mme_patient(gpx4_patients[0])
+
+    with mock_app.app_context():
+        # WHEN the patient is matched against the node
+        first_match = external_matcher(database, dict(patient))
+        # And matched again after its contact was changed
+        edited = dict(patient, contact={"href": "mailto:somebody@test.se", "name": "Somebody"})
+        second_match = external_matcher(database, edited)
+
+        # THEN the node should be queried only once
+        assert sent == [test_node["matching_url"]]
+        # AND the saved results should be returned
+        assert second_match["results"] == first_match["results"]
+        assert second_match["has_matches"] is True
+
+        # WHEN matching is forced
+        external_matcher(database, dict(patient), force=True)
+        # THEN the node should be queried again
+        assert len(sent) == 2
+
+
+def test_internal_matching_genotype_index(database, monkeypatch):
+    """Test genotype matching with the genotype index, reading only the returned patients from the database"""
+
+    # GIVEN a mocked liftover and gene conversion
+    monkeypatch.setattr(parse_patient, "lift_variant", lambda variant: [])
+    monkeypatch.setattr(
+        genotype_matcher,
+        "gtfeatures_to_genes_symbols",
+        lambda features: (["ENSG00000167468"], ["GPX4"]),
+    )
+    # GIVEN a database with 3 patients with a variant in the same gene, indexed
+    monkeypatch.setattr(genotype_index, "enabled", True)
+    variant = {
+        "assembly": "GRCh37",
+        "referenceName": "19",
+        "start": 1105813,
+        "end": 1105813,
+        "referenceBases": "G",
+        "alternateBases": "T",
+    }
+    for patient_id, start in [("p1", 1105813), ("p2", 1), ("p3", 2)]:
+        patient = {
+            "_id": patient_id,
+            "contact": {"name": "Contact Name"},
+            "genomicFeatures": [
+                {
+                    "gene": {"id": "ENSG00000167468"},
+                    "variant": dict(variant, start=start, end=start),
+                }
+            ],
+        }
+        backend_add_patient(database, patient)
+    genotype_index.current(database)
+
+    # GIVEN a database that counts the patients read
+    read_patients = []
+    collection_class = type(database["patients"])
+    find = collection_class.find
+
+    def counting_find(collection, *args, **kwargs):
+        patients = list(find(collection, *args, **kwargs))
+        if collection.name == "patients":
+            read_patients.extend(patient["_id"] for patient in patients)
+        return iter(patients)
+
+    monkeypatch.setattr(collection_class, "find", counting_find)
+
+    # WHEN a genotype-only query is matched returning max 2 results
+    query_patient = {
+        "_id": "query",
+        "genomicFeatures": [{"gene": {"id": "ENSG00000167468"}, "variant": variant}],
+    }
+    match = internal_matcher(database, query_patient, 0.25, 0.75, max_results=2)
+
+    # THEN the patient with the same variant should be the best match
+    results = match["results"][0]["patients"]
+    assert len(results) == 2
+    assert results[0]["patient"]["id"] == "p1"
+    assert results[0]["patient"]["contact"] == {"name": "Contact Name"}
+    assert results[0]["score"]["_genotype"] == 0.75
+    assert results[1]["score"]["_genotype"] == 0.1875
+    # And only the returned patients should be read from the database
+    assert len(read_patients) == 2
+
+
+def test_internal_matching_single_query(mock_app, database, gpx4_patients, monkeypatch):
+    """Test that patients matching by phenotype and genotype are retrieved with a single query,
+    and that only the documents of the returned patients are read"""
+
+    # GIVEN a mocked liftover and gene conversion
+    monkeypatch.setattr(parse_patient, "lift_variant", lambda variant: [])
+    monkeypatch.setattr(
+        genotype_matcher,
+        "gtfeatures_to_genes_symbols",
+        lambda features: ([feature["gene"]["id"] for feature in features], []),
+    )
+    # GIVEN a database with 2 patients with phenotype and genomic features
+    for patient in gpx4_patients:
+        backend_add_patient(database, mme_patient(patient))
+
+    # GIVEN a database that records the queries to the patients collection
+    queries = []
+    collection_class = type(database["patients"])
+    find = collection_class.find
+
+    def recording_find(collection, *args, **kwargs):
+        if collection.name == "patients":
+            queries.append(args)
+        return find(collection, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, "find", recording_find)
+
+    # WHEN one of them is matched returning 1 result
+    query_patient = mme_patient(gpx4_patients[0])
+    match = internal_matcher(database, query_patient, 0.5, 0.5, max_results=1)
+
+    # THEN the best match should have both a phenotype and a genotype score
+    results = match["results"][0]["patients"]
+    assert len(results) == 1
+    assert results[0]["score"]["_phenotype"] > 0
+    assert results[0]["score"]["_genotype"] > 0
+    assert results[0]["patient"]["contact"]
+
+    # AND the patients should be read with one query returning only the fields used for matching
+    candidates_query, projection = queries[0]
+    assert "contact" not in projection
+    # And one query returning the complete document of the best match
+    assert queries[1:] == [({"_id": {"$in": [results[0]["patient"]["id"]]}},)]
+
+
+def test_top_matches():
+    """Test merging phenotype and genotype scores and keeping only the best matches"""
+
+    # GIVEN phenotype and genotype matches, with a patient matching both
+    pheno_matches = {
+        "p1": {"patient_obj": {"_id": "p1"}, "pheno_score": 0.25},
+        "p2": {"patient_obj": None, "pheno_score": 0.1},
+        "p3": {"patient_obj": None, "pheno_score": 0.01},
+    }
+    geno_matches = {
+        "p1": {"patient_obj": None, "geno_score": 0.5},
+        "p4": {"patient_obj": None, "geno_score": 0.125},
+    }
+
+    # THEN the best matches should be returned with their combined score
+    matches = top_matches(pheno_matches, geno_matches, max_results=2)
+    assert [match["_id"] for match in matches] == ["p1", "p4"]
+    assert matches[0]["score"] == {"patient": 0.75, "_genotype": 0.5, "_phenotype": 0.25}
+    assert matches[0]["patient"] == {"_id": "p1"}
+
+    # AND all matches should be returned sorted by score if there is no max number of results
+    matches = top_matches(pheno_matches, geno_matches, max_results=None)
+    assert [match["_id"] for match in matches] == ["p1", "p4", "p2", "p3"]
+
+    # AND matches with a score lower than the threshold should be removed
+    matches = top_matches(pheno_matches, geno_matches, max_results=5, score_threshold=0.1)
+    assert [match["_id"] for match in matches] == ["p1", "p4", "p2"]
+
+
+def test_internal_matching_pruned_phenotype_stage(database, monkeypatch):
+    """Test that the phenotype score is not computed for patients which can't be among the best matches"""
+
+    # GIVEN a mocked gene conversion
+    monkeypatch.setattr(
+        genotype_matcher,
+        "gtfeatures_to_genes_symbols",
+        lambda features: ([feature["gene"]["id"] for feature in features], []),
+    )
+    # GIVEN a mocked phenotype matcher giving the same score to all patients
+    scored = []
+
+    def mock_phenomatch(database, max_score, features, disorders, max_results=None, patients=None):
+        patients = patients or list(database["patients"].find())
+        scored.extend(patient["_id"] for patient in patients)
+        return {
+            patient["_id"]: {"patient_obj": None, "pheno_score": max_score / 2}
+            for patient in patients
+        }
+
+    monkeypatch.setattr(handler, "phenomatch", mock_phenomatch)
+
+    # GIVEN a database with 2 patients sharing a gene with the query patient and 10 patients without genes
+    features = [{"id": "HP:0001250"}]
+    gene = {"gene": {"id": "ENSG00000167468"}}
+    database["patients"].insert_many(
+        [{"_id": f"p{nr}", "features": features, "genomicFeatures": [gene]} for nr in range(2)]
+        + [{"_id": f"p{nr}", "features": features} for nr in range(2, 12)]
+    )
+    query_patient = {"_id": "query", "features": features, "genomicFeatures": [gene]}
+
+    # WHEN all patients are matched
+    all_matches = internal_matcher(database, dict(query_patient), 0.1, 0.9)
+    assert len(scored) == 12
+
+    # WHEN the 2 best matches are requested
+    scored.clear()
+    match = internal_matcher(database, dict(query_patient), 0.1, 0.9, max_results=2)
+
+    # THEN they should be the best of all matches
+    results = match["results"][0]["patients"]
+    assert results == all_matches["results"][0]["patients"][:2]
+    assert [result["patient"]["id"] for result in results] == ["p0", "p1"]
+    # AND the phenotype score of the patients without genes should not be computed
+    assert sorted(scored) == ["p0", "p1"]
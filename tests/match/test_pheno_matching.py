@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from patientMatcher.constants import PHENOTYPE_INDEX
 from patientMatcher.match.phenotype_matcher import match, similarity_wrapper
-from patientMatcher.parse.patient import mme_patient
+from patientMatcher.parse.patient import json_patient, mme_patient
 from patientMatcher.resources import path_to_hpo_terms, path_to_phenotype_annotations
 from patientMatcher.server.extensions import diseases, hpo, hpoic
+from patientMatcher.utils.add import backend_add_patient
+from patientMatcher.utils.hpo import ROOT
 
 PHENOTYPE_ROOT = "HP:0000118"
 
@@ -121,3 +124,51 @@ def test_phenotype_matching(gpx4_patients, database):
     # when either of these phenotype terms is present by itself
     assert len(matches_hpo_omim.keys()) >= len(matches_omim.keys())
     assert len(matches_hpo_omim.keys()) >= len(matches_hpo.keys())
+
+
+def test_phenotype_matching_max_results(mock_app, json_patients, database):
+    """Test that phenotype matching using the phenotype fingerprints returns the same best matches"""
+
+    # GIVEN a database with patients saved with a phenotype fingerprint
+    for patient in json_patients:
+        backend_add_patient(database, mme_patient(patient))
+    saved_patient = database["patients"].find_one({PHENOTYPE_INDEX: {"$exists": True}})
+    assert hpo.term_index(ROOT) in saved_patient[PHENOTYPE_INDEX]["ancestors"]
+
+    # WHEN matching a patient against all patients and against the best 5 patients only
+    features = mme_patient(json_patients[0])["features"]
+    all_matches = match(database, 0.75, features, [])
+    top_matches = match(database, 0.75, features, [], max_results=5)
+
+    # THEN the best 5 matches should be the same
+    assert len(top_matches) < len(all_matches)
+    all_scores = sorted([value["pheno_score"] for value in all_matches.values()], reverse=True)
+    top_scores = sorted([value["pheno_score"] for value in top_matches.values()], reverse=True)
+    assert top_scores[:5] == all_scores[:5]
+
+    # AND the phenotype index should not be returned with the matching patients
+    for value in top_matches.values():
+        assert PHENOTYPE_INDEX not in json_patient(value["patient_obj"])
+
+
+def test_phenotype_matching_max_results_fill(mock_app, json_patients, database):
+    """Test that phenotype matching using the phenotype fingerprints returns max_results matches
+    even if the patients share no informative term with the query, as matching all patients does"""
+
+    # GIVEN a database with patients saved with a phenotype fingerprint
+    for patient in json_patients:
+        backend_add_patient(database, mme_patient(patient))
+
+    # WHEN matching a patient with a term missing from the ontology against the best 5 patients only
+    features = [{"id": "HP:9999999", "observed": "yes"}]
+    all_matches = match(database, 0.75, features, [])
+    top_matches = match(database, 0.75, features, [], max_results=5)
+
+    # THEN 5 patients should be returned, with the same scores of the best 5 matches
+    assert len(all_matches) > 5
+    assert len(top_matches) == 5
+    all_scores = sorted([value["pheno_score"] for value in all_matches.values()], reverse=True)
+    top_scores = sorted([value["pheno_score"] for value in top_matches.values()], reverse=True)
+    assert top_scores == all_scores[:5] == [0.0] * 5
+    # AND the complete patient objects should be returned
+    assert all(value["patient_obj"]["contact"] for value in top_matches.values())
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from patientMatcher.parse import patient
+from patientMatcher.utils import ensembl_rest_client as ensembl_client
+from patientMatcher.utils.gene import GeneTable
 
 
 def test_href_validate_wrong_url():
@@ -79,6 +81,28 @@ def test_mme_patient_entrez_gene(entrez_gene_patient, monkeypatch):
     assert mme_formatted_patient["genomicFeatures"][0]["gene"]["_geneName"]  # it's "KARS"
 
 
+def test_mme_patient_gene_table(entrez_gene_patient, tmp_path, monkeypatch):
+    """Test format a patient with entrez gene using the local HGNC genes table"""
+
+    # GIVEN a gene table loaded from a HGNC complete set file
+    genes_file = tmp_path / "hgnc_complete_set.txt"
+    genes_file.write_text("symbol\tentrez_id\tensembl_gene_id\nKARS1\t3735\tENSG00000065427\n")
+    table = GeneTable()
+    table.init_app(str(genes_file))
+    monkeypatch.setattr(patient, "genes_extension", table)
+
+    # AND the Ensembl web services not available
+    def mock_entrez_to_symbol(*args):
+        raise ConnectionError()
+
+    monkeypatch.setattr(patient, "entrez_to_symbol", mock_entrez_to_symbol)
+
+    # THEN the gene should be converted using the local table
+    mme_formatted_patient = patient.mme_patient(entrez_gene_patient, True)
+    assert mme_formatted_patient["genomicFeatures"][0]["gene"]["id"] == "ENSG00000065427"
+    assert mme_formatted_patient["genomicFeatures"][0]["gene"]["_geneName"] == "KARS1"
+
+
 def test_gtfeatures_to_variants(patient_37, monkeypatch):
     """Test the function that parses variants dictionaries from patient's genomic features"""
 
@@ -110,3 +134,95 @@ def test_gtfeatures_to_variants(patient_37, monkeypatch):
     assert variants[0]["assembly"] == "GRCh37"
     # And one with genome build GRCh38
     assert variants[1]["assembly"] == "GRCh38"
+
+
+def test_variant_key():
+    """Test the canonical keys of variants"""
+    variant = {
+        "assembly": "GRCh37",
+        "referenceName": "chr12",
+        "start": 14794076,
+        "end": 14794076,
+        "referenceBases": "c",
+        "alternateBases": "T",
+    }
+    assert patient.variant_key(variant) == "37:12:14794076:C:T"
+    # Fields order and chromosome naming should not matter
+    assert patient.variant_key(dict(reversed(variant.items()))) == "37:12:14794076:C:T"
+    variant["end"] = 14794080
+    assert patient.variant_key(variant) == "37:12:14794076-14794080:C:T"
+    assert patient.variant_key(None) is None
+
+
+def test_format_genes_batch(ensembl_stub_server, monkeypatch):
+    """Test converting the genes of a patient with batch and concurrent requests to the Ensembl REST API"""
+
+    # GIVEN a local server mocking the Ensembl REST API and no local HGNC genes table
+    monkeypatch.setattr(ensembl_client, "RESTAPI_37", ensembl_stub_server["url"])
+    monkeypatch.setattr(patient, "genes_extension", GeneTable())
+
+    # GIVEN a patient with genes defined by Ensembl IDs and symbols
+    patient_obj = {
+        "genomicFeatures": [
+            {"gene": {"id": "ENSG00000103591"}},
+            {"gene": {"id": "ENSG00000167468"}},
+            {"gene": {"id": "LIMS2"}},
+            {"gene": {"id": "NGLY1"}},
+        ]
+    }
+
+    # WHEN the genes are converted
+    patient.format_genes(patient_obj)
+
+    # THEN all Ensembl IDs should be looked up with one request
+    methods = [method for method, _ in ensembl_stub_server["requests"]]
+    assert methods.count("POST") == 1
+    assert methods.count("GET") == 2
+    # And all genes converted
+    assert [feature["gene"]["id"] for feature in patient_obj["genomicFeatures"]] == [
+        "ENSG00000103591",
+        "ENSG00000167468",
+        "ENSG00000072163",
+        "ENSG00000151092",
+    ]
+    assert [feature["gene"]["_geneName"] for feature in patient_obj["genomicFeatures"]] == [
+        "AAGAB",
+        "GPX4",
+        "LIMS2",
+        "NGLY1",
+    ]
+
+
+def test_genes_resolved_once_per_request(mock_app, monkeypatch):
+    """Test that genes converted when a request is validated are not converted again when matching"""
+
+    # GIVEN a patched gene conversion system counting the requests to the Ensembl web services
+    calls = []
+
+    def mock_symbol_to_ensembl(symbol):
+        calls.append(symbol)
+        return "ENSG00000167468"
+
+    def mock_ensembl_to_symbols(ensembl_ids):
+        calls.extend(ensembl_ids)
+        return {}
+
+    monkeypatch.setattr(patient, "genes_extension", GeneTable())
+    monkeypatch.setattr(patient, "symbol_to_ensembl", mock_symbol_to_ensembl)
+    monkeypatch.setattr(patient, "ensembl_to_symbols", mock_ensembl_to_symbols)
+
+    with mock_app.test_request_context():
+        # WHEN the genes of a patient are converted
+        patient_obj = {"genomicFeatures": [{"gene": {"id": "GPX4"}}]}
+        patient.format_genes(patient_obj)
+        assert calls == ["GPX4"]
+
+        # THEN the converted genes should not be converted again during the same request
+        genes, symbols = patient.gtfeatures_to_genes_symbols(patient_obj["genomicFeatures"])
+        assert (genes, symbols) == (["ENSG00000167468"], ["GPX4"])
+        assert calls == ["GPX4"]
+
+    # While genes should be converted again in a new request
+    with mock_app.test_request_context():
+        patient.gtfeatures_to_genes_symbols(patient_obj["genomicFeatures"])
+        assert calls == ["GPX4", "ENSG00000167468"]
@@ -1,4 +1,5 @@
 from patientMatcher.server.extensions import diseases, hpo
+from patientMatcher.utils.hpo import get_ancestors
 
 
 def test_hpo(mock_app):
@@ -21,6 +22,28 @@ def test_hpo(mock_app):
     assert hpo[obsolete_term]._parent_hps
 
 
+def test_hpo_ancestors(mock_app):
+    """Test the ancestors precomputed for all HPO terms when the app is created"""
+
+    # GIVEN a term of the HPO
+    term = hpo["HP:0008058"]
+
+    # THEN its precomputed ancestors should be the same as those collected by walking the ontology
+    assert term.ancestors() == get_ancestors(term)
+    assert hpo.root in term.ancestors()
+
+    # AND its ancestors should be also available as term indexes
+    assert set(hpo.ancestor_indexes(term.index)) == {
+        ancestor.index for ancestor in term.ancestors()
+    }
+
+    # Terms should be sorted topologically, parents before children
+    assert hpo.terms[0] == hpo.root
+    for node in hpo.terms:
+        for parent in node.parents:
+            assert parent.index < node.index
+
+
 def test_diseases(mock_app):
     """Test the extension handling disease terms"""
 
@@ -6,7 +6,9 @@ from patientMatcher.__version__ import __version__
 from patientMatcher.match.handler import patient_matches
 from patientMatcher.parse.patient import mme_patient
 from patientMatcher.server.controllers import validate_response
+from patientMatcher.server.extensions import matching_queue
 from patientMatcher.utils.add import add_node, backend_add_patient, load_demo_patients
+from patientMatcher.utils.node_health import record_request
 
 ADD_PATIENT_ENDPOINT = "patient/add"
 DELETE_PATIENT_ENDPOINT = "patient/delete/"
@@ -180,6 +182,68 @@ def test_update_patient(mock_app, test_client, gpx4_patients, test_node, databas
     assert len(list(results)) == 2
 
 
+def test_add_patient_matching_queue(mock_app, test_client, gpx4_patients, test_node, database):
+    """Test adding a patient when external matchings are run in the background"""
+
+    # GIVEN a server with a connected node and the matching queue enabled, without worker threads
+    ok_token = test_client["auth_token"]
+    add_node(mongo_db=mock_app.db, obj=test_client, is_client=True)
+    add_node(mongo_db=mock_app.db, obj=test_node, is_client=False)
+    matching_queue.init_app(mock_app, True, workers=0)
+
+    try:
+        # WHEN a patient is added using the add endpoint
+        patient_obj = {"patient": gpx4_patients[1]}
+        response = mock_app.test_client().post(
+            ADD_PATIENT_ENDPOINT, data=json.dumps(patient_obj), headers=auth_headers(ok_token)
+        )
+        assert response.status_code == 200
+
+        # THEN the endpoint should respond with the ID of a queued job, before matching the patient
+        job_id = json.loads(response.data)["job_id"]
+        assert database["matches"].find_one() is None
+        response = mock_app.test_client().get(f"jobs/{job_id}", headers=auth_headers(ok_token))
+        assert json.loads(response.data)["job"]["status"] == "queued"
+
+        # WHEN the job is run in the background
+        with mock_app.app_context():
+            job = matching_queue.run_next()
+
+        # THEN the external matching should be saved
+        assert job["status"] == "done"
+        assert database["matches"].find_one({"_id": job["match_id"]})
+        # AND its status returned by the jobs endpoint
+        response = mock_app.test_client().get(f"jobs/{job_id}", headers=auth_headers(ok_token))
+        assert json.loads(response.data)["job"]["status"] == "done"
+    finally:
+        matching_queue.init_app(mock_app, False)
+
+
+def test_nodes_health(mock_app, database, test_client, test_node):
+    """Test the endpoint returning the health of the connected nodes"""
+
+    # GIVEN a connected node with a recorded request
+    add_node(mongo_db=mock_app.db, obj=test_node, is_client=False)
+    record_request(database, test_node["_id"], 0.5)
+
+    # WHEN the endpoint is called without being authorized
+    response = mock_app.test_client().get("nodes/health")
+    # THEN it should return a 401 status code
+    assert response.status_code == 401
+
+    # WHEN the endpoint is called by an authorized client
+    add_node(mongo_db=mock_app.db, obj=test_client, is_client=True)
+    response = mock_app.test_client().get(
+        "nodes/health", headers=auth_headers(test_client["auth_token"])
+    )
+    # THEN the health of the node should be returned
+    assert response.status_code == 200
+    health = json.loads(response.data)["nodes"]
+    assert health[0]["id"] == test_node["_id"]
+    assert health[0]["state"] == "closed"
+    assert health[0]["latency_p50"] == 0.5
+
+
 def test_metrics(mock_app, database, test_client, demo_data_path, match_objs):
     """Testing viewing the list of patients on server for authorized users"""
 
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+
+import responses
+from patientMatcher.utils import ensembl_rest_client as ensembl_client
+from patientMatcher.utils.ensembl_cache import CACHE_COLLECTION, EnsemblCache
+from patientMatcher.utils.gene import ensembl_to_symbol
+
+URL = "https://grch37.rest.ensembl.org/lookup/id/ENSG00000103591"
+
+
+def test_ensembl_cache_disabled(database):
+    """Test that the Ensembl cache is disabled without a TTL"""
+    cache = EnsemblCache()
+    cache.init_app(database)
+    assert cache.enabled is False
+    cache.set(URL, {"display_name": "AAGAB"})
+    assert cache.get(URL) is None
+
+
+def test_ensembl_cache_get_set(database):
+    """Test saving and reading Ensembl responses"""
+
+    # GIVEN an enabled cache
+    cache = EnsemblCache()
+    cache.init_app(database, ttl=60)
+
+    # THEN saved responses should be returned
+    cache.set(URL, {"display_name": "AAGAB"})
+    assert cache.get(URL) == {"display_name": "AAGAB"}
+    cache.set(URL, [])
+    assert cache.get(URL) == []
+
+    # While expired responses should not
+    database[CACHE_COLLECTION].update_one(
+        {"_id": URL}, {"$set": {"expires": datetime.datetime.now() - datetime.timedelta(seconds=1)}}
+    )
+    assert cache.get(URL) is None
+
+
+def test_ensembl_cache_lru(database):
+    """Test that the least recently used responses are removed when the cache is full"""
+
+    # GIVEN an enabled cache with space for 2 responses
+    cache = EnsemblCache()
+    cache.init_app(database, ttl=60, max_entries=2)
+
+    # WHEN 3 responses are saved, and the first one is read before saving the third
+    # (access times are saved with millisecond precision)
+    cache.set("url1", 1)
+    time.sleep(0.005)
+    cache.set("url2", 2)
+    time.sleep(0.005)
+    assert cache.get("url1") == 1
+    time.sleep(0.005)
+    cache.set("url3", 3)
+
+    # THEN the second response should be removed
+    assert database[CACHE_COLLECTION].count_documents({}) == 2
+    assert cache.get("url2") is None
+    assert cache.get("url1") == 1
+    assert cache.get("url3") == 3
+
+
+@responses.activate
+def test_ensembl_client_cache(database, monkeypatch):
+    """Test that the Ensembl REST API client uses the cache"""
+
+    # GIVEN an enabled cache
+    cache = EnsemblCache()
+    cache.init_app(database, ttl=60)
+    monkeypatch.setattr(ensembl_client, "ensembl_cache", cache)
+
+    # GIVEN a mocked Ensembl REST API
+    responses.add(responses.GET, URL, json={"display_name": "AAGAB"}, status=200)
+
+    # WHEN the same gene is converted twice
+    assert ensembl_to_symbol("ENSG00000103591") == "AAGAB"
+    assert ensembl_to_symbol("ENSG00000103591") == "AAGAB"
+
+    # THEN the Ensembl REST API should be called only once
+    assert len(responses.calls) == 1
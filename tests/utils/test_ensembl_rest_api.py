@@ -84,3 +84,67 @@ def test_send_request_wrong_url():
     )
     data = client.send_request(url)
     assert type(data) == ValueError
+
+
+def test_send_request_connection_pool(ensembl_stub_server):
+    """Test that requests are sent through a pool of persistent connections"""
+
+    # WHEN sending several requests to the Ensembl REST API
+    client = ensembl_api.EnsemblRestApiClient()
+    for _ in range(5):
+        data = client.send_request(f"{ensembl_stub_server['url']}/xrefs/symbol/homo_sapiens/GPX4")
+        assert data[0]["id"] == "ENSG00000167468"
+
+    # THEN they should be sent over the same connection
+    assert len(ensembl_stub_server["requests"]) == 5
+    assert len(ensembl_stub_server["ports"]) == 1
+
+
+def test_send_request_retry_after(ensembl_stub_server):
+    """Test that rate-limited requests are retried after the time requested by the server"""
+
+    client = ensembl_api.EnsemblRestApiClient()
+    data = client.send_request(f"{ensembl_stub_server['url']}/rate-limited")
+
+    # The request should be sent twice, and the second response returned
+    assert data == {"ok": True}
+    assert len(ensembl_stub_server["requests"]) == 2
+
+
+def test_send_requests_concurrent(ensembl_stub_server, mock_symbol_2_ensembl):
+    """Test sending many requests with bounded concurrency"""
+
+    # GIVEN a list of URLs
+    symbols = list(mock_symbol_2_ensembl)[:10]
+    urls = [
+        f"{ensembl_stub_server['url']}/xrefs/symbol/homo_sapiens/{symbol}" for symbol in symbols
+    ]
+
+    # THEN all responses should be returned
+    client = ensembl_api.EnsemblRestApiClient()
+    data = client.send_requests(urls)
+    for symbol, url in zip(symbols, urls):
+        assert data[url][0]["id"] == mock_symbol_2_ensembl[symbol]
+
+    # And the requests should be sent concurrently, using a bounded number of connections
+    assert 1 < ensembl_stub_server["max_active"] <= ensembl_api.MAX_WORKERS
+    assert len(ensembl_stub_server["ports"]) <= ensembl_api.MAX_WORKERS
+
+
+def test_lookup_ids(ensembl_stub_server, monkeypatch):
+    """Test looking up Ensembl IDs with batch requests"""
+
+    # GIVEN batches of 2 IDs
+    monkeypatch.setattr(ensembl_api, "BATCH_SIZE", 2)
+    client = ensembl_api.EnsemblRestApiClient()
+    client.server = ensembl_stub_server["url"]
+
+    # WHEN 3 Ensembl IDs are looked up
+    data = client.lookup_ids(["ENSG00000103591", "ENSG00000167468", "ENSG00000000000"])
+
+    # THEN 2 requests should be sent
+    assert ensembl_stub_server["requests"] == [("POST", "/lookup/id"), ("POST", "/lookup/id")]
+    # And the results of all IDs returned
+    assert data["ENSG00000103591"]["display_name"] == "AAGAB"
+    assert data["ENSG00000167468"]["display_name"] == "GPX4"
+    assert data["ENSG00000000000"] is None
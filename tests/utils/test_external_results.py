@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import copy
+
+from patientMatcher.utils.external_results import content_fingerprint
+
+
+def test_content_fingerprint(gpx4_patients):
+    """Test that the fingerprint of a patient changes only with the content used for matching"""
+    patient = gpx4_patients[0]
+    fingerprint = content_fingerprint(patient)
+
+    # WHEN the contact and the label of the patient are changed
+    edited = copy.deepcopy(patient)
+    edited["contact"]["href"] = "mailto:somebody@test.se"
+    edited["label"] = "A new label"
+    # THEN the fingerprint should be the same
+    assert content_fingerprint(edited) == fingerprint
+
+    # WHEN the order of the features is changed
+    edited["features"].reverse()
+    # THEN the fingerprint should be the same
+    assert content_fingerprint(edited) == fingerprint
+
+    # WHEN a phenotype feature is removed
+    edited["features"].pop()
+    # THEN the fingerprint should change
+    assert content_fingerprint(edited) != fingerprint
@@ -1,7 +1,22 @@
 # -*- coding: utf-8 -*-
 import responses
 from patientMatcher.utils.ensembl_rest_client import requests
-from patientMatcher.utils.gene import ensembl_to_symbol, entrez_to_symbol, symbol_to_ensembl
+from patientMatcher.utils.gene import (
+    GeneTable,
+    ensembl_to_symbol,
+    entrez_to_symbol,
+    symbol_to_ensembl,
+)
+
+HGNC_GENES = "\n".join(
+    [
+        "hgnc_id\tsymbol\tstatus\tprev_symbol\tentrez_id\tensembl_gene_id",
+        'HGNC:6215\tKARS1\tApproved\t"KARS"\t3735\tENSG00000065427',
+        "HGNC:4556\tGPX4\tApproved\t\t2879\tENSG00000167468",
+        'HGNC:1\tGENE1\tApproved\t"OLD|SHARED"\t1\tENSG00000000001',
+        'HGNC:2\tGENE2\tApproved\t"SHARED"\t2\tENSG00000000002',
+    ]
+)
 
 
 @responses.activate
@@ -62,6 +77,7 @@ def test_symbol_to_ensembl_multiple_ensembl_id(monkeypatch):
     class MockResponse(object):
         def __init__(self, url):
             self.status_code = 200
+            self.headers = {}
             self.url = url
 
         def json(self):
@@ -93,10 +109,10 @@ def test_symbol_to_ensembl_multiple_ensembl_id(monkeypatch):
                     }
                 ]
 
-    def mock_get(url, headers):
+    def mock_get(session, method, url, **kwargs):
         return MockResponse(url)
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "request", mock_get)
 
     # The EnsemblRestApiClient should return the right Ensembl ID
     ensembl_id = symbol_to_ensembl(hgnc_symbol)
@@ -116,14 +132,46 @@ def test_ensembl_to_symbol(monkeypatch):
     class MockResponse(object):
         def __init__(self):
             self.status_code = 200
+            self.headers = {}
 
         def json(self):
             return {"display_name": symbol}
 
-    def mock_get(url, headers):
+    def mock_get(session, method, url, **kwargs):
         return MockResponse()
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "request", mock_get)
 
     # The EnsemblRestApiClient should return the right symbl
     assert ensembl_to_symbol(ensembl_id) == symbol
+
+
+def test_gene_table(tmp_path):
+    """Test converting gene identifiers using a local HGNC complete set file"""
+
+    # GIVEN a HGNC complete set file
+    genes_file = tmp_path / "hgnc_complete_set.txt"
+    genes_file.write_text(HGNC_GENES)
+
+    # WHEN it is loaded into a gene table
+    table = GeneTable()
+    table.init_app(str(genes_file))
+    assert table.loaded
+
+    # THEN genes should be converted without calling the Ensembl REST API
+    assert table.entrez_to_symbol("3735") == "KARS1"
+    assert table.symbol_to_ensembl("GPX4") == "ENSG00000167468"
+    assert table.symbol_to_ensembl("gpx4") == "ENSG00000167468"
+    assert table.ensembl_to_symbol("ENSG00000167468.5") == "GPX4"
+    # Previous symbols should be used only when they refer to one gene
+    assert table.symbol_to_ensembl("KARS") == "ENSG00000065427"
+    assert table.symbol_to_ensembl("OLD") == "ENSG00000000001"
+    assert table.symbol_to_ensembl("SHARED") is None
+
+
+def test_gene_table_missing_file(tmp_path):
+    """Test a gene table initialized without the HGNC complete set file"""
+
+    table = GeneTable()
+    table.init_app(str(tmp_path / "hgnc_complete_set.txt"))
+    assert table.loaded is False
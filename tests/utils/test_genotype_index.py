@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import pytest
+from patientMatcher.constants import VARIANT_INDEX
+from patientMatcher.match.genotype_matcher import evaluate_gt_similarity, genotype_query_plan
+from patientMatcher.parse import patient as parse_patient
+from patientMatcher.server.extensions import genotype_index
+from patientMatcher.utils.add import backend_add_patient
+from patientMatcher.utils.delete import delete_by_query
+from patientMatcher.utils.generation import (
+    GENERATION_COLLECTION,
+    PATIENTS_GENERATION,
+    patients_changed,
+)
+from patientMatcher.utils.genotype_index import GenotypeIndex
+
+VARIANT = {
+    "assembly": "GRCh37",
+    "referenceName": "19",
+    "start": 1105813,
+    "end": 1105813,
+    "referenceBases": "G",
+    "alternateBases": "T",
+}
+GPX4 = {"id": "ENSG00000167468", "_geneName": "GPX4"}
+POLG = {"id": "ENSG00000140521", "_geneName": "POLG"}
+
+
+@pytest.fixture
+def enabled_index(database, monkeypatch):
+    """The genotype index extension enabled for the test database, with a mocked liftover"""
+
+    def mock_lift_variant(variant):
+        return [
+            dict(
+                variant, assembly="GRCh38", start=variant["start"] + 1000, end=variant["end"] + 1000
+            )
+        ]
+
+    monkeypatch.setattr(parse_patient, "lift_variant", mock_lift_variant)
+    genotype_index.init_app(database, True)
+    yield genotype_index
+    genotype_index.init_app(database, False)
+
+
+def test_genotype_index_scores(database, enabled_index):
+    """Test that scores computed from the genotype index are those computed from the patient documents"""
+
+    # GIVEN a patient saved by an older version of the software, without variant keys
+    database["patients"].insert_one(
+        {"_id": "legacy", "genomicFeatures": [{"gene": dict(GPX4), "variant": VARIANT}]}
+    )
+    # And patients saved with variant keys
+    patients = [
+        ("p1", [{"gene": dict(GPX4), "variant": VARIANT}, {"gene": dict(POLG)}]),
+        ("p2", [{"gene": dict(GPX4), "variant": dict(VARIANT, start=1, end=1)}]),
+        ("p3", [{"gene": {"id": "ENSG00000000003"}}]),
+    ]
+    for patient_id, features in patients:
+        backend_add_patient(database, {"_id": patient_id, "genomicFeatures": features})
+    enabled_index.build(database)
+    assert len(enabled_index) == 4
+
+    # WHEN a query patient with a variant in build 38 and a gene without variant is scored
+    query_features = [
+        {
+            "gene": dict(GPX4),
+            "variant": dict(VARIANT, assembly="GRCh38", start=1106813, end=1106813),
+        },
+        {"gene": {"id": "ENSG00000140521"}},
+    ]
+    query_plan = genotype_query_plan(query_features)
+    scores = enabled_index.scores(
+        query_plan, ["ENSG00000167468", "ENSG00000140521"], ["GPX4"], 0.25
+    )
+
+    # THEN only patients sharing genes or variants with the query should be returned
+    assert set(scores) == {"legacy", "p1", "p2"}
+    # With the scores computed from their documents
+    for patient in database["patients"].find({"_id": {"$in": list(scores)}}):
+        assert scores[patient["_id"]] == evaluate_gt_similarity(
+            query_plan, patient["genomicFeatures"], 0.25, patient.get(VARIANT_INDEX)
+        )
+    assert scores["p1"] == 0.25 + 0.0625
+    # The legacy patient only has the key of its variant in build 37
+    assert scores["legacy"] == 0.0625
+
+
+def test_genotype_index_sync(database, enabled_index, monkeypatch):
+    """Test that the genotype index is updated when patients are saved or removed"""
+
+    # GIVEN an index that counts its rebuilds
+    builds = []
+    build = GenotypeIndex.build
+    monkeypatch.setattr(
+        GenotypeIndex, "build", lambda self, db: builds.append(1) or build(self, db)
+    )
+    query_plan = genotype_query_plan([{"gene": dict(GPX4)}])
+
+    # WHEN a patient is saved
+    backend_add_patient(database, {"_id": "p1", "genomicFeatures": [{"gene": dict(GPX4)}]})
+    # THEN it should be found in the index without rebuilding it
+    index = enabled_index.current(database)
+    assert index.scores(query_plan, ["ENSG00000167468"], [], 0.5) == {"p1": 0.125}
+
+    # WHEN the patient is updated
+    backend_add_patient(database, {"_id": "p1", "genomicFeatures": [{"gene": dict(POLG)}]})
+    # THEN its old genes should be removed from the index
+    assert enabled_index.current(database).scores(query_plan, ["ENSG00000167468"], [], 0.5) == {}
+
+    # WHEN the patient is removed
+    delete_by_query({"_id": "p1"}, database, "patients")
+    # THEN it should be removed from the index
+    assert len(enabled_index.current(database)) == 0
+    assert builds == []
+
+
+def test_genotype_index_changed_by_other_process(database, enabled_index):
+    """Test that the index is rebuilt when patients are saved by another server process"""
+
+    # GIVEN a patient saved by another server process
+    database["patients"].insert_one({"_id": "p1", "genomicFeatures": [{"gene": dict(GPX4)}]})
+    database[GENERATION_COLLECTION].update_one(
+        {"_id": PATIENTS_GENERATION}, {"$inc": {"value": 1}}, upsert=True
+    )
+    assert len(enabled_index) == 0
+
+    # THEN the index of this process should be rebuilt before it's used
+    assert len(enabled_index.current(database)) == 1
+
+
+def test_genotype_index_changes_log(database, enabled_index, monkeypatch):
+    """Test that the index applies the changes saved by another server process without rebuilding"""
+
+    # GIVEN the genotype index of another server process
+    other_index = GenotypeIndex()
+    other_index.init_app(database, True)
+    builds = []
+    build = GenotypeIndex.build
+    monkeypatch.setattr(
+        GenotypeIndex, "build", lambda self, db: builds.append(1) or build(self, db)
+    )
+    query_plan = genotype_query_plan([{"gene": dict(GPX4)}])
+
+    # WHEN patients are saved, updated and removed by this process
+    backend_add_patient(database, {"_id": "p1", "genomicFeatures": [{"gene": dict(GPX4)}]})
+    backend_add_patient(database, {"_id": "p2", "genomicFeatures": [{"gene": dict(GPX4)}]})
+    backend_add_patient(database, {"_id": "p1", "genomicFeatures": [{"gene": dict(POLG)}]})
+    delete_by_query({"_id": "p2"}, database, "patients")
+    backend_add_patient(database, {"_id": "p3", "genomicFeatures": [{"gene": dict(GPX4)}]})
+
+    # THEN the other index should read only the changed patients
+    index = other_index.current(database)
+    assert builds == []
+    assert index.scores(query_plan, ["ENSG00000167468"], [], 0.5) == {"p3": 0.125}
+    assert len(index) == 2
+    assert index.generation == enabled_index.current(database).generation
+
+    # WHEN all patients are reloaded by another process
+    patients_changed(database)
+    # THEN the index should be rebuilt
+    other_index.current(database)
+    assert builds == [1]
+
+
+def test_genotype_index_ordinals(database, enabled_index):
+    """Test that the ordinals of removed patients are reused"""
+
+    # WHEN patients are repeatedly saved and removed
+    for n_patient in range(10):
+        patient_id = f"p{n_patient}"
+        backend_add_patient(
+            database, {"_id": patient_id, "genomicFeatures": [{"gene": dict(GPX4)}]}
+        )
+        delete_by_query({"_id": patient_id}, database, "patients")
+    backend_add_patient(database, {"_id": "last", "genomicFeatures": [{"gene": dict(GPX4)}]})
+
+    # THEN the index should not grow
+    assert enabled_index.patient_ids == ["last"]
+    query_plan = genotype_query_plan([{"gene": dict(GPX4)}])
+    assert enabled_index.scores(query_plan, ["ENSG00000167468"], [], 0.5) == {"last": 0.125}
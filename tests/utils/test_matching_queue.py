@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from patientMatcher.server.extensions import matching_queue
+from patientMatcher.utils import matching_queue as matching_queue_module
+from patientMatcher.utils.matching_queue import MAX_ATTEMPTS, STALE_JOB_TIMEOUT, job_status
+
+
+def test_matching_queue_retries(mock_app, database, monkeypatch):
+    """Test that failed jobs are run again at most MAX_ATTEMPTS times"""
+
+    # GIVEN an external matching that always fails
+    def failing_matching(database, patient_id, force=False):
+        raise ValueError("Node unavailable")
+
+    monkeypatch.setattr(matching_queue_module, "run_external_matching", failing_matching)
+    matching_queue.init_app(mock_app, True, workers=0)
+
+    try:
+        # WHEN a job is queued and run until there are no more jobs to run
+        job_id = matching_queue.enqueue(database, "patient_1")
+        with mock_app.app_context():
+            runs = 0
+            while matching_queue.run_next():
+                runs += 1
+
+        # THEN it should have been run MAX_ATTEMPTS times and marked as failed
+        assert runs == MAX_ATTEMPTS
+        job = job_status(database, job_id)
+        assert job["status"] == "failed"
+        assert job["error"] == "Node unavailable"
+    finally:
+        matching_queue.init_app(mock_app, False)
+
+
+def test_matching_queue_workers(mock_app, database, monkeypatch):
+    """Test that queued jobs are run by the worker threads"""
+
+    # GIVEN a mocked external matching
+    monkeypatch.setattr(
+        matching_queue_module,
+        "run_external_matching",
+        lambda database, patient_id, force: "match_1",
+    )
+    # GIVEN a queue configured with worker threads
+    matching_queue.init_app(mock_app, True, workers=2, poll_interval=0.01)
+    try:
+        # THEN no worker threads should be started before the server handles a request
+        assert matching_queue._threads == []
+
+        # WHEN the server handles a request and a job is queued
+        mock_app.test_client().get("/")
+        assert len(matching_queue._threads) == 2
+        job_id = matching_queue.enqueue(database, "patient_1")
+        # THEN the job should be run in the background
+        for _ in range(500):
+            if job_status(database, job_id)["status"] == "done":
+                break
+            matching_queue._stop.wait(0.01)
+        assert job_status(database, job_id)["match_id"] == "match_1"
+    finally:
+        matching_queue.init_app(mock_app, False)
+
+
+def test_matching_queue_stale_jobs(mock_app, database):
+    """Test that abandoned jobs are run again, unless they were already run MAX_ATTEMPTS times"""
+
+    # GIVEN 2 jobs left running by a stopped server process, one of them with no attempts left
+    matching_queue.init_app(mock_app, True, workers=0)
+    started = datetime.datetime.now() - datetime.timedelta(seconds=STALE_JOB_TIMEOUT + 1)
+    for job_id, attempts in [("exhausted", MAX_ATTEMPTS), ("retried", 1)]:
+        database["jobs"].insert_one(
+            {
+                "_id": job_id,
+                "patient_id": "patient_1",
+                "status": "running",
+                "created": started,
+                "started": started,
+                "attempts": attempts,
+            }
+        )
+
+    try:
+        # WHEN a worker claims the next job
+        job = matching_queue.claim(database)
+
+        # THEN the job with attempts left should be run again
+        assert job["_id"] == "retried"
+        assert job["attempts"] == 2
+        # AND the other one should be marked as failed
+        assert job_status(database, "exhausted")["status"] == "failed"
+    finally:
+        matching_queue.init_app(mock_app, False)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from patientMatcher.utils import node_health
+from patientMatcher.utils.node_health import (
+    FAILURE_THRESHOLD,
+    HEALTH_COLLECTION,
+    node_available,
+    nodes_health,
+    record_request,
+)
+
+
+def test_node_circuit_breaker(database, test_node):
+    """Test that requests are not sent to a node after repeated failures, until its cooldown is over"""
+    database["nodes"].insert_one(test_node)
+    node_id = test_node["_id"]
+
+    # GIVEN a node that failed as many times as the failure threshold
+    for _ in range(FAILURE_THRESHOLD - 1):
+        record_request(database, node_id, 1.0, "Connection refused")
+        assert node_available(database, node_id)
+    record_request(database, node_id, 1.0, "Connection refused")
+
+    # THEN its circuit should be open and no requests sent to it
+    assert node_available(database, node_id) is False
+    assert nodes_health(database)[0]["state"] == "open"
+
+    # WHEN the cooldown is over
+    opened = datetime.datetime.now() - datetime.timedelta(seconds=node_health.COOLDOWN + 1)
+    database[HEALTH_COLLECTION].update_one({"_id": node_id}, {"$set": {"opened": opened}})
+    # THEN a single trial request should be sent
+    assert node_available(database, node_id)
+    assert node_available(database, node_id) is False
+
+    # WHEN the trial request succeeds
+    record_request(database, node_id, 0.5)
+    # THEN the circuit should be closed
+    assert node_available(database, node_id)
+    health = nodes_health(database)[0]
+    assert health["state"] == "closed"
+    assert health["consecutive_failures"] == 0
+    assert health["requests"] == FAILURE_THRESHOLD + 1
+    assert health["error_rate"] == FAILURE_THRESHOLD / (FAILURE_THRESHOLD + 1)
+    assert health["latency_p50"] == 1.0
+    assert health["last_error"] == "Connection refused"
+
+
+def test_nodes_health_window(database, test_node, monkeypatch):
+    """Test that the health of a node is computed from its most recent requests"""
+    database["nodes"].insert_one(test_node)
+    monkeypatch.setattr(node_health, "WINDOW", 10)
+
+    # GIVEN a node with 20 successful requests with increasing latencies
+    for latency in range(1, 21):
+        record_request(database, test_node["_id"], float(latency))
+
+    # THEN only the last 10 requests should be used to compute its latency percentiles
+    health = nodes_health(database)[0]
+    assert health["requests"] == 10
+    assert health["error_rate"] == 0
+    assert health["latency_p50"] == 15.0
+    assert health["latency_p95"] == 20.0
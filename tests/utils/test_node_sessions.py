@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from patientMatcher.utils import node_sessions
+from patientMatcher.utils.node_sessions import drop_sessions, node_session
+
+
+def test_node_session(test_node, monkeypatch):
+    """Test that the connections to a node are reused until the node settings change"""
+
+    closed = []
+    monkeypatch.setattr("requests.Session.close", lambda session: closed.append(session))
+
+    # GIVEN a node with a custom pool size
+    node = dict(test_node, max_connections=2)
+
+    # WHEN the session of the node is requested twice
+    session = node_session(node)
+    # THEN the same session should be returned
+    assert node_session(node) is session
+    assert session.headers["X-Auth-Token"] == node["auth_token"]
+    assert session.get_adapter(node["matching_url"])._pool_maxsize == 2
+
+    # WHEN the token of the node changes
+    node["auth_token"] = "newToken"
+    # THEN a new session should be created with the new token
+    new_session = node_session(node)
+    assert new_session is not session
+    assert new_session.headers["X-Auth-Token"] == "newToken"
+    # AND the old session should not be closed, since other threads might be using it
+    assert closed == []
+
+    # WHEN the node is no longer connected
+    drop_sessions(keep_ids=[])
+    # THEN its session should be removed without being closed
+    assert node_sessions._sessions == {}
+    assert closed == []
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+
+from patientMatcher.server.extensions import diseases, hpo, hpoic
+from patientMatcher.utils.hpo import HPO, HPOIC
+from patientMatcher.utils.ontology_cache import (
+    cache_dir_writable,
+    default_cache_dir,
+    load_ontology_cache,
+    resources_checksum,
+    save_ontology_cache,
+)
+
+
+def test_save_load_ontology_cache(mock_app, tmpdir):
+    """Test saving a compiled ontology and creating the HPO from it"""
+
+    # GIVEN the checksum of the phenotype resource files
+    checksum = resources_checksum()
+    cache_dir = str(tmpdir)
+
+    # THEN no compiled ontology should be available in an empty cache directory
+    assert load_ontology_cache(cache_dir, checksum) is None
+
+    # WHEN the HPO initialized by the app is saved
+    path = save_ontology_cache(cache_dir, checksum, hpo, hpoic)
+    assert os.path.isdir(path)
+
+    # THEN it should be possible to load it
+    cache = load_ontology_cache(cache_dir, checksum)
+    assert len(cache["term_ids"]) == len(hpo)
+
+    # AND to create an HPO from it
+    cached_hpo = HPO()
+    cached_hpo.init_app(cache)
+    cached_hpoic = HPOIC()
+    cached_hpoic.init_app(None, cached_hpo, diseases, cache)
+
+    # Containing the same terms, alternative IDs, parents and ancestors
+    assert set(cached_hpo.hps) == set(hpo.hps)
+    for hp_id, node in hpo.hps.items():
+        cached_node = cached_hpo[hp_id]
+        assert cached_node.id == node.id
+        assert cached_node.name == node.name
+        assert cached_node.index == node.index
+        assert {parent.id for parent in cached_node.parents} == {
+            parent.id for parent in node.parents
+        }
+        assert {term.id for term in cached_node.ancestors()} == {
+            term.id for term in node.ancestors()
+        }
+        # And the same information content
+        assert cached_hpoic.term_ic.get(cached_node) == hpoic.term_ic.get(node)
+        assert cached_hpoic.lss.get(cached_node) == hpoic.lss.get(node)
+
+
+def test_save_ontology_cache_remove_old(mock_app, tmpdir):
+    """Test that compiled ontologies from older resource files are removed when a new one is saved"""
+
+    # GIVEN a compiled ontology saved for some older resource files
+    cache_dir = str(tmpdir)
+    old_path = save_ontology_cache(cache_dir, "old_checksum", hpo, hpoic)
+    assert os.path.isdir(old_path)
+
+    # WHEN the ontology compiled from the current resource files is saved
+    new_path = save_ontology_cache(cache_dir, resources_checksum(), hpo, hpoic)
+
+    # THEN only the new compiled ontology should be available
+    assert os.listdir(cache_dir) == [os.path.basename(new_path)]
+
+
+def test_memory_mapped_ontology(mock_app, tmpdir):
+    """Test creating an HPO backed by the memory-mapped arrays of a compiled ontology"""
+
+    # GIVEN a compiled ontology
+    checksum = resources_checksum()
+    save_ontology_cache(str(tmpdir), checksum, hpo, hpoic)
+
+    # WHEN it is memory-mapped and used to initialize the HPO and its information content
+    cache = load_ontology_cache(str(tmpdir), checksum, mmap=True)
+    mapped_hpo = HPO()
+    mapped_hpo.init_app(cache, mmap=True)
+    mapped_hpoic = HPOIC()
+    mapped_hpoic.init_app(None, mapped_hpo, diseases, cache)
+
+    # THEN the HPO should contain the same terms
+    assert mapped_hpo.mmap is True
+    assert len(mapped_hpo) == len(hpo)
+    assert len(mapped_hpo.hps) == len(hpo.hps)
+    assert mapped_hpo.root.id == hpo.root.id
+
+    # And terms should be created on demand with the same relationships and information content
+    for hp_id in ["HP:0008058", "HP:0000057"]:
+        node = hpo[hp_id]
+        mapped_node = mapped_hpo[hp_id]
+        assert mapped_node is mapped_hpo[hp_id]
+        assert mapped_node.id == node.id
+        assert mapped_node.name == node.name
+        assert {parent.id for parent in mapped_node.parents} == {
+            parent.id for parent in node.parents
+        }
+        assert {term.id for term in mapped_node.ancestors()} == {
+            term.id for term in node.ancestors()
+        }
+        assert mapped_hpoic.term_ic.get(mapped_node) == hpoic.term_ic.get(node)
+
+    # Unknown terms should not be found
+    assert mapped_hpo.hps.get("HP:9999999") is None
+    assert mapped_hpo.term_indexes(["HP:9999999", "HP:0008058"]) == [hpo["HP:0008058"].index]
+
+
+def test_memory_mapped_nodes_cache(mock_app, tmpdir, monkeypatch):
+    """Test that the number of nodes of a memory-mapped ontology kept in memory is bounded"""
+
+    # GIVEN a memory-mapped ontology keeping at most 10 nodes in memory
+    monkeypatch.setattr("patientMatcher.utils.hpo.NODE_CACHE_SIZE", 10)
+    checksum = resources_checksum()
+    save_ontology_cache(str(tmpdir), checksum, hpo, hpoic)
+    mapped_hpo = HPO()
+    mapped_hpo.init_app(load_ontology_cache(str(tmpdir), checksum, mmap=True), mmap=True)
+
+    # WHEN the ancestors of a term are requested
+    node = mapped_hpo["HP:0008058"]
+    ancestors = node.ancestors()
+
+    # THEN they should be computed only once
+    assert node.ancestors() is ancestors
+
+    # WHEN more terms than the cache size are requested
+    for index in range(20):
+        mapped_hpo.node(index)
+
+    # THEN only the most recently used nodes should be kept in memory
+    assert len(mapped_hpo._nodes) == 10
+
+    # AND a term created again should be equal to the one created before
+    assert mapped_hpo["HP:0008058"] is not node
+    assert mapped_hpo["HP:0008058"] == node
+    assert mapped_hpo.root in ancestors
+
+
+def test_ontology_cache_dir(tmpdir, monkeypatch):
+    """Test the default directory of the compiled ontologies and the check of its permissions"""
+
+    # GIVEN a user cache directory
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir))
+
+    # THEN compiled ontologies should be saved in it by default, outside the installed package
+    cache_dir = default_cache_dir()
+    assert cache_dir == os.path.join(str(tmpdir), "patientMatcher", "ontology")
+    assert cache_dir_writable(cache_dir) is True
+    assert os.path.isdir(cache_dir)
+
+    # AND a directory that can't be created should not be writable
+    blocking_file = tmpdir.join("file")
+    blocking_file.write("")
+    assert cache_dir_writable(os.path.join(str(blocking_file), "ontology")) is False
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+from patientMatcher.constants import VARIANT_INDEX
+from patientMatcher.match import genotype_matcher
+from patientMatcher.match.handler import internal_matcher
+from patientMatcher.parse import patient as parse_patient
+from patientMatcher.parse.patient import mme_patient
+from patientMatcher.server import create_app
+from patientMatcher.server.extensions import patient_replica
+from patientMatcher.utils.add import backend_add_patient
+from patientMatcher.utils.delete import delete_by_query
+from patientMatcher.utils.generation import patients_changed
+from patientMatcher.utils.patient_replica import compact_patient
+from pymongo.errors import OperationFailure
+
+GPX4 = {"id": "ENSG00000167468", "_geneName": "GPX4"}
+
+
+@pytest.fixture
+def standalone_database(database, monkeypatch):
+    """A database without change streams, like a standalone MongoDB server"""
+
+    def watch(collection, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+    monkeypatch.setattr(type(database["patients"]), "watch", watch, raising=False)
+    yield database
+    patient_replica.init_app(database, False)
+
+
+def wait_for(condition, timeout=5):
+    start = time.time()
+    while condition() is False and time.time() - start < timeout:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_compact_patient():
+    """Test that only the fields used for matching are kept in the replica"""
+    patient = {
+        "_id": "p1",
+        "contact": {"name": "Contact Name"},
+        "features": [{"id": "HP:0001250", "label": "Seizure", "observed": "yes"}],
+        "disorders": [{"id": "MIM:616007", "label": "A disease"}],
+        "genomicFeatures": [{"gene": dict(GPX4, label="gene"), "zygosity": 1}],
+        VARIANT_INDEX: [],
+    }
+    assert compact_patient(patient) == {
+        "_id": "p1",
+        "features": [{"id": "HP:0001250"}],
+        "disorders": [{"id": "MIM:616007"}],
+        "genomicFeatures": [{"gene": GPX4, "variant": None}],
+        VARIANT_INDEX: [],
+    }
+
+
+def test_patient_replica_polling(standalone_database, monkeypatch):
+    """Test the replica of a standalone database, updated by polling"""
+    database = standalone_database
+
+    # GIVEN a database with a patient
+    database["patients"].insert_one({"_id": "p1", "genomicFeatures": [{"gene": GPX4}]})
+
+    # WHEN the replica is enabled
+    patient_replica.init_app(database, True, poll_interval=0.01)
+    patient_replica.start()
+
+    # THEN it should be updated by polling and contain the patient
+    assert patient_replica.mode == "polling"
+    assert list(patient_replica.records) == ["p1"]
+
+    # WHEN a patient is saved by this process
+    backend_add_patient(database, {"_id": "p2", "genomicFeatures": [{"gene": GPX4}]})
+    # THEN it should be added to the replica immediately
+    assert set(patient_replica.records) == {"p1", "p2"}
+
+    # WHEN a patient is removed by another process
+    database["patients"].delete_one({"_id": "p1"})
+    monkeypatch.setattr(patient_replica, "update", lambda *args: None)
+    patients_changed(database, removed_ids=["p1"])
+    # THEN the replica should be reloaded by the polling thread
+    assert wait_for(lambda: set(patient_replica.records) == {"p2"})
+    assert list(patient_replica.genotype.ordinals) == ["p2"]
+
+
+def test_patient_replica_apply_change(database):
+    """Test applying the events of the change stream of the patients collection"""
+    patient = {"_id": "p1", "disorders": [{"id": "MIM:616007"}], "genomicFeatures": []}
+
+    # WHEN a patient is inserted
+    assert patient_replica.apply_change({"operationType": "insert", "fullDocument": patient})
+    assert patient_replica.patients() == [compact_patient(patient)]
+
+    # WHEN it is updated
+    patient = dict(patient, genomicFeatures=[{"gene": GPX4}])
+    assert patient_replica.apply_change({"operationType": "update", "fullDocument": patient})
+    assert list(patient_replica.genotype.ordinals) == ["p1"]
+
+    # WHEN it is removed
+    assert patient_replica.apply_change({"operationType": "delete", "documentKey": {"_id": "p1"}})
+    assert len(patient_replica) == 0
+    assert len(patient_replica.genotype) == 0
+
+    # WHEN the collection is dropped the stream should be closed
+    assert patient_replica.apply_change({"operationType": "drop"}) is False
+
+
+def test_patient_replica_started_on_first_request(standalone_database, monkeypatch):
+    """Test that the replica is loaded by the first request handled by the server, not when the app
+    is created"""
+
+    # GIVEN an app with the patient replica enabled
+    monkeypatch.setenv("PATIENT_REPLICA", "True")
+    app = create_app()
+
+    # THEN patients should not be loaded when the app is created (for instance by the command line)
+    assert patient_replica.enabled
+    assert patient_replica.started is False
+    assert patient_replica._thread is None
+
+    # WHEN the server handles its first request
+    app.test_client().get("/")
+    # THEN the replica should be loaded and follow the changes of the patients collection
+    assert patient_replica.started
+    assert patient_replica._thread.is_alive()
+
+
+def test_internal_matching_patient_replica(
+    mock_app, standalone_database, gpx4_patients, monkeypatch
+):
+    """Test that matching with the patient replica returns the same results as matching the database"""
+    database = standalone_database
+
+    # GIVEN a mocked gene conversion and liftover
+    monkeypatch.setattr(
+        genotype_matcher,
+        "gtfeatures_to_genes_symbols",
+        lambda features: ([feature["gene"]["id"] for feature in features], []),
+    )
+    monkeypatch.setattr(parse_patient, "lift_variant", lambda variant: [])
+    # GIVEN a database with 2 patients
+    for patient in gpx4_patients:
+        backend_add_patient(database, mme_patient(patient))
+    proband_patient = mme_patient(gpx4_patients[0])
+
+    # WHEN matching against the database or against the replica
+    db_match = internal_matcher(database, dict(proband_patient), 0.5, 0.5, max_results=1)
+    patient_replica.init_app(database, True)
+    patient_replica.start()
+    replica_match = internal_matcher(database, dict(proband_patient), 0.5, 0.5, max_results=1)
+
+    # THEN the results should be the same
+    assert replica_match["results"] == db_match["results"]
+    assert len(replica_match["results"][0]["patients"]) == 1
+    assert replica_match["results"][0]["patients"][0]["score"]["_genotype"] == 0.5
+
+    # WHEN the patients are removed
+    delete_by_query({}, database, "patients")
+    # THEN they should be removed from the replica
+    replica_match = internal_matcher(database, dict(proband_patient), 0.5, 0.5)
+    assert replica_match["results"][0]["patients"] == []
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import responses
+from patientMatcher.utils.update import update_resources
+
+URL = "https://resources.test/genes.txt"
+
+
+@responses.activate
+def test_update_resources_chunked(tmp_path):
+    """Test downloading a resource file sent without a content-length header"""
+
+    # GIVEN a server sending a resource without its length
+    responses.add(responses.GET, URL, body=b"new content", status=200)
+    destination = tmp_path / "genes.txt"
+    destination.write_text("old content")
+
+    # WHEN the resource is updated
+    update_resources(
+        test=False, resources={"genes": {"url": URL, "resource_path": str(destination)}}
+    )
+
+    # THEN the local file should be replaced, without leaving temporary files
+    assert destination.read_text() == "new content"
+    assert os.listdir(tmp_path) == ["genes.txt"]
+
+
+@responses.activate
+def test_update_resources_max_age(tmp_path):
+    """Test that recently downloaded resource files are not downloaded again"""
+
+    responses.add(responses.GET, URL, body=b"new content", status=200)
+    destination = tmp_path / "genes.txt"
+    resources = {"genes": {"url": URL, "resource_path": str(destination)}}
+
+    # GIVEN a resource file downloaded 1 hour ago
+    destination.write_text("old content")
+    one_hour_ago = time.time() - 3600
+    os.utime(destination, (one_hour_ago, one_hour_ago))
+
+    # WHEN resources older than 1 day are updated
+    update_resources(test=False, resources=resources, max_age=86400)
+    # THEN the file should not be downloaded
+    assert len(responses.calls) == 0
+    assert destination.read_text() == "old content"
+
+    # WHEN resources older than 1 minute are updated
+    update_resources(test=False, resources=resources, max_age=60)
+    # THEN the file should be downloaded again
+    assert destination.read_text() == "new content"
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from patientMatcher.match.phenotype_matcher import similarity_wrapper
+from patientMatcher.server.extensions import hpo, hpoic, simgic
+from patientMatcher.utils.phenotype_index import phenotype_fingerprint
+from patientMatcher.utils.similarity import ENGINES, PhenotypeSimilarity
+
+QUERY_TERMS = ["HP:0008058", "HP:0007033", "HP:0002194", "HP:0002281"]
+
+
+def test_simgic_engine_fingerprint(mock_app):
+    """Test the function that encodes the ancestors of HPO terms into a bit vector"""
+
+    # GIVEN a simGIC engine initialized when the app is created
+    assert simgic.n_terms == len(hpo)
+
+    # WHEN a fingerprint is created for a list of HPO terms
+    fingerprint = simgic.fingerprint(QUERY_TERMS)
+
+    # THEN it should contain one bit per HPO term
+    assert len(fingerprint) == simgic.n_bytes
+
+    # AND its information content should be the same as the one of the ancestors of the terms
+    ancestors = set()
+    for term_id in QUERY_TERMS:
+        ancestors.update(hpo[term_id].ancestors())
+    assert round(simgic.information_content(fingerprint), 9) == round(
+        hpoic.information_content(ancestors), 9
+    )
+
+
+def test_simgic_engine_score(mock_app):
+    """Test that the scores computed by the engine are the same as those computed one patient at the time"""
+
+    # GIVEN a list of patients with different HPO terms
+    candidates = [
+        QUERY_TERMS,
+        ["HP:0008058", "HP:0007033", "HP:0002194"],
+        ["HP:0003002", "HP:0000218"],
+        ["HP:9999999"],  # Unknown term
+        [],
+    ]
+
+    # WHEN they are scored against a query patient
+    scores = simgic.score(QUERY_TERMS, candidates)
+
+    # THEN a score should be returned for each patient
+    assert len(scores) == len(candidates)
+    # The scores of the patients with known terms should be the same as the ones computed by the similarity wrapper
+    for i in range(3):
+        assert round(scores[i], 9) == round(
+            similarity_wrapper(hpoic, hpo, 1.0, QUERY_TERMS, candidates[i]), 9
+        )
+    # And patients without known terms should have a score of 0
+    assert scores[3] == scores[4] == 0
+
+
+def test_simgic_engine_profiles(mock_app):
+    """Test that phenotype profiles are computed once and reused when scoring patients"""
+
+    # GIVEN the phenotype profile of a query patient
+    query_profile = simgic.profile(QUERY_TERMS)
+    assert query_profile["ic"] == simgic.information_content(query_profile["fingerprint"])
+
+    # WHEN it's used to score a list of patients
+    candidates = [QUERY_TERMS, ["HP:0003002", "HP:0000218"]]
+    scores = simgic.score(query_profile, candidates)
+
+    # THEN the scores should be the same as the ones computed from the query HPO terms
+    assert scores.tolist() == simgic.score(QUERY_TERMS, candidates).tolist()
+
+    # AND the profiles of the patients should be memoized by HPO terms, regardless of their order
+    assert simgic.candidate_profile(candidates[1]) is simgic.candidate_profile(
+        list(reversed(candidates[1]))
+    )
+
+
+def test_simgic_engine_stored_profile(mock_app):
+    """Test the phenotype profiles created from the fingerprints saved with the patients"""
+
+    # GIVEN the phenotype fingerprint of a patient
+    fingerprint = phenotype_fingerprint(simgic, QUERY_TERMS)
+    assert fingerprint["version"] == simgic.version
+
+    # THEN the profile created from it should be the same as the one created from the HPO terms
+    profile = simgic.stored_profile(fingerprint)
+    assert profile["fingerprint"].tolist() == simgic.profile(QUERY_TERMS)["fingerprint"].tolist()
+    assert profile["ic"] == simgic.profile(QUERY_TERMS)["ic"]
+
+    # AND fingerprints created from other phenotype resources should not be used
+    fingerprint["version"] = "another_version"
+    assert simgic.stored_profile(fingerprint) is None
+
+
+def test_similarity_engines(mock_app):
+    """Test the scores computed by all the available phenotype similarity engines"""
+
+    candidates = [
+        QUERY_TERMS,
+        ["HP:0008058", "HP:0007033", "HP:0002194"],
+        ["HP:0003002", "HP:0000218"],
+        [],
+    ]
+    fingerprint = phenotype_fingerprint(simgic, candidates[1])
+
+    for engine_name in ENGINES:
+        # GIVEN a phenotype similarity engine
+        engine_selector = PhenotypeSimilarity()
+        engine_selector.init_app(engine_name, simgic, hpoic)
+        engine = engine_selector.engine
+
+        # WHEN patients are scored against a query patient
+        scores = engine.score(engine.profile(QUERY_TERMS), candidates)
+
+        # THEN scores should be between 0 and 1
+        assert all(0 <= score <= 1 for score in scores)
+        # The patient with the same terms should have the highest score
+        assert scores[0] == max(scores)
+        # And the patient without terms should have a score of 0
+        assert scores[3] == 0
+
+        # AND profiles created from saved fingerprints should give the same scores
+        stored_profile = engine.stored_profile(fingerprint)
+        assert engine.score(QUERY_TERMS, [stored_profile])[0] == scores[1]
+
+
+def test_similarity_unknown_engine(mock_app):
+    """Test that simGIC is used when the engine specified in the config file doesn't exist"""
+    engine_selector = PhenotypeSimilarity()
+    engine_selector.init_app("unknown", simgic, hpoic)
+    assert engine_selector.engine is simgic
@@ -1,5 +1,120 @@
+import gzip
+import os
+
 import responses
-from patientMatcher.utils.variant import liftover
+from patientMatcher.utils.variant import ChainLiftOver, liftover
+
+CHAINS = "\n".join(
+    [
+        "chain 1000 chr1 1000 + 100 200 chr1 1000 + 300 400 1",
+        "50 10 10",
+        "40",
+        "",
+        "chain 500 chr2 1000 + 0 20 chr2 500 - 10 30 2",
+        "20",
+        "",
+        "chain 100 chrM 1000 + 0 10 chrM 1000 + 0 10 3",
+        "10",
+        "",
+        "chain 50 chr3 1000 + 0 10 chr3_alt 1000 + 0 10 4",
+        "10",
+        "",
+    ]
+)
+
+
+def _chain_files(tmp_path):
+    """Write 2 test chain files and return their description"""
+    chains = {}
+    for assembly in ["GRCh37", "GRCh38"]:
+        path = tmp_path / f"{assembly}.over.chain.gz"
+        with gzip.open(path, "wt") as chain_file:
+            chain_file.write(CHAINS)
+        chains[assembly] = {"resource_path": str(path), "assembly": assembly}
+    return chains
+
+
+def _chain_liftover(tmp_path, chains=None):
+    """Return a ChainLiftOver object loaded from 2 test chain files"""
+    lifter = ChainLiftOver()
+    lifter.init_app(chains or _chain_files(tmp_path), cache_dir=str(tmp_path / "cache"))
+    return lifter
+
+
+def test_chain_liftover(tmp_path):
+    """Test variant liftover using chain files"""
+
+    # GIVEN chain files for both genome builds
+    lifter = _chain_liftover(tmp_path)
+    assert lifter.loaded
+
+    # THEN a position in an aligned block should be mapped
+    mappings = lifter.liftover("GRCh37", "1", 101, 101)
+    assert mappings[0]["mapped"]["assembly"] == "GRCh38"
+    assert mappings[0]["mapped"]["seq_region_name"] == "1"
+    assert mappings[0]["mapped"]["start"] == mappings[0]["mapped"]["end"] == 301
+
+    # And an interval spanning 2 blocks of the same chain should be mapped
+    mappings = lifter.liftover("GRCh38", "1", 101, 170)
+    assert mappings[0]["mapped"]["assembly"] == "GRCh37"
+    assert (mappings[0]["mapped"]["start"], mappings[0]["mapped"]["end"]) == (301, 370)
+
+    # And a position mapped to the reverse strand should be converted to the forward strand
+    mappings = lifter.liftover("GRCh37", "2", 1)
+    assert (mappings[0]["mapped"]["start"], mappings[0]["mapped"]["strand"]) == (490, -1)
+
+    # And mitochondrial chromosome names should be converted
+    assert lifter.liftover("GRCh37", "MT", 5)[0]["mapped"]["seq_region_name"] == "MT"
+
+    # While positions in alignment gaps, outside chains or aligned to alternate contigs are not mapped
+    assert lifter.liftover("GRCh37", "1", 156) == []
+    assert lifter.liftover("GRCh37", "1", 900) == []
+    assert lifter.liftover("GRCh37", "3", 5) == []
+    assert lifter.liftover("GRCh37", "Y", 5) == []
+
+
+def test_chain_liftover_missing_files(tmp_path):
+    """Test a ChainLiftOver object initialized without chain files"""
+
+    lifter = ChainLiftOver()
+    lifter.init_app(
+        {"GRCh37": {"resource_path": str(tmp_path / "missing.chain.gz"), "assembly": "GRCh37"}},
+        cache_dir=str(tmp_path / "cache"),
+    )
+    assert lifter.loaded is False
+
+
+def test_chain_liftover_cache(tmp_path, monkeypatch):
+    """Test that the arrays parsed from the chain files are reused by the following startups"""
+
+    # GIVEN chain files loaded once
+    chains = _chain_files(tmp_path)
+    _chain_liftover(tmp_path, chains)
+    cache_dir = tmp_path / "cache"
+    saved = sorted(os.listdir(cache_dir))
+    assert len(saved) == 2
+
+    # WHEN they are loaded again
+    def parse_chains(path):
+        raise AssertionError("chain file parsed again")
+
+    monkeypatch.setattr(ChainLiftOver, "_parse_chains", staticmethod(parse_chains))
+    lifter = _chain_liftover(tmp_path, chains)
+
+    # THEN the parsed arrays should be loaded from the cache
+    assert lifter.loaded
+    mappings = lifter.liftover("GRCh37", "1", 101, 101)
+    assert mappings[0]["mapped"]["start"] == 301
+    assert lifter.liftover("GRCh37", "MT", 5)[0]["mapped"]["seq_region_name"] == "MT"
+
+    # AND when a chain file is updated its parsed arrays should be replaced
+    monkeypatch.undo()
+    with gzip.open(chains["GRCh37"]["resource_path"], "wt") as chain_file:
+        chain_file.write(CHAINS + "\n")
+    _chain_liftover(tmp_path, chains)
+    updated = sorted(os.listdir(cache_dir))
+    assert len(updated) == 2
+    assert updated != saved
 
 
 @responses.activate
@@ -194,3 +309,20 @@ def test_liftover_bad_request():
     # THEN the service should not return mappings
     mappings = liftover("GRCh37", chromosome, start, end)
     assert mappings is None
+
+
+@responses.activate
+def test_liftover_service_error():
+    """Test that a failed liftover request is distinguished from a variant without mappings"""
+
+    url = "https://grch37.rest.ensembl.org/map/human/GRCh37/X:1000000..1000000/GRCh38?content-type=application/json"
+
+    # GIVEN a liftover service returning a server error
+    responses.add(responses.GET, url, body="<html>Internal server error</html>", status=500)
+    # THEN the liftover should fail
+    assert liftover("GRCh37", "X", 1000000, 1000000) is None
+
+    # GIVEN a liftover service returning no mappings
+    responses.replace(responses.GET, url, json={"mappings": []}, status=200)
+    # THEN the variant should have no mappings
+    assert liftover("GRCh37", "X", 1000000, 1000000) == []
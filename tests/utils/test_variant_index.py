@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from patientMatcher.constants import VARIANT_INDEX
+from patientMatcher.parse import patient
+from patientMatcher.utils.variant_index import update_variant_indexes, variant_index
+
+VARIANT = {
+    "assembly": "GRCh37",
+    "referenceName": "19",
+    "start": 1105813,
+    "end": 1105813,
+    "referenceBases": "G",
+    "alternateBases": "T",
+}
+
+
+def test_update_variant_indexes(database, monkeypatch):
+    """Test creating the variant keys of patients saved without them"""
+
+    # GIVEN a mocked liftover
+    def mock_lift_variant(variant):
+        return [dict(variant, assembly="GRCh38", start=1106813, end=1106813)]
+
+    monkeypatch.setattr(patient, "lift_variant", mock_lift_variant)
+
+    # GIVEN a database with a patient saved without variant keys
+    features = [{"gene": {"id": "GPX4"}}, {"gene": {"id": "GPX4"}, "variant": VARIANT}]
+    database["patients"].insert_one({"_id": "p1", "genomicFeatures": features})
+
+    # THEN the keys of the patient's variant in both genome builds should be created
+    assert update_variant_indexes(database) == (1, 0)
+    assert database["patients"].find_one()[VARIANT_INDEX] == [
+        {"feature": 1, "key": "37:19:1105813:G:T"},
+        {"feature": 1, "key": "38:19:1106813:G:T"},
+    ]
+    # Only once
+    assert update_variant_indexes(database) == (0, 0)
+
+
+def test_update_variant_indexes_liftover_error(database, monkeypatch):
+    """Test that patients with variants that can't be lifted are recorded and not retried"""
+
+    # GIVEN a liftover service that is not available
+    def mock_lift_variant(variant):
+        raise ConnectionError()
+
+    monkeypatch.setattr(patient, "lift_variant", mock_lift_variant)
+
+    # GIVEN a database with a patient saved without variant keys
+    features = [{"gene": {"id": "GPX4"}, "variant": VARIANT}]
+    database["patients"].insert_one({"_id": "p1", "genomicFeatures": features})
+
+    # THEN the patient should be saved with empty variant keys
+    assert update_variant_indexes(database) == (0, 1)
+    assert database["patients"].find_one()[VARIANT_INDEX] is None
+    # AND it should not be updated again
+    assert update_variant_indexes(database) == (0, 0)
+
+    # WHEN the liftover is available again and failed patients are retried
+    monkeypatch.setattr(patient, "lift_variant", lambda variant: [])
+    # THEN the patient should be updated
+    assert update_variant_indexes(database, retry_failed=True) == (1, 0)
+    assert database["patients"].find_one()[VARIANT_INDEX] == [
+        {"feature": 0, "key": "37:19:1105813:G:T"}
+    ]
+
+
+def test_variant_index_failed_liftover(monkeypatch):
+    """Test that a failed liftover is not saved as a variant without mappings"""
+
+    features = [{"gene": {"id": "GPX4"}, "variant": VARIANT}]
+
+    # GIVEN a liftover service returning an invalid response (e.g. a server error)
+    monkeypatch.setattr(patient, "liftover", lambda *args: None)
+    # THEN the variant keys should not be created, so that the patient is retried later
+    assert variant_index(features) is None
+
+    # WHEN the variant has no mapping in the other genome build
+    monkeypatch.setattr(patient, "liftover", lambda *args: [])
+    # THEN only the key of the original variant should be saved
+    assert variant_index(features) == [{"feature": 0, "key": "37:19:1105813:G:T"}]